@@ -1,98 +1,585 @@
+import os, gc, math, struct
+from array import array
+
 from rustworkx import PyDiGraph
-from Node import Node
+from Node import Node, GATE_NAME, QUBIT, X, Y, Z, H, S, SDG, RZ, CX, GPI, GPI2, VZ, MS
+
+### Parameter slots per node in the compact storage (ms has the most)
+MAX_PARAMS = 3
+
+### Native circuit files are written in chunks of this many lines / bytes
+WRITE_CHUNK_LINES = 1<<14
+WRITE_CHUNK_BYTES = 1<<18
+
+### Binary native circuit format, also read by the qecc simulator (src/circuit.rs).
+### All little-endian: BINARY_MAGIC, u32 num_qubits, u32 approx_factor, then per gate
+### a u8 code followed by a u32 qubit, and a u32 second qubit for ms or a u16 depth for rz with depth
+BINARY_EXT = '.bin'
+BINARY_MAGIC = b'QCB\x01'
+BINARY_GPI, BINARY_GPI2, BINARY_RZ, BINARY_RZ_DEPTH, BINARY_MS = range(5)
+BINARY_CODE = {GPI: BINARY_GPI, GPI2: BINARY_GPI2, RZ: BINARY_RZ, MS: BINARY_MS}
+BINARY_HEADER = struct.Struct('<II')
+BINARY_ONE_QUBIT = struct.Struct('<BI')
+BINARY_TWO_QUBIT = struct.Struct('<BII')
+BINARY_DEPTH = struct.Struct('<BIH')
+
+### Gate names of native circuit files, and the gate codes of the binary format
+NATIVE_OPCODE = {b'gpi': GPI, b'gpi2': GPI2, b'rz': RZ, b'ms': MS}
+BINARY_OPCODE = {BINARY_GPI: GPI, BINARY_GPI2: GPI2, BINARY_RZ: RZ, BINARY_RZ_DEPTH: RZ, BINARY_MS: MS}
+
+def read_native_gates(data: bytes) -> (int, int, [(int, int, int)]):
+    """ Parse a native circuit file of either format.
+        Returns num_qubits, approx_factor and the gates as (opcode, qubit, arg), arg as in Circuit.native_gates """
+    gates = []
+    if data.startswith(BINARY_MAGIC):
+        pos = len(BINARY_MAGIC)
+        num_qubits, approx_factor = BINARY_HEADER.unpack_from(data, pos)
+        pos += BINARY_HEADER.size
+        while pos<len(data):
+            code = data[pos]
+            if code==BINARY_MS:
+                _, qubit, arg = BINARY_TWO_QUBIT.unpack_from(data, pos)
+                pos += BINARY_TWO_QUBIT.size
+            elif code==BINARY_RZ_DEPTH:
+                _, qubit, arg = BINARY_DEPTH.unpack_from(data, pos)
+                pos += BINARY_DEPTH.size
+            elif code in BINARY_OPCODE:
+                _, qubit = BINARY_ONE_QUBIT.unpack_from(data, pos)
+                arg = -1
+                pos += BINARY_ONE_QUBIT.size
+            else:
+                raise Exception(f'Invalid gate code %d at byte %d'%(code, pos))
+            gates.append((BINARY_OPCODE[code], qubit, arg))
+    else:
+        lines = data.split(b'\n')
+        num_qubits, approx_factor = map(int, lines[0].split())
+        for line in lines[1:]:
+            parts = line.split()
+            if not parts:
+                continue
+            opcode = NATIVE_OPCODE.get(parts[0])
+            if opcode==None:
+                raise Exception(f'Invalid gate instruction %s'%line.decode())
+            gates.append((opcode, int(parts[1]), int(parts[2]) if len(parts)>2 else -1))
+    return num_qubits, approx_factor, gates
+
+class CompactDAG(PyDiGraph):
+    """ DAG of a compact Circuit: payloads are None, and indexing returns a NodeRef into the circuit arrays """
+    def __getitem__(self, node_index: int):
+        return NodeRef(self.circuit, node_index)
+
+    ### The graph state of PyDiGraph does not carry subclass attributes, so copies restore the circuit here
+    def __getstate__(self):
+        return (super().__getstate__(), self.circuit)
+
+    def __setstate__(self, state):
+        graph_state, self.circuit = state
+        super().__setstate__(graph_state)
+
+class NodeRef:
+    """ Node-like view of the node_index-th gate of a compact Circuit, reads and writes go to its arrays """
+    __slots__ = ('circuit', 'node_index')
+
+    def __init__(self, circuit, node_index: int):
+        self.circuit = circuit
+        self.node_index = node_index
+
+    @property
+    def opcode(self) -> int:
+        return self.circuit.opcodes[self.node_index]
+
+    @opcode.setter
+    def opcode(self, opcode: int):
+        self.circuit.opcodes[self.node_index] = opcode
+
+    @property
+    def name(self) -> str:
+        return GATE_NAME[self.circuit.opcodes[self.node_index]]
+
+    @property
+    def qubits(self):
+        return QubitsRef(self.circuit, self.node_index)
+
+    @qubits.setter
+    def qubits(self, qubits: [int]):
+        self.circuit.store_qubits(self.node_index, qubits)
+
+    @property
+    def parameter(self):
+        return ParameterRef(self.circuit, self.node_index)
+
+    @parameter.setter
+    def parameter(self, parameter: list):
+        self.circuit.store_parameter(self.node_index, parameter)
+
+    @property
+    def duration(self) -> int:
+        return self.circuit.durations[self.node_index]
+
+    @duration.setter
+    def duration(self, duration: int):
+        self.circuit.durations[self.node_index] = duration
+
+    @property
+    def clifford(self) -> bool:
+        return bool(self.circuit.cliffords[self.node_index])
+
+    @clifford.setter
+    def clifford(self, clifford: bool):
+        self.circuit.cliffords[self.node_index] = clifford
+
+    def to_node(self) -> Node:
+        return Node(self.opcode, list(self.qubits), list(self.parameter), self.duration, self.clifford)
+
+    __str__ = Node.__str__
+
+class QubitsRef:
+    """ List-like view of the qubits of a compact node """
+    __slots__ = ('circuit', 'node_index')
+
+    def __init__(self, circuit, node_index: int):
+        self.circuit = circuit
+        self.node_index = node_index
+
+    def __len__(self) -> int:
+        return 1 if self.circuit.node_qubits[2*self.node_index+1]<0 else 2
+
+    def __getitem__(self, k: int) -> int:
+        if k<0:
+            k += len(self)
+        if k<0 or k>=len(self):
+            raise IndexError(k)
+        return self.circuit.node_qubits[2*self.node_index+k]
+
+    def __setitem__(self, k: int, qubit: int):
+        if k<0:
+            k += len(self)
+        if k<0 or k>=len(self):
+            raise IndexError(k)
+        self.circuit.node_qubits[2*self.node_index+k] = qubit
+
+    def __iter__(self):
+        return iter([self[k] for k in range(len(self))])
+
+    def index(self, qubit: int) -> int:
+        return list(self).index(qubit)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class ParameterRef:
+    """ List-like view of the parameters of a compact node, int parameters are kept as int """
+    __slots__ = ('circuit', 'node_index')
+
+    def __init__(self, circuit, node_index: int):
+        self.circuit = circuit
+        self.node_index = node_index
+
+    def __len__(self) -> int:
+        return self.circuit.param_counts[self.node_index]
+
+    def __getitem__(self, k: int):
+        if k<0:
+            k += len(self)
+        if k<0 or k>=len(self):
+            raise IndexError(k)
+        value = self.circuit.parameters[MAX_PARAMS*self.node_index+k]
+        return int(value) if (self.circuit.int_params[self.node_index]>>k)&1 else value
+
+    def __setitem__(self, k: int, value):
+        if k<0:
+            k += len(self)
+        if k<0 or k>=len(self):
+            raise IndexError(k)
+        self.circuit.parameters[MAX_PARAMS*self.node_index+k] = value
+        if isinstance(value, int):
+            self.circuit.int_params[self.node_index] |= (1<<k)
+        else:
+            self.circuit.int_params[self.node_index] &= ~(1<<k)
+
+    def __iter__(self):
+        return iter([self[k] for k in range(len(self))])
+
+    def __repr__(self):
+        return repr(list(self))
 
 '''
     Logical quantum circuit
 '''
 class Circuit:
-    def __init__(self, num_qubits):
+    def __init__(self, num_qubits, compact: bool = False):
         self.num_qubits = num_qubits
-        self.dag = PyDiGraph()
         self.qubit_list = []
         self.last_gates = []
 
+        ### Compact circuits keep the node payloads as struct-of-arrays indexed by node index,
+        ### instead of a Node object per gate. self.dag[i] then returns a NodeRef into these arrays
+        self.compact = compact
+        if compact:
+            self.dag = CompactDAG()
+            self.dag.circuit = self
+            self.opcodes = array('B')
+            self.node_qubits = array('l')       ### 2 per node, -1 if unused
+            self.parameters = array('d')        ### MAX_PARAMS per node
+            self.param_counts = array('B')
+            self.int_params = array('B')        ### bit k set if the k-th parameter is an int
+            self.durations = array('H')
+            self.cliffords = array('B')
+        else:
+            self.dag = PyDiGraph()
+
+        ### Wire index: two slots per node index, one for each qubit the node is applied to
+        ### wire_qubits[2*i+k] is the k-th qubit of node i (-1 if unused),
+        ### wire_next/wire_prev[2*i+k] are the adjacent node indices on that qubit (-1 if none)
+        self.wire_qubits = array('l')
+        self.wire_next = array('l')
+        self.wire_prev = array('l')
+
         for qubit in range(num_qubits):
-            node_index = self.dag.add_node(Node('qubit', [qubit], []))
+            node_index = self.add_node(Node(QUBIT, [qubit], []))
             self.qubit_list.append(node_index)
             self.last_gates.append(node_index)
 
-    def append_gate(self, name, qubits, parameter=[], duration=1, clifford=True):
-        node = Node(name, qubits, parameter, duration, clifford)
+    @classmethod
+    def from_txt(cls, filepath: str, compact: bool = False):
+        """ Load a native circuit written by circuit_to_txt, in either format. Returns (circuit, approx_factor).
+            The files keep no angles: gpi / gpi2 phases and no-QEC rz angles are loaded as nan,
+            and rz of QEC circuits get their depth as int parameter, as rz_approximation leaves them.
+            The nodes, edges and wires are built in one pass and added to the DAG in bulk """
+        with open(filepath, 'rb') as f:
+            num_qubits, approx_factor, gates = read_native_gates(f.read())
+        circuit = cls(num_qubits, compact)
+        ### A fresh DAG numbers the gates right after the qubit nodes
+        first_index = num_qubits
+        num_nodes = first_index + len(gates)
+
+        gate_qubits = [(qubit, arg) if opcode==MS else (qubit,) for opcode, qubit, arg in gates]
+        for qubits in gate_qubits:
+            if max(qubits)>=num_qubits:
+                raise Exception(f'Invalid qubit %d in %s'%(max(qubits), filepath))
+
+        if compact:
+            node_indices = circuit.dag.add_nodes_from([None]*len(gates))
+            circuit.opcodes.extend(array('B', [opcode for opcode, _, _ in gates]))
+            parameters = []
+            param_counts = array('B', [1])*len(gates)
+            int_params = array('B', [0])*len(gates)
+            durations = array('H', [1])*len(gates)
+            cliffords = array('B', [1])*len(gates)
+            for k, (opcode, _, arg) in enumerate(gates):
+                if opcode==MS:
+                    parameters += (0.0, 0.0, math.pi/2)
+                    param_counts[k] = 3
+                    int_params[k] = 0b011
+                    durations[k] = 5
+                elif opcode==RZ and arg>=0:
+                    parameters += (arg, 0.0, 0.0)
+                    int_params[k] = 1
+                    cliffords[k] = 0
+                else:
+                    parameters += (math.nan, 0.0, 0.0)
+            circuit.parameters.extend(array('d', parameters))
+            circuit.param_counts.extend(param_counts)
+            circuit.int_params.extend(int_params)
+            circuit.durations.extend(durations)
+            circuit.cliffords.extend(cliffords)
+        else:
+            ### Only acyclic objects are allocated here, pause the cyclic GC that would rescan them
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            nodes = []
+            for opcode, qubit, arg in gates:
+                if opcode==MS:
+                    nodes.append(Node(MS, [qubit, arg], [0, 0, math.pi/2], duration=5))
+                elif opcode==RZ and arg>=0:
+                    nodes.append(Node(RZ, [qubit], [arg], clifford=False))
+                else:
+                    nodes.append(Node(opcode, [qubit], [math.nan]))
+            if gc_enabled:
+                gc.enable()
+            node_indices = circuit.dag.add_nodes_from(nodes)
+        assert(len(node_indices)==0 or (node_indices[0]==first_index and node_indices[-1]==num_nodes-1))
+        circuit.dag.add_edges_from_no_data(circuit.link_wires(node_indices, gate_qubits))
+        if compact:
+            circuit.node_qubits = circuit.wire_qubits[:]
+
+        return circuit, approx_factor
+
+    def clone(self):
+        """ Independent copy of the circuit, made without deepcopy.
+            The graph structure is copied natively (node indices and free slots are kept),
+            so only the node payloads are copied in Python: the arrays in compact mode,
+            or one shallow Node copy per gate otherwise """
+        circuit = Circuit.__new__(Circuit)
+        circuit.num_qubits = self.num_qubits
+        circuit.qubit_list = list(self.qubit_list)
+        circuit.last_gates = list(self.last_gates)
+        circuit.compact = self.compact
+        circuit.wire_qubits = self.wire_qubits[:]
+        circuit.wire_next = self.wire_next[:]
+        circuit.wire_prev = self.wire_prev[:]
+
+        if self.compact:
+            circuit.dag = CompactDAG()
+            PyDiGraph.__setstate__(circuit.dag, PyDiGraph.__getstate__(self.dag))
+            circuit.dag.circuit = circuit
+            circuit.opcodes = self.opcodes[:]
+            circuit.node_qubits = self.node_qubits[:]
+            circuit.parameters = self.parameters[:]
+            circuit.param_counts = self.param_counts[:]
+            circuit.int_params = self.int_params[:]
+            circuit.durations = self.durations[:]
+            circuit.cliffords = self.cliffords[:]
+        else:
+            ### Payloads are shared by the copied graph, and nodes are modified in place by the optimizers.
+            ### qubits lists are only ever replaced, never modified, so they stay shared (copy-on-write)
+            circuit.dag = self.dag.copy()
+            ### Only acyclic objects are allocated here, pause the cyclic GC that would rescan them
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            for node_index, node in zip(self.dag.node_indices(), self.dag.nodes()):
+                circuit.dag[node_index] = Node(node.opcode, node.qubits, node.parameter.copy(),
+                                               node.duration, node.clifford)
+            if gc_enabled:
+                gc.enable()
+
+        return circuit
+
+    def append_gate(self, opcode, qubits, parameter=[], duration=1, clifford=True):
+        node = Node(opcode, qubits, parameter, duration, clifford)
         self.append_node(node)
 
     def append_node(self, node):
-        node_index = self.dag.add_node(node)
-        for qubit in node.qubits:
+        node_index = self.add_node(node)
+        for slot, qubit in enumerate(node.qubits, 2*node_index):
             last_gate = self.last_gates[qubit]
             self.dag.add_edge(last_gate, node_index, None)
+            self.wire_next[self.wire_slot(qubit, last_gate)] = node_index
+            self.wire_prev[slot] = last_gate
             self.last_gates[qubit] = node_index
 
-    def get_next_gate(self, qubit_index: int, node_index: int) -> int:
-        next_candidate = []
-        for next_index in self.dag.successor_indices(node_index):
-            if qubit_index in self.dag[next_index].qubits:
-                next_candidate.append(next_index)
-
-        if len(next_candidate)==1:
-            return next_candidate[0]
-        elif len(next_candidate)==2:
-            assert(self.dag[node_index].name=='cx' or self.dag[node_index].name=='ms')
-            gate1 = self.dag[next_candidate[0]]
-            gate2 = self.dag[next_candidate[1]]
-            ### case 1) not ambiguous
-            if qubit_index not in gate1.qubits:
-                assert(qubit_index in gate2.qubits)
-                return next_candidate[1]
-            elif qubit_index not in gate2.qubits:
-                assert(qubit_index in gate1.qubits)
-                return next_candidate[0]
-            ### case 2) ambiguous with different gate
-            elif next_candidate[0]!=next_candidate[1]:
-                curr_node = self.dag[node_index]
-                if curr_node.qubits.index(qubit_index)==0:
-                    pair_index = curr_node.qubits[1]
-                else:
-                    pair_index = curr_node.qubits[0]
-                if qubit_index in gate1.qubits and pair_index in gate1.qubits:
-                    return next_candidate[1]
-                else:
-                    assert(qubit_index in gate2.qubits and pair_index in gate2.qubits)
-                    return next_candidate[0]
-            ### case 3) ambiguous with same gate
-            else:
-                return next_candidate[0]
+    def append_nodes(self, nodes: [Node]):
+        """ append_node of every node in order, the nodes and edges being added to the DAG in bulk """
+        if self.compact:
+            node_indices = self.dag.add_nodes_from([None]*len(nodes))
+            for node_index, node in zip(node_indices, nodes):
+                self.store_node(node_index, node)
         else:
-            assert(len(next_candidate)==0)
-            return None
+            node_indices = self.dag.add_nodes_from(nodes)
+        self.dag.add_edges_from_no_data(self.link_wires(node_indices, [node.qubits for node in nodes]))
 
-    def get_prev_gate(self, qubit_index: int, node_index: int) -> int:
-        prev_candidate = []
-        for prev_index in self.dag.predecessor_indices(node_index):
-            if qubit_index in self.dag[prev_index].qubits:
-                prev_candidate.append(prev_index)
-
-        if len(prev_candidate)==1:
-            return prev_candidate[0]
-        elif len(prev_candidate)==2:
-            gate1 = self.dag[prev_candidate[0]]
-            gate2 = self.dag[prev_candidate[1]]
-            ### case 1) 2Q gate preceded by 1Q gate and 2Q gate
-            if prev_candidate[0]!=prev_candidate[1]:
-                curr_node = self.dag[node_index]
-                pair_index = curr_node.qubits[(curr_node.qubits.index(qubit_index)+1)%2]
-
-                if qubit_index in gate1.qubits and \
-                  pair_index in gate1.qubits:
-                    return prev_candidate[1]
-                else:
-                    assert(qubit_index in gate2.qubits and pair_index in gate2.qubits and pair_index not in gate1.qubits)
-                    return prev_candidate[0]
-            ### case 2) 2Q gate preceded by another 2Q gate that is applied to the same two qubits
-            else:
-                return prev_candidate[0]
+    def link_wires(self, node_indices: [int], gate_qubits: [[int]]) -> [(int, int)]:
+        """ Append the new nodes node_indices, applied to gate_qubits, to the end of their wires in order.
+            Sets their wire slots and returns the DAG edges still to be added """
+        wire_qubits = self.wire_qubits
+        wire_next = self.wire_next
+        wire_prev = self.wire_prev
+        last_gates = self.last_gates
+        node_indices = list(node_indices)
+        num_slots = 2*(max(node_indices, default=-1)+1)
+        if num_slots>len(wire_qubits):
+            grow = num_slots - len(wire_qubits)
+            wire_qubits.extend(array('l', [-1])*grow)
+            wire_next.extend(array('l', [-1])*grow)
+            wire_prev.extend(array('l', [-1])*grow)
+
+        edges = []
+        for node_index, qubits in zip(node_indices, gate_qubits):
+            slot = 2*node_index
+            ### rustworkx reuses indices of removed nodes, so the slots are reset
+            wire_qubits[slot+1] = -1
+            wire_next[slot] = wire_next[slot+1] = wire_prev[slot+1] = -1
+            for gate_slot, gate_qubit in enumerate(qubits, slot):
+                wire_qubits[gate_slot] = gate_qubit
+                last_gate = last_gates[gate_qubit]
+                edges.append((last_gate, node_index))
+                last_slot = 2*last_gate if wire_qubits[2*last_gate]==gate_qubit else 2*last_gate+1
+                wire_next[last_slot] = node_index
+                wire_prev[gate_slot] = last_gate
+                last_gates[gate_qubit] = node_index
+        return edges
+
+    def add_node(self, node) -> int:
+        """ Add a node to the DAG without connecting it to any wire """
+        if self.compact:
+            node_index = self.dag.add_node(None)
+            self.store_node(node_index, node)
+        else:
+            node_index = self.dag.add_node(node)
+        self.reset_wire_slots(node_index, node.qubits)
+        return node_index
+
+    def reset_wire_slots(self, node_index: int, qubits: [int]):
+        """ Point the wire slots of node_index to qubits, unconnected """
+        qubit0 = qubits[0]
+        qubit1 = qubits[1] if len(qubits)==2 else -1
+        slot = 2*node_index
+        if slot==len(self.wire_qubits):
+            self.wire_qubits.append(qubit0)
+            self.wire_qubits.append(qubit1)
+            self.wire_next.extend((-1, -1))
+            self.wire_prev.extend((-1, -1))
+        else:
+            ### rustworkx reuses indices of removed nodes, so the slots are reset
+            assert(slot<len(self.wire_qubits))
+            self.wire_qubits[slot] = qubit0
+            self.wire_qubits[slot+1] = qubit1
+            self.wire_next[slot] = self.wire_next[slot+1] = -1
+            self.wire_prev[slot] = self.wire_prev[slot+1] = -1
+
+    def store_node(self, node_index: int, node):
+        """ Write the payload of node into the compact arrays at node_index """
+        if node_index==len(self.opcodes):
+            self.opcodes.append(0)
+            self.node_qubits.extend((-1, -1))
+            self.parameters.extend([0.0]*MAX_PARAMS)
+            self.param_counts.append(0)
+            self.int_params.append(0)
+            self.durations.append(0)
+            self.cliffords.append(0)
+        else:
+            assert(node_index<len(self.opcodes))
+        self.opcodes[node_index] = node.opcode
+        self.store_qubits(node_index, node.qubits)
+        self.store_parameter(node_index, node.parameter)
+        self.durations[node_index] = node.duration
+        self.cliffords[node_index] = node.clifford
+
+    def store_qubits(self, node_index: int, qubits: [int]):
+        assert(len(qubits)==1 or len(qubits)==2)
+        self.node_qubits[2*node_index] = qubits[0]
+        self.node_qubits[2*node_index+1] = qubits[1] if len(qubits)==2 else -1
+
+    def store_parameter(self, node_index: int, parameter: list):
+        assert(len(parameter)<=MAX_PARAMS)
+        int_mask = 0
+        for k, value in enumerate(parameter):
+            self.parameters[MAX_PARAMS*node_index+k] = value
+            if isinstance(value, int):
+                int_mask |= (1<<k)
+        self.param_counts[node_index] = len(parameter)
+        self.int_params[node_index] = int_mask
+
+    def remove_node(self, node_index: int):
+        """ Remove a node from the DAG, detaching every wire that still points to it """
+        for slot in (2*node_index, 2*node_index+1):
+            qubit_index = self.wire_qubits[slot]
+            if qubit_index<0:
+                continue
+            prev_index = self.wire_prev[slot]
+            if prev_index>=0:
+                prev_slot = self.wire_slot(qubit_index, prev_index)
+                if self.wire_next[prev_slot]==node_index:
+                    self.wire_next[prev_slot] = -1
+            next_index = self.wire_next[slot]
+            if next_index>=0:
+                next_slot = self.wire_slot(qubit_index, next_index)
+                if self.wire_prev[next_slot]==node_index:
+                    self.wire_prev[next_slot] = -1
+            self.wire_qubits[slot] = -1
+            self.wire_next[slot] = -1
+            self.wire_prev[slot] = -1
+        self.dag.remove_node(node_index)
+
+    def replace_nodes(self, replacements: [(int, [Node])]):
+        """ Replace single-qubit nodes by chains of single-qubit nodes on the same wire, in one batch.
+            replacements are (node_index, nodes), nodes being applied in order and possibly empty.
+            The new nodes and edges are added to the DAG in bulk and the old nodes removed at the end """
+        new_nodes = [node for _, nodes in replacements for node in nodes]
+        if self.compact:
+            new_indices = list(self.dag.add_nodes_from([None]*len(new_nodes)))
+            for node_index, node in zip(new_indices, new_nodes):
+                self.store_node(node_index, node)
         else:
-            assert(len(prev_candidate)==0)
-            return None
+            new_indices = list(self.dag.add_nodes_from(new_nodes))
+        for node_index, node in zip(new_indices, new_nodes):
+            self.reset_wire_slots(node_index, node.qubits)
+
+        wire_qubits = self.wire_qubits
+        wire_next = self.wire_next
+        wire_prev = self.wire_prev
+        edges = []
+        k = 0
+        for node_index, nodes in replacements:
+            slot = 2*node_index
+            assert(wire_qubits[slot+1]<0)
+            qubit_index = wire_qubits[slot]
+            ### Read from the wire as it is now, so that adjacent replaced nodes chain up
+            chain = [wire_prev[slot]]
+            chain += new_indices[k:k+len(nodes)]
+            k += len(nodes)
+            next_index = wire_next[slot]
+            if next_index>=0:
+                chain.append(next_index)
+            else:
+                wire_next[self.wire_slot(qubit_index, chain[-1])] = -1
+            for src_index, dst_index in zip(chain, chain[1:]):
+                edges.append((src_index, dst_index))
+                wire_next[self.wire_slot(qubit_index, src_index)] = dst_index
+                wire_prev[self.wire_slot(qubit_index, dst_index)] = src_index
+            wire_qubits[slot] = wire_next[slot] = wire_prev[slot] = -1
+        self.dag.add_edges_from_no_data(edges)
+        self.dag.remove_nodes_from([node_index for node_index, _ in replacements])
+
+    def remove_gate(self, node_index: int) -> [(int, int)]:
+        """ Remove a gate and reconnect each of its wires around it.
+            Returns (qubit_index, prev_index) of every wire the gate was on """
+        wires = []
+        for slot in (2*node_index, 2*node_index+1):
+            qubit_index = self.wire_qubits[slot]
+            if qubit_index>=0:
+                wires.append((qubit_index, self.wire_prev[slot], self.wire_next[slot]))
+        self.remove_node(node_index)
+        for qubit_index, prev_index, next_index in wires:
+            if next_index>=0:
+                self.add_edge(qubit_index, prev_index, next_index)
+        return [(qubit_index, prev_index) for qubit_index, prev_index, _ in wires]
+
+    def num_gates(self) -> int:
+        """ Number of gates, the qubit nodes aside """
+        return self.dag.num_nodes() - self.num_qubits
+
+    def add_edge(self, qubit_index: int, src_index: int, dst_index: int):
+        """ Connect src_index to dst_index along the wire of qubit_index """
+        self.dag.add_edge(src_index, dst_index, None)
+        self.wire_next[self.wire_slot(qubit_index, src_index)] = dst_index
+        self.wire_prev[self.wire_slot(qubit_index, dst_index)] = src_index
+
+    def remove_edge(self, qubit_index: int, src_index: int, dst_index: int):
+        """ Disconnect src_index from dst_index along the wire of qubit_index """
+        self.dag.remove_edge(src_index, dst_index)
+        src_slot = self.wire_slot(qubit_index, src_index)
+        if self.wire_next[src_slot]==dst_index:
+            self.wire_next[src_slot] = -1
+        dst_slot = self.wire_slot(qubit_index, dst_index)
+        if self.wire_prev[dst_slot]==src_index:
+            self.wire_prev[dst_slot] = -1
+
+    def wire_slot(self, qubit_index: int, node_index: int) -> int:
+        slot = 2*node_index
+        if self.wire_qubits[slot]==qubit_index:
+            return slot
+        elif self.wire_qubits[slot+1]==qubit_index:
+            return slot+1
+        return -1
+
+    def get_next_gate(self, qubit_index: int, node_index: int) -> int:
+        slot = 2*node_index
+        if self.wire_qubits[slot]!=qubit_index:
+            slot += 1
+            if self.wire_qubits[slot]!=qubit_index:
+                return None
+        next_index = self.wire_next[slot]
+        return next_index if next_index>=0 else None
+
+    def get_prev_gate(self, qubit_index: int, node_index: int) -> int:
+        slot = 2*node_index
+        if self.wire_qubits[slot]!=qubit_index:
+            slot += 1
+            if self.wire_qubits[slot]!=qubit_index:
+                return None
+        prev_index = self.wire_prev[slot]
+        return prev_index if prev_index>=0 else None
         
     def print_circuit(self, abstract: bool):
         for qubit_index in range(self.num_qubits):
@@ -101,24 +588,24 @@ class Circuit:
             while curr_index!=None:
                 curr_node = self.dag[curr_index]
                 if abstract:
-                    if curr_node.name in ['x', 'y', 'z', 'h', 's']:
+                    if curr_node.opcode in (X, Y, Z, H, S):
                         qubit_line += " %s"%curr_node.name
-                    elif curr_node.name=='sdg':
+                    elif curr_node.opcode==SDG:
                         qubit_line += " d"
-                    elif curr_node.name=='rz':
+                    elif curr_node.opcode==RZ:
                         qubit_line += " r"
-                    elif curr_node.name=='cx':
+                    elif curr_node.opcode==CX:
                         qubit_line += " c"
                     else:
                         raise Exception(f"Invalid gate name %s"%curr_node.name)
                 else:
-                    if curr_node.name=='gpi':
+                    if curr_node.opcode==GPI:
                         qubit_line += " g"
-                    elif curr_node.name=='gpi2':
+                    elif curr_node.opcode==GPI2:
                         qubit_line += " p"
-                    elif curr_node.name=='ms':
+                    elif curr_node.opcode==MS:
                         qubit_line += " m"
-                    elif curr_node.name=='rz' or curr_node.name=='vz':
+                    elif curr_node.opcode==RZ or curr_node.opcode==VZ:
                         qubit_line += " r"
                     else:
                         raise Exception(f"Invalid gate name %s"%curr_node.name)
@@ -126,51 +613,49 @@ class Circuit:
             #qubit_line += '\n'
             print(qubit_line)
 
-    def circuit_to_txt(self, filepath: str, qec: bool, approx_factor: int) -> int:
-        output_file = open(filepath, 'w+')
-        output_file.write("%d %d"%(self.num_qubits, approx_factor))
-        gate_cnt = 0
-
+    def native_gates(self, qec: bool):
+        """ Yield the native gates in file order, as (opcode, qubit, arg).
+            arg is the second qubit of ms, the depth of rz with qec, and -1 otherwise """
+        ### Bound once, they are used for every gate
+        dag = self.dag
+        get_next_gate = self.get_next_gate
         qubit_stack = []
         pending_gate = []
         for qubit_index in range(self.num_qubits):
-            pending_gate.append(self.get_next_gate(qubit_index, qubit_index))
+            pending_gate.append(get_next_gate(qubit_index, qubit_index))
 
         for qubit_index in range(self.num_qubits):
             curr_qubit_index = qubit_index
             curr_index = pending_gate[curr_qubit_index]
 
             while curr_index!=None:
-                curr_node = self.dag[curr_index]
-                if curr_node.name in ['gpi', 'gpi2']:
-                    output_file.write("\n%s %d"%(curr_node.name, curr_qubit_index))
-                    gate_cnt += 1
-                    next_index = self.get_next_gate(curr_qubit_index, curr_index)
+                curr_node = dag[curr_index]
+                opcode = curr_node.opcode
+                if opcode==GPI or opcode==GPI2:
+                    yield (opcode, curr_qubit_index, -1)
+                    next_index = get_next_gate(curr_qubit_index, curr_index)
                     pending_gate[curr_qubit_index] = next_index
                     curr_index = next_index
-                elif curr_node.name=='rz' and qec:
+                elif opcode==RZ and qec:
                     assert(isinstance(curr_node.parameter[0], int))
-                    output_file.write("\n%s %d %d"%(curr_node.name, curr_qubit_index, curr_node.parameter[0]))
-                    gate_cnt += 1
-                    next_index = self.get_next_gate(curr_qubit_index, curr_index)
+                    yield (RZ, curr_qubit_index, curr_node.parameter[0])
+                    next_index = get_next_gate(curr_qubit_index, curr_index)
                     pending_gate[curr_qubit_index] = next_index
                     curr_index = next_index
-                elif curr_node.name=='rz' and not qec:
+                elif opcode==RZ and not qec:
                     assert(isinstance(curr_node.parameter[0], float))
-                    output_file.write("\n%s %d"%(curr_node.name, curr_qubit_index))
-                    gate_cnt += 1
-                    next_index = self.get_next_gate(curr_qubit_index, curr_index)
+                    yield (RZ, curr_qubit_index, -1)
+                    next_index = get_next_gate(curr_qubit_index, curr_index)
                     assert(next_index==None)
                     pending_gate[curr_qubit_index] = next_index
                     curr_index = next_index
-                elif curr_node.name=='ms':
+                elif opcode==MS:
                     pair_qubit_index = curr_node.qubits[(curr_node.qubits.index(curr_qubit_index)+1)%2]
                     if qubit_stack and qubit_stack[-1]==(pair_qubit_index, curr_index):
-                        output_file.write("\n%s %d %d"%(curr_node.name, curr_node.qubits[0], curr_node.qubits[1]))
+                        yield (MS, curr_node.qubits[0], curr_node.qubits[1])
                         qubit_stack.pop()
-                        gate_cnt += 1
-                        pending_gate[curr_qubit_index] = self.get_next_gate(curr_qubit_index, curr_index)
-                        pending_gate[pair_qubit_index] = self.get_next_gate(pair_qubit_index, curr_index)
+                        pending_gate[curr_qubit_index] = get_next_gate(curr_qubit_index, curr_index)
+                        pending_gate[pair_qubit_index] = get_next_gate(pair_qubit_index, curr_index)
                     else:
                         qubit_stack.append((curr_qubit_index, curr_index))
                     curr_qubit_index = pair_qubit_index
@@ -181,6 +666,51 @@ class Circuit:
         for qubit_index in range(self.num_qubits):
             assert(pending_gate[qubit_index]==None)
 
-        output_file.close()
+    def circuit_to_txt(self, filepath: str, qec: bool, approx_factor: int) -> int:
+        """ Write the native circuit, in the binary format if filepath ends with BINARY_EXT.
+            Lines are joined and written in chunks instead of one write per gate """
+        ### Written next to filepath and renamed at the end, so readers never see a partial file
+        tmp_filepath = "%s.%d.tmp"%(filepath, os.getpid())
+        gate_cnt = 0
+
+        try:
+            if filepath.endswith(BINARY_EXT):
+                with open(tmp_filepath, 'wb') as output_file:
+                    output_file.write(BINARY_MAGIC + BINARY_HEADER.pack(self.num_qubits, approx_factor))
+                    chunk = bytearray()
+                    for opcode, qubit, arg in self.native_gates(qec):
+                        if opcode==MS:
+                            chunk += BINARY_TWO_QUBIT.pack(BINARY_CODE[MS], qubit, arg)
+                        elif arg>=0:
+                            chunk += BINARY_DEPTH.pack(BINARY_RZ_DEPTH, qubit, arg)
+                        else:
+                            chunk += BINARY_ONE_QUBIT.pack(BINARY_CODE[opcode], qubit)
+                        gate_cnt += 1
+                        if len(chunk)>=WRITE_CHUNK_BYTES:
+                            output_file.write(chunk)
+                            chunk = bytearray()
+                    output_file.write(chunk)
+            else:
+                with open(tmp_filepath, 'w') as output_file:
+                    output_file.write("%d %d"%(self.num_qubits, approx_factor))
+                    chunk = [""]
+                    for opcode, qubit, arg in self.native_gates(qec):
+                        if arg<0:
+                            chunk.append("%s %d"%(GATE_NAME[opcode], qubit))
+                        else:
+                            chunk.append("%s %d %d"%(GATE_NAME[opcode], qubit, arg))
+                        gate_cnt += 1
+                        if len(chunk)>=WRITE_CHUNK_LINES:
+                            output_file.write("\n".join(chunk))
+                            chunk = [""]
+                    if len(chunk)>1:
+                        output_file.write("\n".join(chunk))
+        except BaseException:
+            ### No orphan temporary file is left next to filepath (e.g. native_gates asserting on an invalid gate)
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+
+        os.replace(tmp_filepath, filepath)
 
-        return gate_cnt
\ No newline at end of file
+        return gate_cnt
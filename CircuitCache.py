@@ -0,0 +1,81 @@
+import os, glob, pickle, shutil, hashlib
+
+_filepath = os.path.abspath(__file__)
+_dirname = os.path.dirname(_filepath)
+
+### Sources whose change invalidates the cached stages after transpiling
+PIPELINE_SOURCES = ["Node.py", "Circuit.py", "CircuitOpt.py", "CircuitGenerator.py"]
+
+def source_hash(filepaths: [str]) -> str:
+    """ Hash of the contents of the given source files """
+    digest = hashlib.sha256()
+    for filepath in sorted(filepaths):
+        digest.update(os.path.relpath(filepath, _dirname).encode())
+        with open(filepath, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def benchmark_version() -> str:
+    """ Version of the Qiskit circuit generation: benchmark sources and Qiskit itself """
+    import qiskit
+    benchmark_sources = glob.glob(os.path.join(_dirname, "benchmark", "**", "*.py"), recursive=True)
+    return "%s-%s"%(qiskit.__version__, source_hash(benchmark_sources))
+
+def pipeline_version() -> str:
+    """ Version of the optimizer / converter code """
+    return source_hash([os.path.join(_dirname, source) for source in PIPELINE_SOURCES])
+
+'''
+    Content-addressed store of the intermediate artifacts of circuit generation.
+    Each artifact lives at <cache_dir>/<stage>/<key>, key being the hash of everything it was built from,
+    so an entry is never stale: a change of parameters or code simply maps to another key.
+    A cache without cache_dir is disabled, it misses every lookup and stores nothing.
+'''
+class CircuitCache:
+    def __init__(self, cache_dir: str = os.path.join(_dirname, "cache")):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, stage, key)
+
+    def load(self, stage: str, key: str):
+        """ Cached object of the stage, or None """
+        if self.cache_dir==None or not os.path.isfile(self.path(stage, key)):
+            return None
+        filepath = self.path(stage, key)
+        with open(filepath, 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, stage: str, key: str, obj):
+        if self.cache_dir==None:
+            return
+        filepath = self.path(stage, key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        ### Concurrent jobs may store the same key, the rename keeps every entry complete
+        tmp_filepath = "%s.%d.tmp"%(filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, filepath)
+
+    def load_file(self, stage: str, key: str, filepath: str) -> bool:
+        """ Copy a cached file of the stage to filepath, returns False if it is not cached """
+        if self.cache_dir==None or not os.path.isfile(self.path(stage, key)):
+            return False
+        cached_filepath = self.path(stage, key)
+        tmp_filepath = "%s.%d.tmp"%(filepath, os.getpid())
+        shutil.copyfile(cached_filepath, tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+        return True
+
+    def store_file(self, stage: str, key: str, filepath: str):
+        if self.cache_dir==None:
+            return
+        cached_filepath = self.path(stage, key)
+        os.makedirs(os.path.dirname(cached_filepath), exist_ok=True)
+        tmp_filepath = "%s.%d.tmp"%(cached_filepath, os.getpid())
+        shutil.copyfile(filepath, tmp_filepath)
+        os.replace(tmp_filepath, cached_filepath)
@@ -1,5 +1,7 @@
-import os, math, datetime
-from copy import deepcopy
+import os, sys, gc, math, time, datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 
 try:
     from qiskit import QuantumCircuit, transpile
@@ -15,15 +17,36 @@ from qiskit.quantum_info import Statevector
 
 from benchmark import *
 from Circuit import Circuit
-from CircuitOpt import AbsCircuitOptimizer, NativeConverter, NativeCircuitOptimizer, rz_approximation
+from CircuitCache import CircuitCache, benchmark_version, pipeline_version
+from OptProfiler import OptProfiler
+from StageReport import StageReport, write_reports
+from Node import Node, OPCODE, Z, S, SDG, RZ, CX, GPI, GPI2, VZ, MS
+from CircuitOpt import AbsCircuitOptimizer, NativeConverter, NativeCircuitOptimizer, rz_approximation_sweep
 
 _filepath = os.path.abspath(__file__)
 _dirname = os.path.dirname(_filepath)
 
-def main(algorithm: str, N: int, approx_factor: int):
+### Gate set the Qiskit circuits are transpiled to, before conversion to the abstract DAG
+BASIS_GATES = ['cx', 'x', 'y', 'z', 'rz','h']
+### Multiples of π/2 split off the rz angles, and the Clifford gate applying each
+CLIFFORD_ANGLES = np.array([0.0, math.pi/2, math.pi, 3*math.pi/2])
+CLIFFORD_GATES = (None, S, Z, SDG)
+
+def generate_qiskit(algorithm: str, N: int, approx_factor: int, report: StageReport = None) -> QuantumCircuit:
+    if report==None:
+        report = StageReport(algorithm, N, approx_factor)
     ### 1. Generate Qiskit circuit from benchmark
-    print("%s (%s %d(af %d)) Start generating Qiskit"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
+    with report.stage("qiskit", "generating Qiskit") as record:
+        qiskit_circ = benchmark_circuit(algorithm, N, approx_factor)
+        record['gate_cnt'] = qiskit_circ.size()
+
+    with report.stage("transpile", "transpiling") as record:
+        qiskit_circ = transpile(qiskit_circ, basis_gates=BASIS_GATES)
+        record['gate_cnt'] = qiskit_circ.size()
+
+    return qiskit_circ
+
+def benchmark_circuit(algorithm: str, N: int, approx_factor: int) -> QuantumCircuit:
     qiskit_circ: QuantumCircuit
     if algorithm.lower()=="ae":
         qiskit_circ = amplitude_estimation(N, approx_factor)
@@ -53,59 +76,120 @@ def main(algorithm: str, N: int, approx_factor: int):
         qiskit_circ = qft(N, s_int)
     elif algorithm.lower()=="vqe":
         qiskit_circ = vqe(N)
-    print("%s (%s %d(af %d)) Finish generating Qiskit"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    print("%s (%s %d(af %d)) Start transpiling"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    qiskit_circ = transpile(qiskit_circ, basis_gates=['cx', 'x', 'y', 'z', 'rz','h'])
-    print("%s (%s %d(af %d)) Finish transpiling"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    ### 2. Convert Qiskit to Abstract DAG
-    print("%s (%s %d(af %d)) Start Qiskit to DAG"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    abs_circ = qiskit_to_circuit(qiskit_circ)
-    print("%s (%s %d(af %d) Finish Qiskit to DAG"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    ### 3. Abstract Optimization
-    print("%s (%s %d(af %d)) Start abstract optimization"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    abs_opter = AbsCircuitOptimizer(abs_circ)
-    abs_circ = abs_opter.abs_opt()
-    print("%s (%s %d(af %d)) Finish abstract optimization"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    ### 4. Convert to Native
-    print("%s (%s %d(af %d)) Start native conversion"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    native_circ = NativeConverter().convert_to_native(abs_circ)
-    print("%s (%s %d(af %d)) Finish native conversion"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    ### 5. Native Optimization
-    print("%s (%s %d(af %d)) Start native optimization with QEC"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    native_circ_qec = deepcopy(native_circ)
-    native_opter_qec = NativeCircuitOptimizer(native_circ_qec)
-    native_circ_qec = native_opter_qec.native_opt(qec=True)
-    native_circ_qec, gate_cnt_qec1 = rz_approximation(native_circ_qec, threshold=13)
-    print("%s (%s %d(af %d)) Finish native optimization with QEC"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    print("%s (%s %d(af %d)) Start native optimization without QEC"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    native_circ_noqec = deepcopy(native_circ)
-    native_opter_noqec = NativeCircuitOptimizer(native_circ_noqec)
-    native_circ_noqec = native_opter_noqec.native_opt(qec=False)
-    print("%s (%s %d(af %d)) Finish native optimization without QEC"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-
-    ### 5-1. Intermediate step for state comparison
-    ### Only works for circuits with small number of qubits
-    ### To pass the following test, rz_approximation in line 87 should be deleted.
-    ### Deleting line 87 disables circuit_to_txt() in line 118, so use it for validity check only.
+    return qiskit_circ
+
+def main(algorithm: str, N: int, approx_factor: int, compact: bool = False, threshold: int = 13,
+         cache: CircuitCache = None, thresholds: [int] = (), profile: bool = False,
+         report: StageReport = None) -> {int: int}:
+    """ Generate the qec / noqec circuit files of one benchmark.
+        Each stage is looked up in the cache first, so a rerun restarts from the deepest stage still valid.
+        Each of thresholds adds a QEC circuit file <name>_qec_t<threshold>.txt, approximated from the same
+        QEC native optimization. With profile, the abstract optimization statistics go to <name>_opt.json
+        (only when it runs, not when its result is loaded from the cache).
+        The stages run (not those loaded from the cache) are timed into report.
+        Returns the gate count of the QEC circuit of each threshold """
+    if cache==None:
+        cache = CircuitCache(cache_dir=None)
+    if report==None:
+        report = StageReport(algorithm, N, approx_factor)
+    filepath_qec = os.path.join(_dirname, "circuit", "%s(%d)_af(%d)_qec.txt"%(algorithm, N, approx_factor))
+    filepath_noqec = os.path.join(_dirname, "circuit", "%s(%d)_af(%d)_noqec.txt"%(algorithm, N, approx_factor))
+    qec_filepaths = {threshold: [filepath_qec]}
+    for sweep_threshold in thresholds:
+        qec_filepaths.setdefault(sweep_threshold, []).append(os.path.join(_dirname, "circuit",
+            "%s(%d)_af(%d)_qec_t%d.txt"%(algorithm, N, approx_factor, sweep_threshold)))
+
+    qiskit_key = cache.key("transpiled", algorithm, N, approx_factor, BASIS_GATES, benchmark_version())
+    abs_key = cache.key("abstract", qiskit_key, compact, pipeline_version())
+    native_key = cache.key("native", abs_key)
+    qec_keys = {qec_threshold: cache.key("qec", native_key, qec_threshold) for qec_threshold in qec_filepaths}
+    noqec_key = cache.key("noqec", native_key)
+
+    qec_gate_cnts = {}
+    for qec_threshold, filepaths in qec_filepaths.items():
+        gate_cnt = cache.load("count", qec_keys[qec_threshold])
+        if gate_cnt!=None and all([cache.load_file("text", qec_keys[qec_threshold], filepath) for filepath in filepaths]):
+            qec_gate_cnts[qec_threshold] = gate_cnt
+    need_qec = [qec_threshold for qec_threshold in qec_filepaths if qec_threshold not in qec_gate_cnts]
+    need_noqec = not cache.load_file("text", noqec_key, filepath_noqec)
+    if not need_qec and not need_noqec:
+        report.log("Loaded circuit files from cache")
+        return qec_gate_cnts
+
+    native_circ = cache.load("native", native_key)
+    if native_circ==None:
+        abs_circ = cache.load("abstract", abs_key)
+        if abs_circ==None:
+            ### 1. Generate (or load) the transpiled Qiskit circuit
+            qiskit_circ = cache.load("transpiled", qiskit_key)
+            if qiskit_circ==None:
+                qiskit_circ = generate_qiskit(algorithm, N, approx_factor, report)
+                cache.store("transpiled", qiskit_key, qiskit_circ)
+
+            ### 2. Convert Qiskit to Abstract DAG
+            with report.stage("qiskit_to_circuit", "Qiskit to DAG") as record:
+                abs_circ = qiskit_to_circuit(qiskit_circ, compact)
+                record['gate_cnt'] = abs_circ.num_gates()
+
+            ### 3. Abstract Optimization
+            with report.stage("abstract_opt", "abstract optimization") as record:
+                profiler = OptProfiler() if profile else None
+                abs_opter = AbsCircuitOptimizer(abs_circ, profiler)
+                abs_circ = abs_opter.abs_opt(incremental=True)
+                record['gate_cnt'] = abs_circ.num_gates()
+            if profiler!=None:
+                profiler.to_json(os.path.join(_dirname, "circuit", "%s(%d)_af(%d)_opt.json"%(algorithm, N, approx_factor)))
+            cache.store("abstract", abs_key, abs_circ)
+
+        ### 4. Convert to Native
+        with report.stage("native_conversion", "native conversion") as record:
+            native_circ = NativeConverter().convert_to_native(abs_circ)
+            record['gate_cnt'] = native_circ.num_gates()
+        cache.store("native", native_key, native_circ)
+
+    ### 5. Native Optimization and 6. Write to file
+    if need_qec:
+        with report.stage("native_opt_qec", "native optimization with QEC") as record:
+            native_circ_qec = native_circ.clone()
+            native_opter_qec = NativeCircuitOptimizer(native_circ_qec)
+            native_circ_qec = native_opter_qec.native_opt(qec=True)
+            record['gate_cnt'] = native_circ_qec.num_gates()
+
+        ### One traversal and angle decomposition for every threshold still missing
+        sweep = rz_approximation_sweep(native_circ_qec, need_qec)
+        for _ in need_qec:
+            with report.stage("rz_approximation", "Rz approximation") as record:
+                qec_threshold, approx_circ_qec, gate_cnt_qec1 = next(sweep)
+                record['threshold'] = qec_threshold
+                record['gate_cnt'] = gate_cnt_qec1
+            with report.stage("write_qec", "writing QEC circuit") as record:
+                for filepath in qec_filepaths[qec_threshold]:
+                    gate_cnt_qec2 = approx_circ_qec.circuit_to_txt(filepath, True, approx_factor)
+                    assert(gate_cnt_qec1==gate_cnt_qec2)
+                record['threshold'] = qec_threshold
+                record['gate_cnt'] = gate_cnt_qec2
+            cache.store_file("text", qec_keys[qec_threshold], qec_filepaths[qec_threshold][0])
+            cache.store("count", qec_keys[qec_threshold], gate_cnt_qec1)
+            qec_gate_cnts[qec_threshold] = gate_cnt_qec1
+            report.log("Rz approximation with threshold %d: %d gates"%(qec_threshold, gate_cnt_qec1))
+
+    if need_noqec:
+        with report.stage("native_opt_noqec", "native optimization without QEC") as record:
+            native_circ_noqec = native_circ.clone()
+            native_opter_noqec = NativeCircuitOptimizer(native_circ_noqec)
+            native_circ_noqec = native_opter_noqec.native_opt(qec=False)
+            record['gate_cnt'] = native_circ_noqec.num_gates()
+
+        with report.stage("write_noqec", "writing circuit without QEC") as record:
+            record['gate_cnt'] = native_circ_noqec.circuit_to_txt(filepath_noqec, False, approx_factor)
+        cache.store_file("text", noqec_key, filepath_noqec)
+
+    return qec_gate_cnts
+
+    ### Intermediate step for state comparison
+    ### Only works for circuits with small number of qubits, and needs the transpiled qiskit_circ.
+    ### To pass the following test, rz_approximation above should be deleted,
+    ### which disables circuit_to_txt() with qec, so use it for validity check only.
     """print("%s (%s %d) Start reconstructing Qiskit"%(datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N))
     recon_qiskit_qec = native_qiskit_reconstructor(native_circ_qec)
     recon_qiskit_noqec = native_qiskit_reconstructor(native_circ_noqec)
@@ -119,18 +203,6 @@ def main(algorithm: str, N: int, approx_factor: int):
     assert(orig_state.equiv(recon_state_noqec))
     print("%s (%s %d) Finish comparison"%(datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N))"""
 
-    ### 6. Write to file
-    print("%s (%s %d(af %d)) Start writing to file"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    gate_cnt_qec2 = native_circ_qec.circuit_to_txt(\
-        os.path.join(_dirname, "circuit", "%s(%d)_af(%d)_qec.txt"%(algorithm, N, approx_factor)), True, approx_factor)
-    gate_cnt_noqec = native_circ_noqec.circuit_to_txt(\
-        os.path.join(_dirname, "circuit", "%s(%d)_af(%d)_noqec.txt"%(algorithm, N, approx_factor)), False, approx_factor)
-
-    assert(gate_cnt_qec1==gate_cnt_qec2)
-    print("%s (%s %d(af %d)) Finish writing to file"%\
-          (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, approx_factor))
-    
 def native_qiskit_reconstructor(native_circ: Circuit) -> QuantumCircuit:
     new_qiskit_qc = QuantumCircuit(native_circ.num_qubits)
     pending_gate = []
@@ -149,7 +221,7 @@ def native_qiskit_reconstructor(native_circ: Circuit) -> QuantumCircuit:
             assert(pending_gate[qubit_index]==curr_index)
             curr_node = native_circ.dag[curr_index]
 
-            if curr_node.name=='ms':
+            if curr_node.opcode==MS:
                 if stack and stack[-1][1]==curr_index:
                     pair_index, curr_index = stack.pop()
                     assert(pair_index==curr_node.qubits[(curr_node.qubits.index(qubit_index)+1)%2])
@@ -186,13 +258,13 @@ def native_qiskit_reconstructor(native_circ: Circuit) -> QuantumCircuit:
                     stack.append((pair_index, pending_gate[pair_index]))
                 continue
 
-            if curr_node.name=='gpi':
+            if curr_node.opcode==GPI:
                 param = curr_node.parameter[0]
                 new_qiskit_qc.u(math.pi, param, math.pi-param, qubit_index)
-            elif curr_node.name=='gpi2':
+            elif curr_node.opcode==GPI2:
                 param = curr_node.parameter[0]
                 new_qiskit_qc.u(math.pi/2, param-math.pi/2, math.pi/2-param, qubit_index)
-            elif curr_node.name=='vz' or curr_node.name=='rz':
+            elif curr_node.opcode==VZ or curr_node.opcode==RZ:
                 param = curr_node.parameter[0]
                 new_qiskit_qc.rz(param, qubit_index)
             else:
@@ -205,54 +277,135 @@ def native_qiskit_reconstructor(native_circ: Circuit) -> QuantumCircuit:
 
     return new_qiskit_qc
 
-def qiskit_to_circuit(qiskit_qc: QuantumCircuit) -> Circuit:
+def qiskit_to_circuit(qiskit_qc: QuantumCircuit, compact: bool = False) -> Circuit:
+    """ Abstract circuit of a Qiskit circuit transpiled to BASIS_GATES.
+        Every rz angle is normalized to [0, 2π) and split into a Clifford gate and a remaining rz at once,
+        then the nodes are appended to the DAG in bulk """
     qubit_offset = {}
     for qubit in qiskit_qc.qubits:
         qubit_offset[qubit] = len(qubit_offset)
-    circuit = Circuit(len(qubit_offset))
+    circuit = Circuit(len(qubit_offset), compact)
 
+    ### 1. Gates in order, rz angles being collected apart
+    gates = []
+    angles = []
+    ### Named attributes, unpacking an instruction as a tuple is deprecated and builds its operation
     for entry in qiskit_qc.data:
-        name = entry[0].name
-        qubit = entry[1][0]
+        operation = entry.operation
+        name = operation.name
+        qubit = entry.qubits[0]
         offset = qubit_offset[qubit]
 
         if name.lower() in ['x', 'y', 'z', 'h']:
-            assert(len(entry[1])==1)
-            circuit.append_gate(name.lower(), [offset], [])
+            assert(len(entry.qubits)==1)
+            gates.append((OPCODE[name.lower()], [offset]))
         elif name.lower()=='rz':
-            assert(len(entry[1])==1)
-            assert(len(entry[0].params)==1)
-            param = float(entry[0].params[0])
-            param = param - int(param/(2*math.pi))*(2*math.pi)
-            while param<0.0:
-                param += (2*math.pi)
-            while param>=2*math.pi:
-                param -= (2*math.pi)
-            if param>=3*math.pi/2:
-                circuit.append_gate('sdg', [offset], [])
-                param -= 3*math.pi/2
-            elif param>=math.pi:
-                circuit.append_gate('z', [offset], [])
-                param -= math.pi
-            elif param>=math.pi/2:
-                circuit.append_gate('s', [offset], [])
-                param -= math.pi/2
-            assert(param>=0.0 and param<math.pi)
-            if param!=0.0:
-                circuit.append_gate('rz', [offset], [param])
+            assert(len(entry.qubits)==1)
+            assert(len(operation.params)==1)
+            gates.append((RZ, [offset]))
+            angles.append(float(operation.params[0]))
         elif name.lower() in ['cx' or 'cnot']:
-            assert(len(entry[1])==2)
-            qubit2 = entry[1][1]
+            assert(len(entry.qubits)==2)
+            qubit2 = entry.qubits[1]
             offset2 = qubit_offset[qubit2]
-            circuit.append_gate('cx', [offset, offset2], [])
+            gates.append((CX, [offset, offset2]))
         elif name=="measure" or name=="barrier":
             continue
         else:
             print("invalid gate : %s q%d"%(name, offset))
             exit(-1)
 
+    ### 2. Angles in [0, 2π), the multiple of π/2 below each one is applied as sdg, z or s
+    angles = np.array(angles, dtype=float)
+    angles = angles - np.trunc(angles/(2*math.pi))*(2*math.pi)
+    angles = np.where(angles<0.0, angles+2*math.pi, angles)
+    angles = np.where(angles>=2*math.pi, angles-2*math.pi, angles)
+    quarters = np.searchsorted(CLIFFORD_ANGLES, angles, side='right') - 1
+    angles = angles - CLIFFORD_ANGLES[quarters]
+    assert(np.all((angles>=0.0) & (angles<math.pi)))
+
+    ### 3. Nodes, only acyclic objects are allocated here so the cyclic GC is paused
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    nodes = []
+    rz_params = iter(zip(quarters.tolist(), angles.tolist()))
+    for opcode, qubits in gates:
+        if opcode==RZ:
+            quarter, param = next(rz_params)
+            if quarter:
+                nodes.append(Node(CLIFFORD_GATES[quarter], qubits, []))
+            if param!=0.0:
+                nodes.append(Node(RZ, qubits, [param]))
+        else:
+            nodes.append(Node(opcode, qubits, []))
+    if gc_enabled:
+        gc.enable()
+    circuit.append_nodes(nodes)
+
     return circuit
 
+def run_job(algorithm: str, N: int, approx_factor: int, cache_dir: str, thresholds: [int] = (),
+            profile: bool = False) -> (float, dict):
+    """ Generate the circuit files of one benchmark, returning the elapsed time in seconds and its stage report """
+    start = time.perf_counter()
+    report = StageReport(algorithm, N, approx_factor)
+    main(algorithm, N, approx_factor, cache=CircuitCache(cache_dir), thresholds=thresholds, profile=profile, report=report)
+    return time.perf_counter() - start, report.to_dict()
+
+def generate_all(native_set: {str: [(int, int)]}, num_workers: int, cache_dir: str = None, thresholds: [int] = (),
+                 profile: bool = False, report_path: str = None):
+    """ Fan out every (algorithm, N, approx_factor) of native_set over a pool of num_workers processes.
+        The stage reports of the jobs are written to report_path as JSON, if given """
+    jobs = [(algorithm, N, af) for algorithm, num_qubit_range in native_set.items() for N, af in num_qubit_range]
+    timings = {}
+    stage_reports = {}
+    failed = []
+
+    def report(job, result=None, error=None):
+        algorithm, N, af = job
+        if error==None:
+            elapsed, stage_reports[job] = result
+            timings[job] = elapsed
+            print("%s (%s %d(af %d)) Finished job in %.2fs"%\
+                  (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, af, elapsed))
+        else:
+            failed.append(job)
+            print("%s (%s %d(af %d)) Failed job: %r"%\
+                  (datetime.datetime.today().strftime("[%H:%M:%S]"), algorithm, N, af, error))
+
+    ### A failing benchmark (e.g. a missing Qiskit feature) does not stop the others
+    if num_workers<=1:
+        for job in jobs:
+            try:
+                report(job, result=run_job(*job, cache_dir, thresholds, profile))
+            except (Exception, SystemExit) as error:
+                report(job, error=error)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(run_job, *job, cache_dir, thresholds, profile): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], result=future.result())
+                except (Exception, SystemExit) as error:
+                    report(futures[future], error=error)
+
+    print("Job timings (%d workers)"%num_workers)
+    for job in jobs:
+        if job in timings:
+            print("  %s(%d)_af(%d): %.2fs"%(*job, timings[job]))
+    ### Durations summed over the benchmark matrix, to see which stage dominates
+    stage_durations = {}
+    for job in jobs:
+        for record in stage_reports.get(job, {'stages': []})['stages']:
+            stage_durations[record['stage']] = stage_durations.get(record['stage'], 0.0) + record['duration']
+    print("Stage timings (summed over jobs)")
+    for stage, duration in sorted(stage_durations.items(), key=lambda item: -item[1]):
+        print("  %s: %.2fs"%(stage, duration))
+    if report_path!=None:
+        write_reports(report_path, [stage_reports[job] for job in jobs if job in stage_reports])
+    if failed:
+        raise Exception(f'Failed jobs: %s'%", ".join(["%s(%d)_af(%d)"%job for job in failed]))
+
 if __name__=="__main__":    
     native_set = {
                   "vqe": [(8, 1)],
@@ -265,6 +418,14 @@ if __name__=="__main__":
                   "mc": [(8, 1)],
                 }
 
-    for algorithm, num_qubit_range in native_set.items():
-        for N, af in num_qubit_range:
-            main(algorithm, N, af)
\ No newline at end of file
+    ### python CircuitGenerator.py [num_workers], every core by default
+    ### Stages are cached under cache/, set NO_CACHE to regenerate everything from scratch
+    ### Set THRESHOLDS (e.g. 7,9,11) to also write the _qec_t<threshold>.txt circuit of each Rz approximation threshold
+    ### Set PROFILE to write the pass timings and rule hits of the abstract optimization to _opt.json (with NO_CACHE for every benchmark)
+    ### Set STAGE_REPORT to a path to write the duration, memory (start, end and own peak) and gate count of every stage of every job as JSON
+    num_workers = int(sys.argv[1]) if len(sys.argv)>1 else os.cpu_count()
+    cache_dir = None if os.environ.get('NO_CACHE') else os.path.join(_dirname, "cache")
+    thresholds = [int(threshold) for threshold in os.environ.get('THRESHOLDS', '').split(',') if threshold]
+    profile = bool(os.environ.get('PROFILE'))
+    report_path = os.environ.get('STAGE_REPORT')
+    generate_all(native_set, num_workers, cache_dir, thresholds, profile, report_path)
\ No newline at end of file
@@ -1,24 +1,113 @@
-import math
+import math, gc
+from collections import deque
+from itertools import product
 
+import numpy as np
+
+from rustworkx import topological_sort
 from rustworkx.visualization import graphviz_draw
 
 from Circuit import Circuit
-from Node import Node
+from OptProfiler import OptProfiler
+from Node import Node, GATE_NAME, OPCODE, QUBIT, X, Y, Z, H, S, SDG, RZ, CX, GPI, GPI2, VZ, MS
+from Node import opcode_mask, CONTROL_COMMUTE, TARGET_COMMUTE
+
+class RuleAutomaton:
+    """ Aho-Corasick automaton over gate tokens, compiled once from a list of patterns.
+        A token is a gate name, optionally refined by side conditions ('cx.target').
+        Gates are fed as the symbol opcode|(flags<<FLAG_SHIFT), flags having bit i set
+        if the i-th condition of conditions[opcode] holds (0 for gates without conditions). """
+    FLAG_SHIFT = 4
+
+    def __init__(self, patterns: [[str]], conditions: {int: [str]}):
+        assert(max(OPCODE.values()) < (1<<self.FLAG_SHIFT))
+        self.conditions = conditions
+        num_symbols = 1<<(self.FLAG_SHIFT + max([len(names) for names in conditions.values()], default=0))
+
+        ### 1. Trie over every concrete symbol sequence of the patterns
+        goto = [{}]
+        matched = [[]]
+        for rule_index, pattern in enumerate(patterns):
+            for symbols in product(*[self.expand_token(token) for token in pattern]):
+                state = 0
+                for symbol in symbols:
+                    if symbol not in goto[state]:
+                        goto[state][symbol] = len(goto)
+                        goto.append({})
+                        matched.append([])
+                    state = goto[state][symbol]
+                matched[state].append(rule_index)
+
+        ### 2. Failure links in BFS order, folded into a complete transition table indexed by symbol
+        self.transitions = [None for _ in goto]
+        self.transitions[0] = [0 for _ in range(num_symbols)]
+        for symbol, next_state in goto[0].items():
+            self.transitions[0][symbol] = next_state
+        fail = [0 for _ in goto]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            self.transitions[state] = list(self.transitions[fail[state]])
+            for symbol, next_state in goto[state].items():
+                self.transitions[state][symbol] = next_state
+            matched[state] += matched[fail[state]]
+            for symbol, next_state in goto[state].items():
+                fail[next_state] = self.transitions[fail[state]][symbol]
+                queue.append(next_state)
+
+        ### Lowest rule index ending at each state (-1 if none), earlier rules take priority
+        self.output = [min(rules) if rules else -1 for rules in matched]
+
+    def expand_token(self, token: str) -> [int]:
+        name, *required = token.split('.')
+        if name not in OPCODE:
+            raise Exception(f'Invalid gate name %s'%name)
+        opcode = OPCODE[name]
+        if opcode not in self.conditions:
+            if required:
+                raise Exception(f'No side condition registered for %s'%name)
+            return [opcode]
+
+        names = self.conditions[opcode]
+        mask = 0
+        for condition in required:
+            if condition not in names:
+                raise Exception(f'Invalid side condition %s of %s'%(condition, name))
+            mask |= (1<<names.index(condition))
+        return [opcode|(flags<<self.FLAG_SHIFT) for flags in range(1<<len(names)) if flags&mask==mask]
+
+### Commutation classes of a gate on one wire: diagonal (z-like, and the control of a cx),
+### x-like (and the target of a cx), or commuting with neither
+COMMUTE_NONE, COMMUTE_Z, COMMUTE_X = range(3)
+### Most gates of one commutation run a gate is moved across
+COMMUTE_WINDOW = 256
 
 class AbsCircuitOptimizer:
-    def __init__(self, circuit: Circuit):
+    def __init__(self, circuit: Circuit, profiler: OptProfiler = None):
         self.circuit = circuit
+        ### Records passes, rule hits and rounds when given, see OptProfiler
+        self.profiler = profiler
 
         self.h_rule = []
         self.cancel_rule = []
         self.merge_rule = []
-        self.commute_rule = []
         self.initialize_h_ruleset()
         self.initialize_cancelling_ruleset()
         self.initialize_merging_ruleset()
-        #self.initialize_commuting_ruleset()
+        self.initialize_commuting_ruleset()
+
+        ### (qubit_index, node_index) positions to re-examine, only used by the incremental mode
+        self.worklist = None
+        self.queued = None
+        ### Longest pattern in the rule sets, bounds the window re-examined around a position
+        self.window = max(len(before_opt) for before_opt, _, _ in self.h_rule)
 
-    def abs_opt(self) -> Circuit:
+    def abs_opt(self, incremental: bool = False) -> Circuit:
+        if incremental:
+            return self.abs_opt_incremental()
+
+        if self.profiler!=None:
+            self.profiler.begin(self.circuit)
         optimized = True
 
         cnt = 0
@@ -27,13 +116,114 @@ class AbsCircuitOptimizer:
             optimized = False
             if cnt%3==0:
                 print("Start %dth H reduction"%cnt)
-            optimized |= self.H_reduction()
+            optimized |= self.run_pass("H_reduction", self.H_reduction)
             if cnt%3==0:
                 print("Start %dth gate cancellation"%cnt)
-            optimized |= self.gate_cancellation()
+            optimized |= self.run_pass("gate_cancellation", self.gate_cancellation)
+            optimized |= self.run_pass("commutation_cancellation", self.commutation_cancellation)
+            if self.profiler!=None:
+                self.profiler.end_round(self.circuit, optimized)
+
+        return self.circuit
+
+    def abs_opt_incremental(self) -> Circuit:
+        """ Sweep the circuit once, then re-examine only the neighbourhood of each rewrite """
+        if self.profiler!=None:
+            self.profiler.begin(self.circuit)
+        self.worklist = deque()
+        self.queued = set()
+
+        optimized = self.run_pass("H_reduction", self.H_reduction)
+        optimized |= self.run_pass("gate_cancellation", self.gate_cancellation)
+
+        cnt = 0
+        def drain_worklist() -> bool:
+            nonlocal cnt
+            optimized = False
+            while self.worklist:
+                qubit_index, node_index = self.worklist.popleft()
+                self.queued.discard((qubit_index, node_index))
+                ### The node may have been removed (and its index reused) since it was queued
+                if self.circuit.wire_slot(qubit_index, node_index)<0:
+                    continue
+                cnt += 1
+                optimized |= self.examine_window(qubit_index, node_index)
+            return optimized
+
+        while True:
+            optimized |= self.run_pass("worklist", drain_worklist)
+            ### Pairs cancelled through commuting gates queue their neighbourhoods again
+            commuted = self.run_pass("commutation_cancellation", self.commutation_cancellation)
+            if self.profiler!=None:
+                self.profiler.end_round(self.circuit, optimized or commuted)
+            optimized = False
+            if not commuted:
+                break
+
+        if self.profiler!=None:
+            self.profiler.count("re-examined positions", cnt)
+        self.worklist = None
+        self.queued = None
 
         return self.circuit
 
+    def run_pass(self, name: str, opt_pass) -> bool:
+        """ Run one pass, timed by the profiler if any """
+        if self.profiler==None:
+            return opt_pass()
+        return self.profiler.run_pass(name, self.circuit, opt_pass)
+
+    def touch(self, qubit_index: int, node_index: int):
+        """ Queue the position after a rewrite next to it, if running in incremental mode """
+        if self.worklist is None or node_index is None:
+            return
+        if (qubit_index, node_index) not in self.queued:
+            self.queued.add((qubit_index, node_index))
+            self.worklist.append((qubit_index, node_index))
+
+    def examine_window(self, qubit_index: int, node_index: int) -> bool:
+        ### Every pattern containing node_index starts at most (window-1) gates before it
+        start_index = node_index
+        for _ in range(self.window-1):
+            prev_index = self.circuit.get_prev_gate(qubit_index, start_index)
+            if prev_index==None:
+                break
+            start_index = prev_index
+
+        ### H reduction over the window
+        self.reset_h_state()
+        curr_index = start_index
+        for _ in range(2*self.window-1):
+            if curr_index==None:
+                break
+            next_index = self.circuit.get_next_gate(qubit_index, curr_index)
+            if self.update_h_rule(qubit_index, curr_index):
+                return True
+            curr_index = next_index
+        self.reset_h_state()
+
+        ### Gate cancellation over the window
+        prev_index = start_index
+        curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
+        for _ in range(2*self.window-1):
+            if curr_index==None:
+                break
+            opt_flag, prev_index, curr_index = self.cancellation_step(qubit_index, prev_index, curr_index)
+            if opt_flag:
+                return True
+
+        ### CX cancellation looks through commuting gates, so also retry a CX right behind them
+        cx_index = start_index
+        while cx_index!=None and (1<<self.circuit.dag[cx_index].opcode)&(CONTROL_COMMUTE|TARGET_COMMUTE):
+            cx_index = self.circuit.get_prev_gate(qubit_index, cx_index)
+        if cx_index!=None and cx_index!=start_index and self.circuit.dag[cx_index].opcode==CX:
+            curr_index = self.circuit.get_next_gate(qubit_index, cx_index)
+            opt_flag, _, _ = self.cancellation_step(qubit_index, cx_index, curr_index)
+            if opt_flag:
+                return True
+
+        return False
+
     def H_reduction(self) -> bool:
         result = False
         for qubit_index in range(self.circuit.num_qubits):
@@ -44,340 +234,457 @@ class AbsCircuitOptimizer:
                 result |= self.update_h_rule(qubit_index, curr_index)
 
                 curr_index = next_index
-            self.reset_h_pointer()
+            self.reset_h_state()
 
         return result
 
     def initialize_h_ruleset(self):
-        self.h_rule.append([['h', 's', 'h'], ['sdg', 'h', 'sdg'], 0])                    ### rule 0
-        self.h_rule.append([['h', 'sdg', 'h'], ['s', 'h', 's'], 0])                     ### rule 1
-        self.h_rule.append([['h', 's', 'cx', 'sdg', 'h'], ['s', 'cx', 'sdg'], 0])        ### rule 2
-        self.h_rule.append([['h', 'sdg', 'cx', 's', 'h'], ['sdg', 'cx', 's'], 0])        ### rule 3
-        self.h_rule.append([['h', 'cx', 'h', 'h', 'h'], ['cx'], 0])                    ### rule 4
-
-    def reset_h_pointer(self):
-        for rule_index in range(len(self.h_rule)):
-            self.h_rule[rule_index][-1] = 0
+        ### Pattern tokens are gate names on the current wire, optionally refined by side conditions
+        ### of self.h_condition ('cx.target': the wire is the target of the cx)
+        self.h_rule.append([['h', 's', 'h'], ['sdg', 'h', 'sdg'], self.rename_h_rule])                     ### rule 0
+        self.h_rule.append([['h', 'sdg', 'h'], ['s', 'h', 's'], self.rename_h_rule])                      ### rule 1
+        self.h_rule.append([['h', 's', 'cx.target', 'sdg', 'h'], ['s', 'cx', 'sdg'], self.strip_h_rule])  ### rule 2
+        self.h_rule.append([['h', 'sdg', 'cx.target', 's', 'h'], ['sdg', 'cx', 's'], self.strip_h_rule])  ### rule 3
+        self.h_rule.append([['h', 'cx.pair_h', 'h'], ['cx'], self.flip_cx_h_rule])                         ### rule 4
+
+        ### Gates written by the rewrites are interned once here
+        for rule in self.h_rule:
+            rule[1] = [OPCODE[name] for name in rule[1]]
+
+        self.h_condition = {CX: [('target', self.is_cx_target), ('pair_h', self.is_cx_pair_h)]}
+        self.h_automaton = RuleAutomaton([before_opt for before_opt, _, _ in self.h_rule],
+                                         {opcode: [cond for cond, _ in conds] for opcode, conds in self.h_condition.items()})
+        self.h_state = 0
+
+    def reset_h_state(self):
+        self.h_state = 0
+
+    def h_symbol(self, qubit_index: int, node_index: int):
+        curr_node = self.circuit.dag[node_index]
+        conditions = self.h_condition.get(curr_node.opcode)
+        if conditions==None:
+            return curr_node.opcode
+        flags = 0
+        for bit, (_, condition) in enumerate(conditions):
+            if condition(qubit_index, node_index):
+                flags |= (1<<bit)
+        return curr_node.opcode|(flags<<RuleAutomaton.FLAG_SHIFT)
+
+    def is_cx_target(self, qubit_index: int, node_index: int) -> bool:
+        return self.circuit.dag[node_index].qubits[1]==qubit_index
+
+    def is_cx_pair_h(self, qubit_index: int, node_index: int) -> bool:
+        """ The other qubit of the cx is sandwiched by H gates """
+        tqgate = self.circuit.dag[node_index]
+        pair_index = tqgate.qubits[(tqgate.qubits.index(qubit_index)+1)%2]
+        pair_prev_index = self.circuit.get_prev_gate(pair_index, node_index)
+        pair_next_index = self.circuit.get_next_gate(pair_index, node_index)
+        return self.circuit.dag[pair_prev_index].opcode==H and \
+          pair_next_index!=None and self.circuit.dag[pair_next_index].opcode==H
 
     def update_h_rule(self, qubit_index: int, node_index: int) -> bool:
+        symbol = self.h_symbol(qubit_index, node_index)
+        self.h_state = self.h_automaton.transitions[self.h_state][symbol]
+        rule_index = self.h_automaton.output[self.h_state]
+        if rule_index<0:
+            return False
+
+        before_opt, after_opt_rev, rewrite = self.h_rule[rule_index]
+        if self.profiler!=None:
+            self.profiler.hit("h_rule %d: %s"%(rule_index, " ".join(before_opt)))
+        rewrite(qubit_index, node_index, after_opt_rev)
+        self.reset_h_state()
+
+        return True
+
+    def rename_h_rule(self, qubit_index: int, node_index: int, after_opt_rev: [int]):
+        curr_index = node_index
+        for gate_type in after_opt_rev:
+            curr_node = self.circuit.dag[curr_index]
+            curr_node.opcode = gate_type
+            curr_index = self.circuit.get_prev_gate(qubit_index, curr_index)
+        self.touch(qubit_index, node_index)
+
+    def strip_h_rule(self, qubit_index: int, node_index: int, after_opt_rev: [int]):
+        ### Remove the current H gate
+        prev_index = self.circuit.get_prev_gate(qubit_index, node_index)
+        assert(self.circuit.dag[node_index].opcode==H)
+        self.circuit.remove_edge(qubit_index, prev_index, node_index)
+        next_index = self.circuit.get_next_gate(qubit_index, node_index)
+        if next_index!=None:
+            self.circuit.remove_edge(qubit_index, node_index, next_index)
+            self.circuit.add_edge(qubit_index, prev_index, next_index)
+        self.circuit.remove_node(node_index)
+        self.touch(qubit_index, prev_index)
+        ### Convert S, sdg to sdg, S respectively
+        curr_index = prev_index
+        for gate_type in after_opt_rev:
+            curr_node = self.circuit.dag[curr_index]
+            if gate_type==CX:
+                assert(curr_node.opcode==CX)
+            curr_node.opcode = gate_type
+            curr_index = self.circuit.get_prev_gate(qubit_index, curr_index)
+        ### Remove the H gate
+        assert(self.circuit.dag[curr_index].opcode==H)
+        next_index = self.circuit.get_next_gate(qubit_index, curr_index)
+        self.circuit.remove_edge(qubit_index, curr_index, next_index)
+        prev_index = self.circuit.get_prev_gate(qubit_index, curr_index)
+        if prev_index!=None:
+            self.circuit.remove_edge(qubit_index, prev_index, curr_index)
+            self.circuit.add_edge(qubit_index, prev_index, next_index)
+        self.circuit.remove_node(curr_index)
+
+    def flip_cx_h_rule(self, qubit_index: int, node_index: int, after_opt_rev: [int]):
+        cnot_index = self.circuit.get_prev_gate(qubit_index, node_index)
+        cnot_gate = self.circuit.dag[cnot_index]
+        assert(cnot_gate.opcode==CX)
+        pair_index = cnot_gate.qubits[(cnot_gate.qubits.index(qubit_index)+1)%2]
+
+        h2_index = node_index
+        h1_index = self.circuit.get_prev_gate(qubit_index, cnot_index)
+
+        h3_index = self.circuit.get_prev_gate(pair_index, cnot_index)
+        h4_index = self.circuit.get_next_gate(pair_index, cnot_index)
+
+        assert(self.circuit.dag[h1_index].opcode==H and self.circuit.dag[h2_index].opcode==H 
+          and self.circuit.dag[h3_index].opcode==H and self.circuit.dag[h4_index].opcode==H)
+
+        self.circuit.remove_edge(qubit_index, h1_index, cnot_index)
+        h1_prev_index = self.circuit.get_prev_gate(qubit_index, h1_index)
+        self.circuit.add_edge(qubit_index, h1_prev_index, cnot_index)
+
+        self.circuit.remove_edge(qubit_index, cnot_index, h2_index)
+        h2_next_index = self.circuit.get_next_gate(qubit_index, h2_index)
+        if h2_next_index!=None:
+            self.circuit.remove_edge(qubit_index, h2_index, h2_next_index)
+            self.circuit.add_edge(qubit_index, cnot_index, h2_next_index)
+
+        self.circuit.remove_edge(pair_index, h3_index, cnot_index)
+        h3_prev_index = self.circuit.get_prev_gate(pair_index, h3_index)
+        self.circuit.add_edge(pair_index, h3_prev_index, cnot_index)
+
+        self.circuit.remove_edge(pair_index, cnot_index, h4_index)
+        h4_next_index = self.circuit.get_next_gate(pair_index, h4_index)
+        if h4_next_index!=None:
+            self.circuit.remove_edge(pair_index, h4_index, h4_next_index)
+            self.circuit.add_edge(pair_index, cnot_index, h4_next_index)
+
+        self.circuit.remove_node(h1_index)
+        self.circuit.remove_node(h2_index)
+        self.circuit.remove_node(h3_index)
+        self.circuit.remove_node(h4_index)
+        self.touch(qubit_index, cnot_index)
+        self.touch(pair_index, cnot_index)
+
+        ### qubits may be shared with clones of the circuit, so it is replaced rather than swapped in place
+        cnot_gate.qubits = [cnot_gate.qubits[1], cnot_gate.qubits[0]]
+
+    def gate_cancellation(self) -> bool:
         opt_flag = False
-        curr_node = self.circuit.dag[node_index]
-        for rule_index in range(len(self.h_rule)):
-            before_opt = self.h_rule[rule_index][0]
-            after_opt_rev = self.h_rule[rule_index][1]
-            pointer = self.h_rule[rule_index][2]
-
-            if curr_node.name==before_opt[pointer]:
-                ### Additional Check for rule 2, 3
-                if (rule_index==2 or rule_index==3) and pointer==2:
-                    assert(curr_node.name=='cx')
-                    if curr_node.qubits.index(qubit_index)==0:
-                        pointer = 0
-                    else:
-                        pointer += 1
-                else:
-                    pointer += 1
+        for qubit_index in range(self.circuit.num_qubits):
+            prev_index = qubit_index
+            curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
+            if not curr_index:
+                continue
+
+            while curr_index!=None:
+                step_flag, prev_index, curr_index = self.cancellation_step(qubit_index, prev_index, curr_index)
+                opt_flag |= step_flag
+
+        return opt_flag
+
+    def cancellation_step(self, qubit_index: int, prev_index: int, curr_index: int) -> (bool, int, int):
+        """ Try every cancellation/merge rule on (prev_index, curr_index) of the qubit wire,
+            and return whether the circuit changed with the next pair of the wire to look at """
+        prev_node = self.circuit.dag[prev_index]
+        curr_node = self.circuit.dag[curr_index]
+        ### Single-qubit gate Cancellation
+        if self.cancel_mask[prev_node.opcode]&(1<<curr_node.opcode):
+            if self.profiler!=None:
+                self.profiler.hit("cancel %s %s"%(prev_node.name, curr_node.name))
+            self.circuit.remove_edge(qubit_index, prev_index, curr_index)
+
+            assert(len(self.circuit.dag.predecessor_indices(prev_index))==1)
+            pprev_index = self.circuit.get_prev_gate(qubit_index, prev_index)
+            self.circuit.remove_edge(qubit_index, pprev_index, prev_index)
+            self.circuit.remove_node(prev_index)
+            self.touch(qubit_index, pprev_index)
+            next_index = self.circuit.get_next_gate(qubit_index, curr_index)
+            if next_index:
+                self.circuit.remove_edge(qubit_index, curr_index, next_index)
+                self.circuit.add_edge(qubit_index, pprev_index, next_index)
+                self.circuit.remove_node(curr_index)
+                return True, next_index, self.circuit.get_next_gate(qubit_index, next_index)
             else:
-                pointer = 0
-
-            ### Additional Check for rule 4
-            if rule_index==4 and pointer==3:
-                tqgate_index = self.circuit.get_prev_gate(qubit_index, node_index)
-                tqgate = self.circuit.dag[tqgate_index]
-                assert(tqgate.name=='cx')
-                pair_index = tqgate.qubits[(tqgate.qubits.index(qubit_index)+1)%2]
-                pair_prev_index = self.circuit.get_prev_gate(pair_index, tqgate_index)
-                pair_prev_node = self.circuit.dag[pair_prev_index]
-                pair_next_index = self.circuit.get_next_gate(pair_index, tqgate_index)
-                if pair_prev_node.name=='h' and pair_next_index!=None and self.circuit.dag[pair_next_index].name=='h':
-                    pointer += 2
+                self.circuit.remove_node(curr_index)
+                return True, pprev_index, None
+        ### Two-qubit gate Cancellation - qubit_index : control
+        elif prev_node.opcode==CX:
+            control_index = prev_node.qubits[0]
+            target_index = prev_node.qubits[1]
+            ### Z rotation can be commutated in control qubit
+            control_next_index = self.circuit.get_next_gate(control_index, prev_index)
+            control_adjacent = True
+            while control_next_index!=None:
+                control_next_node = self.circuit.dag[control_next_index]
+                if (1<<control_next_node.opcode)&CONTROL_COMMUTE:
+                    control_adjacent = False
+                    control_next_index = self.circuit.get_next_gate(control_index, control_next_index)
                 else:
-                    pointer = 0
-
-            if pointer==len(before_opt) and (rule_index==0 or rule_index==1):
-                opt_flag = True
-                curr_index = node_index
-                for gate_type in after_opt_rev:
-                    curr_node = self.circuit.dag[curr_index]
-                    curr_node.name = gate_type
-                    curr_index = self.circuit.get_prev_gate(qubit_index, curr_index)
-            elif pointer==len(before_opt) and (rule_index==2 or rule_index==3):
-                opt_flag = True
-                ### Remove the current H gate
-                prev_index = self.circuit.get_prev_gate(qubit_index, node_index)
-                assert(self.circuit.dag[node_index].name=='h')
-                self.circuit.dag.remove_edge(prev_index, node_index)
-                next_index = self.circuit.get_next_gate(qubit_index, node_index)
-                if next_index!=None:
-                    self.circuit.dag.remove_edge(node_index, next_index)
-                    self.circuit.dag.add_edge(prev_index, next_index, None)
-                self.circuit.dag.remove_node(node_index)
-                ### Convert S, sdg to sdg, S respectively
-                curr_index = prev_index
-                for gate_type in after_opt_rev:
-                    curr_node = self.circuit.dag[curr_index]
-                    if gate_type=='cx':
-                        assert(curr_node.name=='cx')
-                    curr_node.name = gate_type
-                    curr_index = self.circuit.get_prev_gate(qubit_index, curr_index)
-                ### Remove the H gate
-                assert(self.circuit.dag[curr_index].name=='h')
-                next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-                self.circuit.dag.remove_edge(curr_index, next_index)
-                prev_index = self.circuit.get_prev_gate(qubit_index, curr_index)
-                if prev_index!=None:
-                    self.circuit.dag.remove_edge(prev_index, curr_index)
-                    self.circuit.dag.add_edge(prev_index, next_index, None)
-                self.circuit.dag.remove_node(curr_index)
-            elif pointer==len(before_opt) and rule_index==4:
-                assert(pointer==5)
-                opt_flag = True
-                cnot_index = self.circuit.get_prev_gate(qubit_index, node_index)
-                cnot_gate = self.circuit.dag[cnot_index]
-                assert(cnot_gate.name=='cx')
-                pair_index = cnot_gate.qubits[(cnot_gate.qubits.index(qubit_index)+1)%2]
-
-                h2_index = node_index
-                h1_index = self.circuit.get_prev_gate(qubit_index, cnot_index)
-
-                h3_index = self.circuit.get_prev_gate(pair_index, cnot_index)
-                h4_index = self.circuit.get_next_gate(pair_index, cnot_index)
-
-                assert(self.circuit.dag[h1_index].name=='h' and self.circuit.dag[h2_index].name=='h' 
-                  and self.circuit.dag[h3_index].name=='h' and self.circuit.dag[h4_index].name=='h')
-
-                self.circuit.dag.remove_edge(h1_index, cnot_index)
-                h1_prev_index = self.circuit.get_prev_gate(qubit_index, h1_index)
-                self.circuit.dag.add_edge(h1_prev_index, cnot_index, None)
-                
-                self.circuit.dag.remove_edge(cnot_index, h2_index)
-                h2_next_index = self.circuit.get_next_gate(qubit_index, h2_index)
-                if h2_next_index!=None:
-                    self.circuit.dag.remove_edge(h2_index, h2_next_index)
-                    self.circuit.dag.add_edge(cnot_index, h2_next_index, None)
-
-                self.circuit.dag.remove_edge(h3_index, cnot_index)
-                h3_prev_index = self.circuit.get_prev_gate(pair_index, h3_index)
-                self.circuit.dag.add_edge(h3_prev_index, cnot_index, None)
-
-                self.circuit.dag.remove_edge(cnot_index, h4_index)
-                if self.circuit.dag.successor_indices(h4_index):
-                    h4_next_index = self.circuit.dag.successor_indices(h4_index)[0]
-                    self.circuit.dag.remove_edge(h4_index, h4_next_index)
-                    self.circuit.dag.add_edge(cnot_index, h4_next_index, None)
-
-                self.circuit.dag.remove_node(h1_index)
-                self.circuit.dag.remove_node(h2_index)
-                self.circuit.dag.remove_node(h3_index)
-                self.circuit.dag.remove_node(h4_index)
-
-                self.circuit.dag[cnot_index].qubits[0], self.circuit.dag[cnot_index].qubits[1] = \
-                  self.circuit.dag[cnot_index].qubits[1], self.circuit.dag[cnot_index].qubits[0]
+                    break
+            ### X rotation can be commutated in target qubit
+            target_next_index = self.circuit.get_next_gate(target_index, prev_index)
+            target_adjacent = True
+            while target_next_index!=None:
+                target_next_node = self.circuit.dag[target_next_index]
+                if (1<<target_next_node.opcode)&TARGET_COMMUTE:
+                    target_adjacent = False
+                    target_next_index = self.circuit.get_next_gate(target_index, target_next_index)
+                else:
+                    break
 
-            if opt_flag:
-                self.reset_h_pointer()
-                break
+            tqgate_opt_flag = False
+            if control_next_index==target_next_index and control_next_index!=None:
+                cancel_index = control_next_index
+                cancel_node = self.circuit.dag[cancel_index]
+                assert(cancel_node.opcode==CX)
+                if prev_node.qubits[0]==cancel_node.qubits[0] and \
+                  prev_node.qubits[1]==cancel_node.qubits[1]:
+                    tqgate_opt_flag = True
+
+            if not tqgate_opt_flag:
+                return False, curr_index, self.circuit.get_next_gate(qubit_index, curr_index)    # Do not consider merge for CX gates
+            if self.profiler!=None:
+                self.profiler.hit("cancel cx cx" if control_adjacent and target_adjacent else "cancel cx cx (commuted)")
+
+            control_pprev_index = self.circuit.get_prev_gate(control_index, prev_index)
+            control_nprev_index = self.circuit.get_next_gate(control_index, prev_index)
+            control_pcurr_index = self.circuit.get_prev_gate(control_index, cancel_index)
+            control_ncurr_index = self.circuit.get_next_gate(control_index, cancel_index)
+
+            target_pprev_index = self.circuit.get_prev_gate(target_index, prev_index)
+            target_nprev_index = self.circuit.get_next_gate(target_index, prev_index)
+            target_pcurr_index = self.circuit.get_prev_gate(target_index, cancel_index)
+            target_ncurr_index = self.circuit.get_next_gate(target_index, cancel_index)
+
+            if control_adjacent:
+                assert(control_nprev_index==cancel_index and control_pcurr_index==prev_index)
+                self.circuit.remove_edge(control_index, control_pprev_index, prev_index)
+                self.circuit.remove_edge(control_index, prev_index, cancel_index)
+                if control_ncurr_index:
+                    self.circuit.remove_edge(control_index, cancel_index, control_ncurr_index)
+                    self.circuit.add_edge(control_index, control_pprev_index, control_ncurr_index)
             else:
-                self.h_rule[rule_index][2] = pointer
-
-        return opt_flag
+                assert(control_nprev_index!=cancel_index and control_pcurr_index!=prev_index)
+                self.circuit.remove_edge(control_index, control_pprev_index, prev_index)
+                self.circuit.remove_edge(control_index, prev_index, control_nprev_index)
+                self.circuit.remove_edge(control_index, control_pcurr_index, cancel_index)
+                self.circuit.add_edge(control_index, control_pprev_index, control_nprev_index)
+                if control_ncurr_index:
+                    self.circuit.remove_edge(control_index, cancel_index, control_ncurr_index)
+                    self.circuit.add_edge(control_index, control_pcurr_index, control_ncurr_index)
+
+            if target_adjacent:
+                assert(target_nprev_index==cancel_index and target_pcurr_index==prev_index)
+                self.circuit.remove_edge(target_index, target_pprev_index, prev_index)
+                self.circuit.remove_edge(target_index, prev_index, cancel_index)
+                if target_ncurr_index:
+                    self.circuit.remove_edge(target_index, cancel_index, target_ncurr_index)
+                    self.circuit.add_edge(target_index, target_pprev_index, target_ncurr_index)
+            else:
+                assert(target_nprev_index!=cancel_index and target_pcurr_index!=prev_index)
+                self.circuit.remove_edge(target_index, target_pprev_index, prev_index)
+                self.circuit.remove_edge(target_index, prev_index, target_nprev_index)
+                self.circuit.remove_edge(target_index, target_pcurr_index, cancel_index)
+                self.circuit.add_edge(target_index, target_pprev_index, target_nprev_index)
+                if target_ncurr_index:
+                    self.circuit.remove_edge(target_index, cancel_index, target_ncurr_index)
+                    self.circuit.add_edge(target_index, target_pcurr_index, target_ncurr_index)
+
+            self.circuit.remove_node(prev_index)
+            self.circuit.remove_node(cancel_index)
+            self.touch(control_index, control_pprev_index)
+            self.touch(target_index, target_pprev_index)
+            if not control_adjacent:
+                self.touch(control_index, control_pcurr_index)
+            if not target_adjacent:
+                self.touch(target_index, target_pcurr_index)
+
+            if qubit_index==control_index and control_adjacent:
+                prev_index = control_ncurr_index
+            elif qubit_index==control_index and not control_adjacent:
+                prev_index = control_nprev_index
+                assert(prev_index!=None)
+            elif qubit_index==target_index and target_adjacent:
+                prev_index = target_ncurr_index
+            else:
+                assert(qubit_index==target_index and not target_adjacent)
+                prev_index = target_nprev_index
+                assert(prev_index!=None)
 
-    def gate_cancellation(self) -> bool:
-        for qubit_index in range(self.circuit.num_qubits):
-            opt_flag = False
+            if prev_index!=None:
+                curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
+            else:
+                curr_index = None
+            return True, prev_index, curr_index
 
-            prev_index = qubit_index
+        ### Merge Rule
+        merge_opt_flag = False
+        if not self.merge_mask[prev_node.opcode]&(1<<curr_node.opcode):
+            prev_index = curr_index
             curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-            if not curr_index:
+            return False, prev_index, curr_index
+        for pattern, merged in self.merge_rule:
+            if prev_node.opcode!=pattern[0] or curr_node.opcode!=pattern[1]:
                 continue
 
-            while curr_index!=None:
-                prev_node = self.circuit.dag[prev_index]
-                curr_node = self.circuit.dag[curr_index]
-                ### Single-qubit gate Cancellation
-                if (prev_node.name, curr_node.name) in self.cancel_rule:
-                    opt_flag = True
-                    self.circuit.dag.remove_edge(prev_index, curr_index)
-
-                    assert(len(self.circuit.dag.predecessor_indices(prev_index))==1)
-                    pprev_index = self.circuit.get_prev_gate(qubit_index, prev_index)
-                    self.circuit.dag.remove_edge(pprev_index, prev_index)
-                    self.circuit.dag.remove_node(prev_index)
+            merge_opt_flag = True
+            if self.profiler!=None:
+                self.profiler.hit("merge %s %s"%(GATE_NAME[pattern[0]], GATE_NAME[pattern[1]]))
+            self.touch(qubit_index, prev_index)
+            if merged!=RZ or (prev_node.parameter[0]+curr_node.parameter[0])<math.pi/2:
+                prev_node.opcode = merged
+                if merged==RZ:
+                    prev_node.parameter[0] = prev_node.parameter[0] + curr_node.parameter[0]
+                self.circuit.remove_edge(qubit_index, prev_index, curr_index)
+                next_index = self.circuit.get_next_gate(qubit_index, curr_index)
+                if next_index:
+                    self.circuit.remove_edge(qubit_index, curr_index, next_index)
+                    self.circuit.add_edge(qubit_index, prev_index, next_index)
+                self.circuit.remove_node(curr_index)
+                curr_index = next_index
+            else:
+                assert(prev_node.parameter[0]+curr_node.parameter[0] >= math.pi/2)
+                assert(prev_node.parameter[0]+curr_node.parameter[0] < math.pi)
+                new_param = prev_node.parameter[0] + curr_node.parameter[0] - math.pi/2
+                prev_node.opcode = S
+                prev_node.parameter = []
+
+                if new_param>0:
+                    curr_node.opcode = RZ
+                    curr_node.parameter = [new_param]
+                    
+                    prev_index = curr_index
+                    curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
+                else:
+                    self.circuit.remove_edge(qubit_index, prev_index, curr_index)
                     next_index = self.circuit.get_next_gate(qubit_index, curr_index)
                     if next_index:
-                        self.circuit.dag.remove_edge(curr_index, next_index)
-                        self.circuit.dag.add_edge(pprev_index, next_index, None)
-                        self.circuit.dag.remove_node(curr_index)
-                        prev_index = next_index
-                        curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-                        continue
-                    else:
-                        self.circuit.dag.remove_node(curr_index)
-                        break
-                ### Two-qubit gate Cancellation - qubit_index : control
-                elif prev_node.name=='cx':
-                    control_index = prev_node.qubits[0]
-                    target_index = prev_node.qubits[1]
-                    ### Z rotation can be commutated in control qubit
-                    control_next_index = self.circuit.get_next_gate(control_index, prev_index)
-                    control_adjacent = True
-                    while control_next_index!=None:
-                        control_next_node = self.circuit.dag[control_next_index]
-                        if control_next_node.name in ['s', 'sdg', 'z', 'rz']:
-                            control_adjacent = False
-                            control_next_index = self.circuit.get_next_gate(control_index, control_next_index)
-                        else:
-                            break
-                    ### X rotation can be commutated in target qubit
-                    target_next_index = self.circuit.get_next_gate(target_index, prev_index)
-                    target_adjacent = True
-                    while target_next_index!=None:
-                        target_next_node = self.circuit.dag[target_next_index]
-                        if target_next_node.name=='x':
-                            target_adjacent = False
-                            target_next_index = self.circuit.get_next_gate(target_index, target_next_index)
-                        else:
-                            break
+                        self.circuit.remove_edge(qubit_index, curr_index, next_index)
+                        self.circuit.add_edge(qubit_index, prev_index, next_index)
+                    self.circuit.remove_node(curr_index)
+                    curr_index = next_index
+            break
+
+        if not merge_opt_flag:
+            prev_index = curr_index
+            curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
 
-                    tqgate_opt_flag = False
-                    if control_next_index==target_next_index and control_next_index!=None:
-                        cancel_index = control_next_index
-                        cancel_node = self.circuit.dag[cancel_index]
-                        assert(cancel_node.name=='cx')
-                        if prev_node.qubits[0]==cancel_node.qubits[0] and \
-                          prev_node.qubits[1]==cancel_node.qubits[1]:
-                            tqgate_opt_flag = True
-
-                    if not tqgate_opt_flag:
-                        prev_index = curr_index
-                        curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-                        continue    # Do not consider merge for CX gates
-
-                    control_pprev_index = self.circuit.get_prev_gate(control_index, prev_index)
-                    control_nprev_index = self.circuit.get_next_gate(control_index, prev_index)
-                    control_pcurr_index = self.circuit.get_prev_gate(control_index, cancel_index)
-                    control_ncurr_index = self.circuit.get_next_gate(control_index, cancel_index)
-
-                    target_pprev_index = self.circuit.get_prev_gate(target_index, prev_index)
-                    target_nprev_index = self.circuit.get_next_gate(target_index, prev_index)
-                    target_pcurr_index = self.circuit.get_prev_gate(target_index, cancel_index)
-                    target_ncurr_index = self.circuit.get_next_gate(target_index, cancel_index)
-
-                    if control_adjacent:
-                        assert(control_nprev_index==cancel_index and control_pcurr_index==prev_index)
-                        self.circuit.dag.remove_edge(control_pprev_index, prev_index)
-                        self.circuit.dag.remove_edge(prev_index, cancel_index)
-                        if control_ncurr_index:
-                            self.circuit.dag.remove_edge(cancel_index, control_ncurr_index)
-                            self.circuit.dag.add_edge(control_pprev_index, control_ncurr_index, None)
-                    else:
-                        assert(control_nprev_index!=cancel_index and control_pcurr_index!=prev_index)
-                        self.circuit.dag.remove_edge(control_pprev_index, prev_index)
-                        self.circuit.dag.remove_edge(prev_index, control_nprev_index)
-                        self.circuit.dag.remove_edge(control_pcurr_index, cancel_index)
-                        self.circuit.dag.add_edge(control_pprev_index, control_nprev_index, None)
-                        if control_ncurr_index:
-                            self.circuit.dag.remove_edge(cancel_index, control_ncurr_index)
-                            self.circuit.dag.add_edge(control_pcurr_index, control_ncurr_index, None)
-
-                    if target_adjacent:
-                        assert(target_nprev_index==cancel_index and target_pcurr_index==prev_index)
-                        self.circuit.dag.remove_edge(target_pprev_index, prev_index)
-                        self.circuit.dag.remove_edge(prev_index, cancel_index)
-                        if target_ncurr_index:
-                            self.circuit.dag.remove_edge(cancel_index, target_ncurr_index)
-                            self.circuit.dag.add_edge(target_pprev_index, target_ncurr_index, None)
-                    else:
-                        assert(target_nprev_index!=cancel_index and target_pcurr_index!=prev_index)
-                        self.circuit.dag.remove_edge(target_pprev_index, prev_index)
-                        self.circuit.dag.remove_edge(prev_index, target_nprev_index)
-                        self.circuit.dag.remove_edge(target_pcurr_index, cancel_index)
-                        self.circuit.dag.add_edge(target_pprev_index, target_nprev_index, None)
-                        if target_ncurr_index:
-                            self.circuit.dag.remove_edge(cancel_index, target_ncurr_index)
-                            self.circuit.dag.add_edge(target_pcurr_index, target_ncurr_index, None)
-
-                    self.circuit.dag.remove_node(prev_index)
-                    self.circuit.dag.remove_node(cancel_index)
-
-                    if qubit_index==control_index and control_adjacent:
-                        prev_index = control_ncurr_index
-                    elif qubit_index==control_index and not control_adjacent:
-                        prev_index = control_nprev_index
-                        assert(prev_index!=None)
-                    elif qubit_index==target_index and target_adjacent:
-                        prev_index = target_ncurr_index
-                    else:
-                        assert(qubit_index==target_index and not target_adjacent)
-                        prev_index = target_nprev_index
-                        assert(prev_index!=None)
+        return merge_opt_flag, prev_index, curr_index
+
+    def commute_class(self, qubit_index: int, node) -> int:
+        """ Commutation class of a gate on the wire of qubit_index, gates of the same class commute on that wire """
+        if node.opcode==CX:
+            return COMMUTE_Z if node.qubits[0]==qubit_index else COMMUTE_X
+        return self.commute_mask[node.opcode]
+
+    def commutation_cancellation(self) -> bool:
+        """ Cancel pairs of gates separated by gates they commute with.
+            Gates are visited in topological order, keeping on each wire the current run of gates of one commutation class,
+            indexed by cancellation key (the opcode, or the qubits of a cx), so that the nearest partner of a gate
+            is found without rescanning the wire. A cx cancels with the nearest identical cx in the runs of both its wires.
+            Runs hold at most COMMUTE_WINDOW gates """
+        circuit = self.circuit
+        dag = circuit.dag
+        run_class = [COMMUTE_NONE for _ in range(circuit.num_qubits)]
+        run_index = [{} for _ in range(circuit.num_qubits)]
+        run_size = [0 for _ in range(circuit.num_qubits)]
+        opt_flag = False
 
-                    if prev_index!=None:
-                        curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-                    else:
-                        curr_index = None
-                    continue
+        def add_to_run(qubit_index: int, commute_class: int, key, node_index: int):
+            if commute_class!=run_class[qubit_index] or run_size[qubit_index]>=COMMUTE_WINDOW:
+                run_class[qubit_index] = commute_class
+                run_index[qubit_index] = {}
+                run_size[qubit_index] = 0
+            if commute_class!=COMMUTE_NONE:
+                run_index[qubit_index].setdefault(key, []).append(node_index)
+                run_size[qubit_index] += 1
+
+        for node_index in topological_sort(dag):
+            if not dag.has_node(node_index):
+                continue
+            node = dag[node_index]
+            if node.opcode==QUBIT:
+                continue
 
-                ### Merge Rule
-                merge_opt_flag = False
-                for pattern, merged in self.merge_rule:
-                    if prev_node.name!=pattern[0] or curr_node.name!=pattern[1]:
-                        continue
-
-                    merge_opt_flag = True
-                    if merged!='rz' or (prev_node.parameter[0]+curr_node.parameter[0])<math.pi/2:
-                        prev_node.name = merged
-                        if merged=='rz':
-                            prev_node.parameter[0] = prev_node.parameter[0] + curr_node.parameter[0]
-                        self.circuit.dag.remove_edge(prev_index, curr_index)
-                        next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-                        if next_index:
-                            self.circuit.dag.remove_edge(curr_index, next_index)
-                            self.circuit.dag.add_edge(prev_index, next_index, None)
-                        self.circuit.dag.remove_node(curr_index)
-                        curr_index = next_index
-                    else:
-                        assert(prev_node.parameter[0]+curr_node.parameter[0] >= math.pi/2)
-                        assert(prev_node.parameter[0]+curr_node.parameter[0] < math.pi)
-                        new_param = prev_node.parameter[0] + curr_node.parameter[0] - math.pi/2
-                        prev_node.name = 's'
-                        prev_node.parameter = []
-
-                        if new_param>0:
-                            curr_node.name = 'rz'
-                            curr_node.parameter = [new_param]
-                            
-                            prev_index = curr_index
-                            curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-                        else:
-                            self.circuit.dag.remove_edge(prev_index, curr_index)
-                            next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-                            if next_index:
-                                self.circuit.dag.remove_edge(curr_index, next_index)
-                                self.circuit.dag.add_edge(prev_index, next_index, None)
-                            self.circuit.dag.remove_node(curr_index)
-                            curr_index = next_index
-                    break
+            if node.opcode==CX:
+                control_index, target_index = node.qubits[0], node.qubits[1]
+                key = (control_index, target_index)
+                partner_index = None
+                if run_class[control_index]==COMMUTE_Z and run_class[target_index]==COMMUTE_X:
+                    control_partners = run_index[control_index].get(key)
+                    target_partners = run_index[target_index].get(key)
+                    ### The last cx on the same qubits is the same gate on both wires, if both runs reach it
+                    if control_partners and target_partners and control_partners[-1]==target_partners[-1]:
+                        partner_index = control_partners.pop()
+                        target_partners.pop()
+                if partner_index==None:
+                    add_to_run(control_index, COMMUTE_Z, key, node_index)
+                    add_to_run(target_index, COMMUTE_X, key, node_index)
+                    continue
+            else:
+                qubit_index = node.qubits[0]
+                commute_class = self.commute_mask[node.opcode]
+                partner_index = None
+                if commute_class!=COMMUTE_NONE and commute_class==run_class[qubit_index]:
+                    for partner_opcode in self.cancel_partners[node.opcode]:
+                        partners = run_index[qubit_index].get(partner_opcode)
+                        if partners:
+                            partner_index = partners.pop()
+                            break
+                if partner_index==None:
+                    add_to_run(qubit_index, commute_class, node.opcode, node_index)
+                    continue
 
-                opt_flag |= merge_opt_flag
-                if not merge_opt_flag:
-                    prev_index = curr_index
-                    curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
+            opt_flag = True
+            if self.profiler!=None:
+                self.profiler.hit("commute %s %s"%(dag[partner_index].name, node.name))
+            for qubit_index, prev_index in circuit.remove_gate(partner_index):
+                self.touch(qubit_index, prev_index)
+            for qubit_index, prev_index in circuit.remove_gate(node_index):
+                self.touch(qubit_index, prev_index)
 
         return opt_flag
 
+    def initialize_commuting_ruleset(self):
+        ### Single-qubit gates commuting with the control / target of a cx, and with each other
+        self.commute_mask = [COMMUTE_NONE for _ in range(len(OPCODE))]
+        for opcode in range(len(OPCODE)):
+            if (1<<opcode)&CONTROL_COMMUTE:
+                self.commute_mask[opcode] = COMMUTE_Z
+            elif (1<<opcode)&TARGET_COMMUTE:
+                self.commute_mask[opcode] = COMMUTE_X
+        ### cancel_partners[opcode]: opcodes of earlier gates it cancels with
+        self.cancel_partners = [[prev for prev, curr in self.cancel_rule if curr==opcode] for opcode in range(len(OPCODE))]
+
     def initialize_merging_ruleset(self):
-        self.merge_rule.append((('rz', 'rz'), 'rz'))
-        self.merge_rule.append((('s', 's'), 'z'))
-        self.merge_rule.append((('sdg', 'sdg'), 'z'))
+        self.merge_rule.append(((RZ, RZ), RZ))
+        self.merge_rule.append(((S, S), Z))
+        self.merge_rule.append(((SDG, SDG), Z))
+        ### merge_mask[prev opcode]: opcodes that merge into it
+        self.merge_mask = [opcode_mask(*[curr for (prev, curr), _ in self.merge_rule if prev==opcode])
+                           for opcode in range(len(OPCODE))]
 
     def initialize_cancelling_ruleset(self):
-        self.cancel_rule.append(('x', 'x'))
-        self.cancel_rule.append(('y', 'y'))
-        self.cancel_rule.append(('z', 'z'))
-        self.cancel_rule.append(('h', 'h'))
-        self.cancel_rule.append(('s', 'sdg'))
-        self.cancel_rule.append(('sdg', 's'))
+        self.cancel_rule.append((X, X))
+        self.cancel_rule.append((Y, Y))
+        self.cancel_rule.append((Z, Z))
+        self.cancel_rule.append((H, H))
+        self.cancel_rule.append((S, SDG))
+        self.cancel_rule.append((SDG, S))
+        ### cancel_mask[prev opcode]: opcodes that cancel it
+        self.cancel_mask = [opcode_mask(*[curr for prev, curr in self.cancel_rule if prev==opcode])
+                            for opcode in range(len(OPCODE))]
 
 
 class NativeConverter:
@@ -386,16 +693,16 @@ class NativeConverter:
         self.initialize_conversion_rule()
 
     def initialize_conversion_rule(self):
-        self.conversion_rule['x'] = [('gpi', 0)]
-        self.conversion_rule['y'] = [('gpi', math.pi/2)]
-        self.conversion_rule['z'] = [('vz', math.pi)]
-        self.conversion_rule['s'] = [('vz', math.pi/2)]
-        self.conversion_rule['sdg'] = [('vz', 3*math.pi/2)]
-        self.conversion_rule['h'] = [('gpi2', 3*math.pi/2), ('vz', math.pi)]
+        self.conversion_rule[X] = [(GPI, 0)]
+        self.conversion_rule[Y] = [(GPI, math.pi/2)]
+        self.conversion_rule[Z] = [(VZ, math.pi)]
+        self.conversion_rule[S] = [(VZ, math.pi/2)]
+        self.conversion_rule[SDG] = [(VZ, 3*math.pi/2)]
+        self.conversion_rule[H] = [(GPI2, 3*math.pi/2), (VZ, math.pi)]
 
     def convert_to_native(self, circuit: Circuit) -> Circuit:
         """ Make a new circuit consisting of native gates, from the given (abstract) circuit """
-        native_circuit = Circuit(circuit.num_qubits)
+        native_circuit = Circuit(circuit.num_qubits, compact=circuit.compact)
 
         pending_gate = []
         for qubit_index in range(circuit.num_qubits):
@@ -412,17 +719,17 @@ class NativeConverter:
                 qubit_index, curr_node_index = stack.pop()
                 assert(pending_gate[qubit_index]==curr_node_index)
                 curr_node = circuit.dag[curr_node_index]
-                if curr_node.name=='cx':
+                if curr_node.opcode==CX:
                     if stack and stack[-1][1]==curr_node_index:
                         pair_qubit_index, pair_node_index = stack.pop()
                         assert(pair_qubit_index==curr_node.qubits[(curr_node.qubits.index(qubit_index)+1)%2])
                         control_qubit_index = curr_node.qubits[0]
                         target_qubit_index = curr_node.qubits[1]
-                        native_circuit.append_gate('gpi2', [control_qubit_index], [math.pi/2])
-                        native_circuit.append_gate('ms', [control_qubit_index, target_qubit_index], [0, 0, math.pi/2], duration=5)
-                        native_circuit.append_gate('gpi2', [control_qubit_index], [math.pi])
-                        native_circuit.append_gate('gpi2', [target_qubit_index], [math.pi])
-                        native_circuit.append_gate('gpi2', [control_qubit_index], [3*math.pi/2])
+                        native_circuit.append_gate(GPI2, [control_qubit_index], [math.pi/2])
+                        native_circuit.append_gate(MS, [control_qubit_index, target_qubit_index], [0, 0, math.pi/2], duration=5)
+                        native_circuit.append_gate(GPI2, [control_qubit_index], [math.pi])
+                        native_circuit.append_gate(GPI2, [target_qubit_index], [math.pi])
+                        native_circuit.append_gate(GPI2, [control_qubit_index], [3*math.pi/2])
 
                         next_node_index = circuit.get_next_gate(qubit_index, curr_node_index)
                         pending_gate[qubit_index] = next_node_index
@@ -436,14 +743,14 @@ class NativeConverter:
                         stack.append((qubit_index, curr_node_index))
                         stack.append((pair_qubit_index, pending_gate[pair_qubit_index]))
                     continue
-                elif curr_node.name=='rz':
+                elif curr_node.opcode==RZ:
                     param = curr_node.parameter[0]
                     assert(param>0 and param<math.pi/2)
-                    native_circuit.append_gate('rz', [qubit_index], [param])
+                    native_circuit.append_gate(RZ, [qubit_index], [param])
                 else:
-                    assert(curr_node.name in self.conversion_rule.keys())
-                    for native_gate_name, param in self.conversion_rule[curr_node.name]:
-                        native_circuit.append_gate(native_gate_name, [qubit_index], [param])
+                    assert(curr_node.opcode in self.conversion_rule.keys())
+                    for native_opcode, param in self.conversion_rule[curr_node.opcode]:
+                        native_circuit.append_gate(native_opcode, [qubit_index], [param])
 
                 next_index = circuit.get_next_gate(qubit_index, curr_node_index)
                 pending_gate[qubit_index] = next_index
@@ -452,335 +759,246 @@ class NativeConverter:
 
         return native_circuit
 
-class NativeCircuitOptimizer:
-    def __init__(self, circuit: Circuit):
-        self.circuit = circuit
-
-    def native_opt(self, qec: bool):
-        opt_flag = True
-        opt_cnt = 0
-        while opt_flag:
-            opt_flag = False
-            opt_flag |= self.vz_elimination(qec)
-            opt_flag |= self.gpi_cancellation(qec)
-            opt_cnt += 1
+### Phases of the Clifford gates, as the floats the QEC circuits are made of, and their number of quarter turns
+QUARTER_PHASES = [(math.pi/2)*n for n in range(0, 4)]
+QUARTER_TURNS = {phase: n for n, phase in enumerate(QUARTER_PHASES)}
 
-            assert((opt_flag and opt_cnt==1) or (not opt_flag and opt_cnt==2))
+def wrap_phase(phase: float) -> float:
+    """ phase modulo 2*pi, in [0, 2*pi) """
+    phase %= (2*math.pi)
+    ### A tiny negative phase rounds up to 2*pi
+    return phase if phase<(2*math.pi) else 0.0
 
-        return self.circuit
+def quarter_turns(phase: float) -> int:
+    """ Clifford phase as its integer number of quarter turns """
+    turns = QUARTER_TURNS.get(phase)
+    assert(turns!=None)
+    return turns
 
-    def gpi_cancellation(self, qec: bool) -> bool:
-        opt_flag = False
+def quarter_phase(turns: int) -> float:
+    return QUARTER_PHASES[turns]
 
-        for qubit_index in range(self.circuit.num_qubits):
-            accumulated_phase = 0.0
-            prev_index = qubit_index
-            curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-            if curr_index!=None:
-                next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-            else:
-                next_index = None
+def wrap_turns(turns: int) -> int:
+    return turns%4
 
-            while curr_index!=None:
-                curr_node = self.circuit.dag[curr_index]
-                if next_index!=None:
-                    next_node = self.circuit.dag[next_index]
-                else:
-                    next_node = None
-
-                if curr_node.name=='gpi' and next_node!=None and next_node.name=='gpi':
-                    opt_flag = True
-                    new_param = 2*(next_node.parameter[0] - curr_node.parameter[0])
-                    accumulated_phase += new_param
-                    while accumulated_phase<0.0:
-                        accumulated_phase += (2*math.pi)
-                    while accumulated_phase>=2*math.pi:
-                        accumulated_phase -= (2*math.pi)
-
-                    if qec:
-                        assert(accumulated_phase in [n*math.pi for n in range(0, 2)])
-
-                    self.circuit.dag.remove_edge(prev_index, curr_index)
-                    self.circuit.dag.remove_edge(curr_index, next_index)
-                    nnext_index = self.circuit.get_next_gate(qubit_index, next_index)
-                    if nnext_index!=None:
-                        self.circuit.dag.remove_edge(next_index, nnext_index)
-                        self.circuit.dag.add_edge(prev_index, nnext_index, None)
-                    self.circuit.dag.remove_node(curr_index)
-                    self.circuit.dag.remove_node(next_index)
-
-                    curr_index = nnext_index
-                    if curr_index!=None:
-                        next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-                    else:
-                        next_index = None
-
-                    continue
-                elif (curr_node.name=='gpi' or curr_node.name=='gpi2'):
-                    new_param = curr_node.parameter[0] - accumulated_phase
-                    while new_param<0:
-                        new_param += (2*math.pi)
-                    while new_param>=2*math.pi:
-                        new_param -= (2*math.pi)
-                    if qec:
-                        assert(new_param in [n*math.pi/2 for n in range(0, 4)])
-
-                    curr_node.parameter[0] = new_param
-                elif curr_node.name=='ms':
-                    param_index = curr_node.qubits.index(qubit_index)
-                    assert(param_index==0 or param_index==1)
-                    curr_node.parameter[param_index] -= accumulated_phase
-                elif curr_node.name=='rz':
-                    ### Do nothing, just pass by commutation
-                    ### For no qec circuit, rz can appear only at the end of rz
-                    if qec and next_index!=None:
-                        assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<math.pi/2)
-                    elif qec and next_index==None:
-                        assert(self.circuit.get_next_gate(qubit_index, curr_index)==None)
-                    else:
-                        assert(not qec and next_index==None and curr_node.parameter[0]>0 and curr_node.parameter[0]<2*math.pi)
-                else:
-                    ### vz cannot appear in gpi cancellation, if vz_elimination is previously executed
-                    raise Exception(f'Invalid gate %s'%curr_node.name)
-
-                prev_index = curr_index
-                curr_index = next_index
-                if curr_index!=None:
-                    next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-
-            assert(accumulated_phase>=0.0 and accumulated_phase<2*math.pi)
-            if qec:
-                assert(accumulated_phase in [(math.pi/2)*n for n in range(0, 4)])
-
-            last_node = self.circuit.dag[prev_index]
-            assert(self.circuit.get_next_gate(qubit_index, prev_index)==None)
-            if accumulated_phase!=0.0 and last_node.name=='rz':
-                new_param = last_node.parameter[0] + accumulated_phase
-                while new_param<0:
-                    new_param += (2*math.pi)
-                while new_param>=(2*math.pi):
-                    new_param -= (2*math.pi)
-                if new_param!=0.0:
-                    last_node.parameter[0] = new_param
-                else:
-                    pprev_index = self.circuit.get_prev_gate(qubit_index, prev_index)
-                    self.circuit.dag.remove_edge(pprev_index, prev_index)
-                    self.circuit.dag.remove_node(prev_index)
-            elif accumulated_phase!=0.0:
-                new_node = Node('rz', [qubit_index], [accumulated_phase])
-                new_index = self.circuit.dag.add_node(new_node)
-                assert(self.circuit.get_next_gate(qubit_index, prev_index)==None)
-                self.circuit.dag.add_edge(prev_index, new_index, None)
+class NativeCircuitOptimizer:
+    def __init__(self, circuit: Circuit):
+        self.circuit = circuit
 
-        return opt_flag
+    def native_opt(self, qec: bool):
+        for qubit_index in range(self.circuit.num_qubits):
+            self.wire_opt(qubit_index, qec)
 
-    def vz_elimination(self, qec: bool) -> bool:
-        opt_flag = False
+        return self.circuit
 
-        for qubit_index in range(self.circuit.num_qubits):
-            accumulated_phase = 0.0
-            prev_index = qubit_index
-            curr_index = self.circuit.get_next_gate(qubit_index, prev_index)
-            if curr_index!=None:
-                next_index = self.circuit.get_next_gate(qubit_index, curr_index)
-            else:
-                next_index = None
+    def wire_opt(self, qubit_index: int, qec: bool):
+        """ vz elimination and gpi cancellation, fused in a single sweep of the wire.
+            vz (and rz before the end of the wire without QEC) are removed and their phase is accumulated,
+            the gpi cancellation runs one gate behind on the gates left, turning adjacent gpi pairs into a second phase.
+            Both phases are moved past the gpi / gpi2 / ms on the way and applied by the rz at the end of the wire """
+        circuit = self.circuit
+        dag = circuit.dag
+        get_next_gate = circuit.get_next_gate
+        ### With QEC every phase moved around is Clifford, and counted exactly in integer quarter turns.
+        ### Phases are read from / written to the gate parameters as floats
+        if qec:
+            read_phase, write_phase, wrap = quarter_turns, quarter_phase, wrap_turns
+        else:
+            read_phase, write_phase, wrap = float, float, wrap_phase
+        vz_phase = wrap(0)
+        gpi_phase = wrap(0)
+
+        def shift_phase(node, phase):
+            """ Move an accumulated phase past a gpi / gpi2 """
+            node.parameter[0] = write_phase(wrap(read_phase(node.parameter[0]) - phase))
+
+        ### Gates left on the wire, and the last gpi, kept until the next gate tells if they cancel
+        kept = [qubit_index]
+        removed = []
+        pending_gpi = None
+
+        curr_index = get_next_gate(qubit_index, qubit_index)
+        while curr_index!=None:
+            next_index = get_next_gate(qubit_index, curr_index)
+            curr_node = dag[curr_index]
+            opcode = curr_node.opcode
 
-            while curr_index!=None:
-                curr_node = self.circuit.dag[curr_index]
-                if curr_node.name=='gpi' or curr_node.name=='gpi2':
-                    new_param = curr_node.parameter[0] - accumulated_phase
-                    while new_param<0:
-                        new_param += (2*math.pi)
-                    while new_param>=2*math.pi:
-                        new_param -= (2*math.pi)
-                    if qec:
-                        assert(new_param in [(math.pi/2)*n for n in range(0, 4)])
-
-                    curr_node.parameter[0] = new_param
-                    prev_index = curr_index
-                elif curr_node.name=='vz':
-                    opt_flag = True
-                    assert(curr_node.parameter[0] in [(math.pi/2)*n for n in range(1, 4)])
+            ### 1. vz elimination
+            if opcode==VZ or (opcode==RZ and not qec and next_index!=None):
+                if opcode==VZ:
                     ### VZ Gate is deleted regardless of qec or not
-                    accumulated_phase += curr_node.parameter[0]
-                    while accumulated_phase<0:
-                        accumulated_phase += (2*math.pi)
-                    while accumulated_phase>=2*math.pi:
-                        accumulated_phase -= (2*math.pi)
-                    if qec:
-                        assert(accumulated_phase in [(math.pi/2)*n for n in range(0, 4)])
-
-                    self.circuit.dag.remove_edge(prev_index, curr_index)
-                    if next_index!=None:
-                        self.circuit.dag.remove_edge(curr_index, next_index)
-                        self.circuit.dag.add_edge(prev_index, next_index, None)
-                    self.circuit.dag.remove_node(curr_index)
-                elif curr_node.name=='ms':
-                    if qec:
-                        assert(accumulated_phase in [n*math.pi/2 for n in range(0, 4)])
-                    param_index = curr_node.qubits.index(qubit_index)
-                    assert(param_index==0 or param_index==1)
-                    curr_node.parameter[param_index] -= accumulated_phase
-                    prev_index = curr_index
-                elif curr_node.name=='rz':
-                    assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<2*math.pi)
-
-                    if not qec and next_index!=None:
-                        opt_flag = True
-                        ### Also treated as vz
-                        accumulated_phase += curr_node.parameter[0]
-                        while accumulated_phase<0:
-                            accumulated_phase += (2*math.pi)
-                        while accumulated_phase>=2*math.pi:
-                            accumulated_phase -= (2*math.pi)
-
-                        self.circuit.dag.remove_edge(prev_index, curr_index)
-                        if next_index!=None:
-                            self.circuit.dag.remove_edge(curr_index, next_index)
-                            self.circuit.dag.add_edge(prev_index, next_index, None)
-                        self.circuit.dag.remove_node(curr_index)
-                    else:
-                        ### Moving VZ commutes with current rz, passing without any modification
-                        prev_index = curr_index
+                    assert(curr_node.parameter[0] in QUARTER_TURNS and curr_node.parameter[0]!=0)
                 else:
-                    raise Exception(f"Invalid gate %s"%curr_node.name)
-
-                ### prev_index should be updated in the if-else statements above
+                    ### Also treated as vz
+                    assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<2*math.pi)
+                vz_phase = wrap(vz_phase + read_phase(curr_node.parameter[0]))
+                removed.append(curr_index)
                 curr_index = next_index
-                if curr_index!=None:
-                    next_index = self.circuit.get_next_gate(qubit_index, curr_index)
+                continue
+            elif opcode==GPI or opcode==GPI2:
+                shift_phase(curr_node, vz_phase)
+            elif opcode==MS:
+                param_index = curr_node.qubits.index(qubit_index)
+                assert(param_index==0 or param_index==1)
+                curr_node.parameter[param_index] -= write_phase(vz_phase)
+            elif opcode==RZ:
+                ### Moving VZ commutes with current rz, passing without any modification
+                ### For no qec circuit, rz can appear only at the end of the wire
+                assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<2*math.pi)
+            else:
+                raise Exception(f"Invalid gate %s"%curr_node.name)
+
+            ### 2. gpi cancellation of the previous gpi
+            if pending_gpi!=None:
+                if opcode==GPI:
+                    gpi_phase = wrap(gpi_phase + 2*(read_phase(curr_node.parameter[0]) - read_phase(dag[pending_gpi].parameter[0])))
+                    removed.append(pending_gpi)
+                    removed.append(curr_index)
+                    pending_gpi = None
+                    curr_index = next_index
+                    continue
+                shift_phase(dag[pending_gpi], gpi_phase)
+                kept.append(pending_gpi)
+                pending_gpi = None
 
-            assert(accumulated_phase>=0.0 and accumulated_phase<2*math.pi)
-            if qec:
-                assert(accumulated_phase in [(math.pi/2)*n for n in range(0, 4)])
-            
-            last_node = self.circuit.dag[prev_index]
-            if accumulated_phase!=0.0 and last_node.name=='rz':
-                new_param = last_node.parameter[0] + accumulated_phase
-                while new_param<0:
-                    new_param += (2*math.pi)
-                while new_param>=(2*math.pi):
-                    new_param -= (2*math.pi)
+            if opcode==GPI:
+                pending_gpi = curr_index
+            else:
+                if opcode==GPI2:
+                    shift_phase(curr_node, gpi_phase)
+                elif opcode==MS:
+                    curr_node.parameter[param_index] -= write_phase(gpi_phase)
+                kept.append(curr_index)
+            curr_index = next_index
+
+        if pending_gpi!=None:
+            shift_phase(dag[pending_gpi], gpi_phase)
+            kept.append(pending_gpi)
+
+        ### Reconnect the gates left, once per gap
+        for src_index, dst_index in zip(kept, kept[1:]):
+            if get_next_gate(qubit_index, src_index)!=dst_index:
+                circuit.add_edge(qubit_index, src_index, dst_index)
+        for node_index in removed:
+            circuit.remove_node(node_index)
+
+        ### Apply the phases at the end of the wire, the one of vz elimination first
+        last_index = kept[-1]
+        assert(get_next_gate(qubit_index, last_index)==None)
+        for accumulated_phase in (vz_phase, gpi_phase):
+            if accumulated_phase==0:
+                continue
+            last_node = dag[last_index]
+            if last_node.opcode==RZ:
+                new_param = wrap_phase(last_node.parameter[0] + write_phase(accumulated_phase))
                 if new_param!=0.0:
                     last_node.parameter[0] = new_param
                 else:
-                    pprev_index = self.circuit.get_prev_gate(qubit_index, prev_index)
-                    self.circuit.dag.remove_edge(pprev_index, prev_index)
-                    self.circuit.dag.remove_node(prev_index)
-            elif accumulated_phase!=0.0:
-                new_node = Node('rz', [qubit_index], [accumulated_phase])
-                new_index = self.circuit.dag.add_node(new_node)
-                assert(self.circuit.get_next_gate(qubit_index, prev_index)==None)
-                self.circuit.dag.add_edge(prev_index, new_index, None)
-
-        return opt_flag
-
-def rz_approximation(native_circ: Circuit, threshold: int) -> (Circuit, int):
+                    prev_index = circuit.get_prev_gate(qubit_index, last_index)
+                    circuit.remove_node(last_index)
+                    last_index = prev_index
+            else:
+                new_index = circuit.add_node(Node(RZ, [qubit_index], [write_phase(accumulated_phase)]))
+                circuit.add_edge(qubit_index, last_index, new_index)
+                last_index = new_index
+
+def collect_rz(native_circ: Circuit) -> (int, [int], [int], np.ndarray):
+    """ Walk the wires of a native circuit with QEC optimization.
+        Returns the number of gates other than Rz, and the node index, qubit and angle of every Rz,
+        the angle of a Rz at the end of a wire being reduced below pi/2 """
     gate_cnt = 0
-    pending_gate = []
+    rz_indices = []
+    rz_qubits = []
+    angles = []
+    last = []
+    dag = native_circ.dag
+    get_next_gate = native_circ.get_next_gate
     for qubit_index in range(native_circ.num_qubits):
-        pending_gate.append(native_circ.get_next_gate(qubit_index, qubit_index))
-
-    qubit_stack = []
-    for qubit_index in range(native_circ.num_qubits):
-        curr_qubit_index = qubit_index
-        curr_index = pending_gate[curr_qubit_index]
-
+        curr_index = get_next_gate(qubit_index, qubit_index)
         while curr_index!=None:
-            curr_node = native_circ.dag[curr_index]
-            next_index = native_circ.get_next_gate(curr_qubit_index, curr_index)
-            if curr_node.name in ['gpi', 'gpi2']:
+            curr_node = dag[curr_index]
+            next_index = get_next_gate(qubit_index, curr_index)
+            if curr_node.opcode==GPI or curr_node.opcode==GPI2:
                 gate_cnt += 1
-                pending_gate[curr_qubit_index] = next_index
-                curr_index = next_index
-            elif curr_node.name=='rz' and next_index!=None:
-                assert(isinstance(curr_node.parameter[0], float))
-                assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<(math.pi/2))
-
-                prev_index = native_circ.get_prev_gate(curr_qubit_index, curr_index)                
-                native_circ.dag.remove_edge(prev_index, curr_index)
-                native_circ.dag.remove_edge(curr_index, next_index)
-
-                ### Discretize angle of Rz
-                gate_applied = [False for _ in range(threshold+1)]
-                applied_cnt = 0
-                for n in range(2, threshold+1):
-                    divisor = 2**n
-                    if curr_node.parameter[0]>=(math.pi/divisor):
-                        curr_node.parameter[0] -= (math.pi/divisor)
-                        gate_applied[n] = True
-                        applied_cnt += 1
-
-                if applied_cnt>int((threshold-1)/2):
-                    for n in range(2, threshold+1):
-                        gate_applied[n] = not gate_applied[n]
-
-                prev_rz_index = prev_index
-                for n in range(2, threshold+1):
-                    if gate_applied[n]:
-                        new_rz_index = native_circ.dag.add_node(Node('rz', [curr_qubit_index], [n-1], clifford=False))
-                        native_circ.dag.add_edge(prev_rz_index, new_rz_index, None)
-                        prev_rz_index = new_rz_index
-                        gate_cnt += 1
-                native_circ.dag.add_edge(prev_rz_index, next_index, None)
-                native_circ.dag.remove_node(curr_index)
-
-                pending_gate[curr_qubit_index] = next_index
-                curr_index = next_index
-            elif curr_node.name=='rz':
-                assert(next_index==None)
+            elif curr_node.opcode==RZ:
                 assert(isinstance(curr_node.parameter[0], float))
-                assert(curr_node.parameter[0]>0 and curr_node.parameter[0]<(2*math.pi))
-
-                prev_index = native_circ.get_prev_gate(curr_qubit_index, curr_index)
-                native_circ.dag.remove_edge(prev_index, curr_index)
-
-                if curr_node.parameter[0]>=math.pi:
-                    curr_node.parameter[0] -= math.pi
-                if curr_node.parameter[0]>=(math.pi/2):
-                    curr_node.parameter[0] -= (math.pi/2)
-
-                ### Discretize angle of Rz
-                gate_applied = [False for _ in range(threshold+1)]
-                applied_cnt = 0
-                for n in range(2, threshold+1):
-                    divisor = 2**n
-                    if curr_node.parameter[0]>=(math.pi/divisor):
-                        curr_node.parameter[0] -= (math.pi/divisor)
-                        gate_applied[n] = True
-                        applied_cnt += 1
-
-                if applied_cnt>int((threshold-1)/2):
-                    for n in range(2, threshold+1):
-                        gate_applied[n] = not gate_applied[n]
-
-                prev_rz_index = prev_index
-                for n in range(2, threshold+1):
-                    if gate_applied[n]:
-                        new_rz_index = native_circ.dag.add_node(Node('rz', [curr_qubit_index], [n-1], clifford=False))
-                        native_circ.dag.add_edge(prev_rz_index, new_rz_index, None)
-                        prev_rz_index = new_rz_index
-                        gate_cnt += 1
-                native_circ.dag.remove_node(curr_index)
-
-                pending_gate[curr_qubit_index] = next_index
-                curr_index = next_index
-            elif curr_node.name=='ms':
-                pair_qubit_index = curr_node.qubits[(curr_node.qubits.index(curr_qubit_index)+1)%2]
-                if qubit_stack and qubit_stack[-1]==(pair_qubit_index, curr_index):
-                    qubit_stack.pop()
+                rz_indices.append(curr_index)
+                rz_qubits.append(qubit_index)
+                angles.append(curr_node.parameter[0])
+                last.append(next_index==None)
+            elif curr_node.opcode==MS:
+                if curr_node.qubits[0]==qubit_index:
                     gate_cnt += 1
-                    pending_gate[curr_qubit_index] = native_circ.get_next_gate(curr_qubit_index, curr_index)
-                    pending_gate[pair_qubit_index] = native_circ.get_next_gate(pair_qubit_index, curr_index)
-                else:
-                    qubit_stack.append((curr_qubit_index, curr_index))
-                curr_qubit_index = pair_qubit_index
-                curr_index = pending_gate[pair_qubit_index]
             else:
                 raise Exception(f'Invalid gate instruction %s %s'%(curr_node.name, curr_node.qubits))
-            
-    for qubit_index in range(native_circ.num_qubits):
-        assert(pending_gate[qubit_index]==None)
+            curr_index = next_index
+
+    angles = np.array(angles, dtype=float)
+    last = np.array(last, dtype=bool)
+    assert(np.all(angles[~last]>0) and np.all(angles[~last]<(math.pi/2)))
+    assert(np.all(angles[last]>0) and np.all(angles[last]<(2*math.pi)))
+    ### Rz at the end of a wire is only needed up to pi/2 before the measurement
+    np.subtract(angles, math.pi, out=angles, where=last&(angles>=math.pi))
+    np.subtract(angles, math.pi/2, out=angles, where=last&(angles>=(math.pi/2)))
+    return gate_cnt, rz_indices, rz_qubits, angles
+
+def rz_decomposition(angles: np.ndarray, thresholds: [int]) -> {int: np.ndarray}:
+    """ Discretize Rz angles in [0, pi/2) onto rz(pi/2**n) for n in 2..threshold, over all angles at once.
+        Returns for each threshold a bool matrix whose row i has column n-2 set if rz(pi/2**n) is applied for angles[i] """
+    max_threshold = max(thresholds)
+    residual = angles.copy()
+    greedy = np.zeros((len(angles), max(max_threshold-1, 0)), dtype=bool)
+    ### Greedy, with the same float subtractions in the same order as a per-angle loop.
+    ### The choice up to a threshold does not depend on the later steps, so it is shared by every threshold
+    for n in range(2, max_threshold+1):
+        np.greater_equal(residual, math.pi/2**n, out=greedy[:, n-2])
+        np.subtract(residual, math.pi/2**n, out=residual, where=greedy[:, n-2])
+
+    decompositions = {}
+    for threshold in thresholds:
+        applied = greedy[:, :max(threshold-1, 0)].copy()
+        ### More than half of the gates applied: apply the complement instead
+        flipped = applied.sum(axis=1)>int((threshold-1)/2)
+        applied[flipped] = ~applied[flipped]
+        decompositions[threshold] = applied
+    return decompositions
+
+def splice_rz(native_circ: Circuit, rz_indices: [int], rz_qubits: [int], applied: np.ndarray) -> int:
+    """ Replace the Rz nodes by the rz(pi/2**n) gates of their decomposition, the parameter being the depth n-1.
+        Returns the number of gates added """
+    ### Applied gates in row-major order, i.e. grouped by Rz and by increasing depth
+    rows, columns = np.nonzero(applied)
+    chain_ends = np.cumsum(applied.sum(axis=1)).tolist()
+    ### Only acyclic objects are allocated here, pause the cyclic GC that would rescan them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    qubit_lists = [[qubit_index] for qubit_index in rz_qubits]
+    new_nodes = [Node(RZ, qubit_lists[row], [column+1], clifford=False)
+                 for row, column in zip(rows.tolist(), columns.tolist())]
+    replacements = []
+    chain_start = 0
+    for node_index, chain_end in zip(rz_indices, chain_ends):
+        replacements.append((node_index, new_nodes[chain_start:chain_end]))
+        chain_start = chain_end
+    native_circ.replace_nodes(replacements)
+    if gc_enabled:
+        gc.enable()
+    return len(new_nodes)
+
+def rz_approximation_sweep(native_circ: Circuit, thresholds: [int]):
+    """ rz_approximation for several thresholds, sharing the wire traversal and the angle decomposition.
+        Yields (threshold, circuit, gate_cnt) in the order of thresholds. Every circuit but the last
+        is approximated on a clone of native_circ, and the last one on native_circ itself """
+    gate_cnt, rz_indices, rz_qubits, angles = collect_rz(native_circ)
+    decompositions = rz_decomposition(angles, thresholds)
+    for k, threshold in enumerate(thresholds):
+        ### Clones keep the node indices, so rz_indices stay valid for them
+        circuit = native_circ.clone() if k<len(thresholds)-1 else native_circ
+        added_cnt = splice_rz(circuit, rz_indices, rz_qubits, decompositions[threshold])
+        yield threshold, circuit, gate_cnt+added_cnt
 
-    return native_circ, gate_cnt
\ No newline at end of file
+def rz_approximation(native_circ: Circuit, threshold: int) -> (Circuit, int):
+    """ Replace every Rz by the rz(pi/2**n) gates of its discretized angle, the parameter being the depth n-1.
+        The angles are discretized together by rz_decomposition and the DAG spliced in one batch """
+    _, native_circ, gate_cnt = next(rz_approximation_sweep(native_circ, [threshold]))
+    return native_circ, gate_cnt
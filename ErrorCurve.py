@@ -0,0 +1,186 @@
+import sys, dataclasses
+from math import comb
+
+import numpy as np
+
+import QeccLib
+
+'''
+    Success probability of a schedule as a closed-form function of the two-qubit error rate x,
+    equal to generate_error_depol of src/error_generator.rs at every x.
+    Every gate maps the error probability e of its qubit to 3/4 - (3/4-e)(1-k*x), k depending on the gate only,
+    so a QEC segment (the gates up to and including a 'q') only depends on how many gates of each kind it has:
+    at its 'q', e = 3/4 - (3/4-e0) * prod_t (1-k_t*x)^count_t, with e0 = 0 on the first segment of a qubit
+    and QEC_ERR*x after a QEC. Segments with the same histogram are evaluated once, for all error rates at once.
+    The gate error weights are parameters (NoiseModel), so other noise hypotheses and (n, k, d) codes
+    are scored against the same schedules without rebuilding the simulator; the schedules themselves,
+    made with the QEC times of src/lib.rs, do not change with them.
+'''
+
+@dataclasses.dataclass
+class NoiseModel:
+    """ Gate error weights relative to the two-qubit error rate, those the library was built with by default """
+    sq_err: float = QeccLib.SQ_ERR
+    tq_err: float = QeccLib.TQ_ERR
+    swap_err: float = QeccLib.SWAP_ERR
+    shuttle_err: float = QeccLib.SHUTTLE_ERR
+    measure_err: float = QeccLib.MEASURE_ERR
+    qec_err: float = QeccLib.QEC_ERR
+
+    def to_array(self) -> np.ndarray:
+        return np.array(dataclasses.astuple(self), dtype=np.float64)
+
+DEFAULT_NOISE = NoiseModel()
+SQ, TQ, SWAP, SHUTTLE, MEASURE, QEC = range(6)
+### Scheduled gate letters (GPI, GPI2, rz, MS, swap, shuttle, measure), their weight in a NoiseModel,
+### and the depolarizing factor k/weight of the one (4/3) or two (16/15) qubit channel
+OPS = 'gprmshM'
+OP_NOISE = np.array([SQ, SQ, SQ, TQ, SWAP, SHUTTLE, MEASURE])
+OP_DEPOL = np.array([4/3, 4/3, 4/3, 16/15, 16/15, 4/3, 4/3])
+QEC_OP = 'q'
+### Elements of the (segments, models, rates) arrays evaluated at once
+EVAL_CHUNK = 1<<22
+
+_OP_INDEX = np.full(256, -1, dtype=np.int64)
+for _index, _op in enumerate(OPS):
+    _OP_INDEX[ord(_op)] = _index
+_OP_INDEX[ord(QEC_OP)] = len(OPS)
+
+def _noise_array(noise_models) -> np.ndarray:
+    """ (models, 6) weights of a NoiseModel, a list of them, or an array of weight vectors """
+    if isinstance(noise_models, NoiseModel):
+        noise_models = [noise_models]
+    noise_models = [noise.to_array() if isinstance(noise, NoiseModel) else noise for noise in noise_models]
+    return np.atleast_2d(np.asarray(noise_models, dtype=np.float64))
+
+class ErrorCurve:
+    """ QEC segments of a schedule as unique (histogram, first segment) rows with their multiplicity """
+    def __init__(self, counts: np.ndarray, first: np.ndarray, multiplicity: np.ndarray):
+        self.counts = counts                # (segments, len(OPS)) gates of each kind
+        self.first = first                  # (segments,) first segment of its qubit
+        self.multiplicity = multiplicity    # (segments,) number of such segments in the schedule
+
+    @classmethod
+    def from_qubits(cls, qubits: [str]):
+        """ Schedule given as the gate letters of each qubit (whitespace ignored) """
+        rows, firsts = [], []
+        for qubit_index, qubit in enumerate(qubits):
+            ops = _OP_INDEX[np.frombuffer(''.join(qubit.split()).encode(), dtype=np.uint8)]
+            if len(ops)==0:
+                continue
+            if np.any(ops<0):
+                raise Exception(f'Unknown gate in the schedule of qubit %d'%qubit_index)
+            is_qec = ops==len(OPS)
+            if not is_qec[-1]:
+                raise Exception(f'Schedule of qubit %d does not end with a QEC'%qubit_index)
+            ### Segment of each gate, a QEC closing its own segment
+            segment = np.cumsum(is_qec) - is_qec
+            num_segments = int(is_qec.sum())
+            gates = ~is_qec
+            counts = np.bincount(segment[gates]*len(OPS) + ops[gates], minlength=num_segments*len(OPS))
+            rows.append(counts.reshape(num_segments, len(OPS)))
+            qubit_first = np.zeros(num_segments, dtype=bool)
+            qubit_first[0] = True
+            firsts.append(qubit_first)
+        if not rows:
+            return cls(np.zeros((0, len(OPS)), dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64))
+        keys = np.hstack([np.concatenate(rows), np.concatenate(firsts)[:, None]])
+        keys, multiplicity = np.unique(keys, axis=0, return_counts=True)
+        return cls(keys[:, :len(OPS)], keys[:, len(OPS)].astype(bool), multiplicity)
+
+    @classmethod
+    def from_file(cls, filepath: str):
+        """ Schedule printed by the SCHED_EXP experiment, one 'q<index> <gate> <gate> ...' line per qubit """
+        with open(filepath, 'r') as f:
+            return cls.from_qubits([line.split(maxsplit=1)[1] if len(line.split())>1 else ''
+                                    for line in f if line.strip()])
+
+    @classmethod
+    def from_schedule(cls, sched):
+        """ QeccLib.Schedule """
+        return cls.from_qubits([sched.qubit_gates(qubit_index) for qubit_index in range(sched.num_qubits)])
+
+    @property
+    def num_segments(self) -> int:
+        return int(self.multiplicity.sum())
+
+    def evaluate(self, noise_models, codes: [(int, int, int)], two_qubit_errors, approx_factor: int = 1) -> np.ndarray:
+        """ (models, codes, rates) success probabilities raised to approx_factor,
+            NaN where an error rate is out of the error model of a noise model """
+        noise = _noise_array(noise_models)
+        rates = np.atleast_1d(np.asarray(two_qubit_errors, dtype=np.float64))
+        success_probs = np.empty((len(noise), len(codes), len(rates)))
+        chunk = max(1, EVAL_CHUNK//max(1, len(self.multiplicity)*len(rates)))
+        for begin in range(0, len(noise), chunk):
+            success_probs[begin:begin+chunk] = self._evaluate(noise[begin:begin+chunk], codes, rates, approx_factor)
+        return success_probs
+
+    def _evaluate(self, noise: np.ndarray, codes: [(int, int, int)], rates: np.ndarray, approx_factor: int) -> np.ndarray:
+        ### (models, ops, rates) decay of 3/4-e by each gate
+        decay = 1.0 - (OP_DEPOL*noise[:, OP_NOISE])[:, :, None]*rates[None, None, :]
+        ### Only the gates the schedule has can take a rate out of the error model
+        invalid = np.any((decay<=0.0) & (self.counts.sum(0)>0)[None, :, None], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            log_decay = np.log(np.where(decay>0.0, decay, 1.0))
+            ### Error probability at the QEC of each segment, (segments, models, rates)
+            start = np.where(self.first[:, None, None], 0.0, (noise[:, QEC, None]*rates[None, :])[None, :, :])
+            error_prob = 0.75 - (0.75 - start)*np.exp(np.tensordot(self.counts, log_decay, axes=([1], [1])))
+            invalid |= np.any(error_prob>1.0, axis=0)
+            not_flip_prob = 1.0 - 2.0*error_prob/3.0
+            log_not_flip_prob = np.log(not_flip_prob)
+            flip_ratio = (1.0-not_flip_prob)/not_flip_prob
+            multiplicity = self.multiplicity.astype(np.float64)
+            success_probs = np.empty((len(noise), len(codes), len(rates)))
+            for code_index, (n, _, d) in enumerate(codes):
+                ### sum_j C(n, j) f^(n-j) (1-f)^j for j <= d/2, as f^n times a polynomial of (1-f)/f
+                polynomial = np.full_like(flip_ratio, comb(n, d//2))
+                for num_errors in range(d//2-1, -1, -1):
+                    polynomial = polynomial*flip_ratio + comb(n, num_errors)
+                log_correctable_prob = n*log_not_flip_prob + np.log(polynomial)
+                log_success = np.tensordot(multiplicity, log_correctable_prob, axes=1)
+                success_probs[:, code_index] = np.exp(2.0*approx_factor*log_success)
+        success_probs[np.broadcast_to(invalid[:, None, :], success_probs.shape)] = np.nan
+        return success_probs
+
+    def success_prob(self, code: (int, int, int), two_qubit_error, approx_factor: int = 1, noise: NoiseModel = DEFAULT_NOISE):
+        """ Success probability at each two-qubit error rate (a float for a single rate), raised to approx_factor """
+        success_probs = self.evaluate(noise, [code], two_qubit_error, approx_factor)[0, 0]
+        if np.any(np.isnan(success_probs)):
+            raise Exception(f'Error rate out of the error model of %s'%(noise,))
+        return float(success_probs[0]) if np.ndim(two_qubit_error)==0 else success_probs
+
+    def threshold(self, code: (int, int, int), success_prob: float, error_rates: np.ndarray, approx_factor: int = 1,
+                  noise: NoiseModel = DEFAULT_NOISE) -> float:
+        """ Error rate where the success probability first falls to success_prob on the increasing error_rates,
+            linearly interpolated (None if it stays above) """
+        return crossing(error_rates, self.success_prob(code, error_rates, approx_factor, noise) - success_prob)
+
+def crossing(error_rates: np.ndarray, values: np.ndarray) -> float:
+    """ First error rate where values changes sign or reaches 0, linearly interpolated (None if never).
+        values = curve_a - curve_b gives where two curves cross """
+    error_rates, values = np.asarray(error_rates), np.asarray(values)
+    if values[0]==0.0:
+        return float(error_rates[0])
+    changes = np.nonzero(np.sign(values[1:])!=np.sign(values[:-1]))[0]
+    if len(changes)==0:
+        return None
+    i = changes[0]
+    return float(error_rates[i] + (error_rates[i+1]-error_rates[i]) * values[i]/(values[i]-values[i+1]))
+
+def load_curves(filepaths: [str]) -> {str: ErrorCurve}:
+    """ ErrorCurve of each SCHED_EXP output, parsed once and then evaluated for any number of noise models """
+    return {filepath: ErrorCurve.from_file(filepath) for filepath in filepaths}
+
+def evaluate_curves(curves: {str: ErrorCurve}, noise_models, codes: [(int, int, int)], two_qubit_errors,
+                    approx_factor: int = 1) -> {str: np.ndarray}:
+    """ ErrorCurve.evaluate of every curve with the same batch of noise models, codes and error rates """
+    return {name: curve.evaluate(noise_models, codes, two_qubit_errors, approx_factor) for name, curve in curves.items()}
+
+if __name__ == '__main__':
+    ### python ErrorCurve.py <SCHED_EXP output> [max error rate]
+    ### Prints where the success probability of each code falls to 1/2, over 10000 error rates
+    curve = ErrorCurve.from_file(sys.argv[1])
+    error_rates = np.linspace(0.0, float(sys.argv[2]) if len(sys.argv)>2 else 1e-2, 10000)
+    print("%d QEC segments, %d distinct"%(curve.num_segments, len(curve.multiplicity)))
+    for code in QeccLib.CODES:
+        print("%s: success probability 1/2 at error rate %s"%(code, curve.threshold(code, 0.5, error_rates)))
@@ -2,14 +2,34 @@ import math
 from dataclasses import dataclass
 from dataclasses import field
 
-@dataclass
+### Gate opcodes, interned from gate names on input and turned back into names on output
+QUBIT, X, Y, Z, H, S, SDG, RZ, CX, GPI, GPI2, VZ, MS = range(13)
+GATE_NAME = ('qubit', 'x', 'y', 'z', 'h', 's', 'sdg', 'rz', 'cx', 'gpi', 'gpi2', 'vz', 'ms')
+OPCODE = {name: opcode for opcode, name in enumerate(GATE_NAME)}
+
+def opcode_mask(*opcodes) -> int:
+    """ Bitmask of a set of opcodes, tested with (1<<opcode)&mask """
+    mask = 0
+    for opcode in opcodes:
+        mask |= (1<<opcode)
+    return mask
+
+### Gates that commute through the control / target of a cx
+CONTROL_COMMUTE = opcode_mask(S, SDG, Z, RZ)
+TARGET_COMMUTE = opcode_mask(X)
+
+@dataclass(slots=True)
 class Node:
-    name: str
+    opcode: int
     qubits : [int]
     parameter: [float] = field(default_factory=list)
     duration: [int] = 1
     clifford: bool = True
 
+    @property
+    def name(self) -> str:
+        return GATE_NAME[self.opcode]
+
     def __str__(self):
         applied_qubit = ""
         for qubit_index in self.qubits:
@@ -0,0 +1,59 @@
+import os, json, time
+
+'''
+    Opt-in instrumentation of AbsCircuitOptimizer, given as its profiler.
+    Records the wall time, calls and removed nodes of each pass, how often each rule fires,
+    counters of work that is not a rewrite (e.g. re-examined positions),
+    and the DAG size after each round (a last round that changes nothing is the wasted one).
+'''
+class OptProfiler:
+    def __init__(self):
+        self.passes = {}        # pass name: {'calls', 'time', 'removed'}
+        self.rules = {}         # rule name: number of rewrites
+        self.counters = {}      # counter name: total, for work that is not a rewrite
+        self.rounds = []        # {'round', 'num_nodes', 'optimized'} after each round
+        self.initial_nodes = None
+        self.start = None
+        self.elapsed = 0.0
+
+    def begin(self, circuit):
+        self.initial_nodes = circuit.dag.num_nodes()
+        self.start = time.perf_counter()
+
+    def run_pass(self, name: str, circuit, opt_pass):
+        """ Run opt_pass(), recording its wall time and the nodes it removed """
+        num_nodes = circuit.dag.num_nodes()
+        start = time.perf_counter()
+        result = opt_pass()
+        elapsed = time.perf_counter() - start
+        stats = self.passes.setdefault(name, {'calls': 0, 'time': 0.0, 'removed': 0})
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        stats['removed'] += num_nodes - circuit.dag.num_nodes()
+        return result
+
+    def hit(self, rule: str):
+        self.rules[rule] = self.rules.get(rule, 0) + 1
+
+    def count(self, counter: str, amount: int):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def end_round(self, circuit, optimized: bool):
+        self.rounds.append({'round': len(self.rounds)+1, 'num_nodes': circuit.dag.num_nodes(), 'optimized': optimized})
+        self.elapsed = time.perf_counter() - self.start
+
+    def summary(self) -> dict:
+        return {'initial_nodes': self.initial_nodes,
+                'final_nodes': self.rounds[-1]['num_nodes'] if self.rounds else self.initial_nodes,
+                'total_time': self.elapsed,
+                'wasted_rounds': sum([1 for record in self.rounds if not record['optimized']]),
+                'passes': self.passes,
+                'rules': dict(sorted(self.rules.items(), key=lambda item: -item[1])),
+                'counters': self.counters,
+                'rounds': self.rounds}
+
+    def to_json(self, filepath: str):
+        tmp_filepath = "%s.tmp"%filepath
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+        os.replace(tmp_filepath, filepath)
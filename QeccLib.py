@@ -0,0 +1,188 @@
+import os, sys, ctypes, weakref
+from ctypes import c_bool, c_double, c_int64, c_size_t, c_uint8, c_uint32, c_uint64, c_void_p, POINTER
+
+import numpy as np
+
+from Circuit import Circuit, BINARY_CODE, BINARY_RZ_DEPTH
+from Node import OPCODE, RZ
+
+'''
+    In-process access to the scheduler and error generator of the qecc crate (src/ffi.rs),
+    without spawning target/release/qecc per sweep point.
+    The library is built along with the simulator by cargo build --release.
+'''
+
+_filepath = os.path.abspath(__file__)
+_dirname = os.path.dirname(_filepath)
+if sys.platform=='win32':
+    _library = os.path.join(_dirname, "target", "release", "qecc.dll")
+elif sys.platform=='darwin':
+    _library = os.path.join(_dirname, "target", "release", "libqecc.dylib")
+else:
+    _library = os.path.join(_dirname, "target", "release", "libqecc.so")
+### Set QECC_LIB to load the library from another build
+_library = os.environ.get('QECC_LIB', _library)
+if not os.path.isfile(_library):
+    raise Exception(f'No library exists at %s, build it with cargo build --release'%_library)
+
+_lib = ctypes.CDLL(_library)
+_lib.qecc_circuit_from_gates.argtypes = [c_size_t, c_size_t, POINTER(c_uint8), POINTER(c_uint32), POINTER(c_int64), c_size_t]
+_lib.qecc_circuit_from_gates.restype = c_void_p
+_lib.qecc_circuit_from_native.argtypes = [ctypes.c_char_p, c_size_t, ctypes.c_char_p, c_size_t]
+_lib.qecc_circuit_from_native.restype = c_void_p
+_lib.qecc_circuit_free.argtypes = [c_void_p]
+_lib.qecc_circuit_free.restype = None
+_lib.qecc_circuit_num_qubits.argtypes = [c_void_p]
+_lib.qecc_circuit_num_qubits.restype = c_size_t
+_lib.qecc_circuit_approx_factor.argtypes = [c_void_p]
+_lib.qecc_circuit_approx_factor.restype = c_size_t
+_lib.qecc_schedule.argtypes = [c_void_p, c_uint32, c_size_t, c_size_t, c_size_t, POINTER(c_size_t)]
+_lib.qecc_schedule.restype = c_void_p
+_lib.qecc_schedule_free.argtypes = [c_void_p]
+_lib.qecc_schedule_free.restype = None
+_lib.qecc_schedule_num_qubits.argtypes = [c_void_p]
+_lib.qecc_schedule_num_qubits.restype = c_size_t
+_lib.qecc_schedule_num_gates.argtypes = [c_void_p]
+_lib.qecc_schedule_num_gates.restype = c_size_t
+_lib.qecc_schedule_export.argtypes = [c_void_p, POINTER(c_size_t), POINTER(c_uint8), POINTER(c_uint64)]
+_lib.qecc_schedule_export.restype = None
+_lib.qecc_error_depol.argtypes = [c_void_p, c_size_t, c_size_t, c_size_t, POINTER(c_double), c_size_t, POINTER(c_double)]
+_lib.qecc_error_depol.restype = c_bool
+_lib.qecc_tq_time.argtypes = []
+_lib.qecc_tq_time.restype = c_size_t
+_lib.qecc_empty_sector.argtypes = []
+_lib.qecc_empty_sector.restype = c_size_t
+_lib.qecc_num_codes.argtypes = []
+_lib.qecc_num_codes.restype = c_size_t
+_lib.qecc_code.argtypes = [c_size_t, POINTER(c_size_t), POINTER(c_size_t)]
+_lib.qecc_code.restype = c_bool
+_lib.qecc_error_weights.argtypes = [POINTER(c_double)]
+_lib.qecc_error_weights.restype = None
+_lib.qecc_num_error_rate_ticks.argtypes = []
+_lib.qecc_num_error_rate_ticks.restype = c_size_t
+_lib.qecc_error_rate_ticks.argtypes = [POINTER(c_double)]
+_lib.qecc_error_rate_ticks.restype = None
+
+### Schedulers of qecc_schedule (SCHED_* of src/ffi.rs)
+SCHED_NTCF, SCHED_MARK, SCHED_PMARK = range(3)
+### Codes, QEC times and sector layout of src/lib.rs, read from the library so that they are always the simulator's
+def _codes() -> {(int, int, int): int}:
+    code_times = {}
+    code, qec_time = (c_size_t*3)(), c_size_t(0)
+    for index in range(_lib.qecc_num_codes()):
+        ### Not inside an assert, which python -O strips along with the call
+        if not _lib.qecc_code(index, code, ctypes.byref(qec_time)):
+            raise Exception(f'No code %d in the library %s'%(index, _library))
+        code_times[tuple(code)] = qec_time.value
+    return code_times
+
+TQ_TIME = _lib.qecc_tq_time()
+EMPTY_SECTOR = _lib.qecc_empty_sector()
+CODE_TIMES = _codes()
+CODES = list(CODE_TIMES)
+C7_CODE, C17_CODE, C31_CODE = (7, 1, 3), (17, 1, 5), (31, 1, 7)
+for _code in (C7_CODE, C17_CODE, C31_CODE):
+    if _code not in CODE_TIMES:
+        raise Exception(f'Code %s is not in the library %s'%(_code, _library))
+NO_QEC_CODE = (1, 1, 1)
+### Gate error weights of the error model, relative to the two-qubit error rate
+_weights = np.zeros(6, dtype=np.float64)
+_lib.qecc_error_weights(_weights.ctypes.data_as(POINTER(c_double)))
+SQ_ERR, TQ_ERR, SWAP_ERR, SHUTTLE_ERR, MEASURE_ERR, QEC_ERR = _weights.tolist()
+### Two-qubit error rates swept by the error rate experiment
+ERROR_RATES = np.zeros(_lib.qecc_num_error_rate_ticks(), dtype=np.float64)
+_lib.qecc_error_rate_ticks(ERROR_RATES.ctypes.data_as(POINTER(c_double)))
+
+### Binary gate code of each opcode, rz with a depth being turned into BINARY_RZ_DEPTH
+_GATE_CODE = np.zeros(len(OPCODE), dtype=np.uint8)
+for _opcode, _code in BINARY_CODE.items():
+    _GATE_CODE[_opcode] = _code
+
+def _pointer(array: np.ndarray, ctype):
+    return array.ctypes.data_as(POINTER(ctype))
+
+class SimCircuit:
+    """ Native circuit loaded in the library """
+    def __init__(self, handle: int):
+        if not handle:
+            raise Exception(f'Invalid native circuit')
+        self.handle = handle
+        ### Freed with the object, and still safely at interpreter exit
+        weakref.finalize(self, _lib.qecc_circuit_free, handle)
+        self.num_qubits = _lib.qecc_circuit_num_qubits(handle)
+        self.approx_factor = _lib.qecc_circuit_approx_factor(handle)
+
+    @classmethod
+    def from_circuit(cls, circuit: Circuit, qec: bool, approx_factor: int):
+        """ Native circuit of an optimized (and, with qec, Rz approximated) Circuit, as circuit_to_txt would write it """
+        gates = np.array(list(circuit.native_gates(qec)), dtype=np.int64).reshape(-1, 3)
+        opcodes, targets, args = gates[:, 0], gates[:, 1], gates[:, 2]
+        codes = _GATE_CODE[opcodes]
+        codes[(opcodes==RZ) & (args>=0)] = BINARY_RZ_DEPTH
+        codes = np.ascontiguousarray(codes)
+        targets = np.ascontiguousarray(targets, dtype=np.uint32)
+        args = np.ascontiguousarray(args)
+        return cls(_lib.qecc_circuit_from_gates(circuit.num_qubits, approx_factor, _pointer(codes, c_uint8),
+                                                _pointer(targets, c_uint32), _pointer(args, c_int64), len(gates)))
+
+    @classmethod
+    def from_file(cls, filepath: str):
+        """ Native circuit file written by circuit_to_txt, in either format """
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        error = ctypes.create_string_buffer(256)
+        handle = _lib.qecc_circuit_from_native(data, len(data), error, len(error))
+        if not handle:
+            raise Exception(f'Invalid native circuit %s: %s'%(filepath, error.value.decode()))
+        return cls(handle)
+
+class Schedule:
+    """ Schedule made in the library, kept there for generate_error_depol.
+        offsets[q]:offsets[q+1] are the gates of qubit q in gates (ASCII letters as uint8) and timestamps """
+    def __init__(self, handle: int, runtime: int):
+        if not handle:
+            raise Exception(f'Scheduling failed')
+        self.handle = handle
+        weakref.finalize(self, _lib.qecc_schedule_free, handle)
+        self.runtime = runtime
+        num_qubits = _lib.qecc_schedule_num_qubits(handle)
+        num_gates = _lib.qecc_schedule_num_gates(handle)
+        self.offsets = np.zeros(num_qubits+1, dtype=np.uintp)
+        self.gates = np.zeros(num_gates, dtype=np.uint8)
+        self.timestamps = np.zeros(num_gates, dtype=np.uint64)
+        _lib.qecc_schedule_export(handle, _pointer(self.offsets, c_size_t), _pointer(self.gates, c_uint8),
+                                  _pointer(self.timestamps, c_uint64))
+
+    @property
+    def num_qubits(self) -> int:
+        return len(self.offsets)-1
+
+    def qubit_gates(self, qubit_index: int) -> str:
+        """ Scheduled gates of a qubit, one letter each as printed by the SCHED_EXP experiment """
+        return self.gates[self.offsets[qubit_index]:self.offsets[qubit_index+1]].tobytes().decode()
+
+def _schedule(circuit: SimCircuit, scheduler: int, sector_size: int, empty_sector: int, qec_time: int) -> (Schedule, int):
+    runtime = c_size_t(0)
+    handle = _lib.qecc_schedule(circuit.handle, scheduler, sector_size, empty_sector, qec_time, ctypes.byref(runtime))
+    sched = Schedule(handle, runtime.value)
+    return sched, sched.runtime
+
+def ntcf_scheduler(circuit: SimCircuit, sector_size: int, empty_sector: int = EMPTY_SECTOR,
+                   qec_time: int = CODE_TIMES[C17_CODE]) -> (Schedule, int):
+    return _schedule(circuit, SCHED_NTCF, sector_size, empty_sector, qec_time)
+
+def mark_scheduler(circuit: SimCircuit, sector_size: int, empty_sector: int = EMPTY_SECTOR,
+                   qec_time: int = CODE_TIMES[C17_CODE]) -> (Schedule, int):
+    return _schedule(circuit, SCHED_MARK, sector_size, empty_sector, qec_time)
+
+def pmark_scheduler(circuit: SimCircuit, sector_size: int, empty_sector: int = EMPTY_SECTOR) -> (Schedule, int):
+    return _schedule(circuit, SCHED_PMARK, sector_size, empty_sector, 0)
+
+def generate_error_depol(sched: Schedule, code: (int, int, int), two_qubit_error):
+    """ Success probability of the schedule at each two-qubit error rate (a float for a single rate).
+        Like the simulator, raise it to the power approx_factor of the circuit for the whole algorithm """
+    rates = np.ascontiguousarray(np.atleast_1d(two_qubit_error), dtype=np.float64)
+    success_probs = np.empty(len(rates), dtype=np.float64)
+    if not _lib.qecc_error_depol(sched.handle, *code, _pointer(rates, c_double), len(rates), _pointer(success_probs, c_double)):
+        raise Exception(f'Schedule rejected by the error model of code %s'%(code,))
+    return float(success_probs[0]) if np.ndim(two_qubit_error)==0 else success_probs
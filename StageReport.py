@@ -0,0 +1,80 @@
+import os, sys, json, time, datetime
+from contextlib import contextmanager
+
+def _proc_status_mb(field: str) -> float:
+    """ A kB field of /proc/self/status in MB, None where there is no procfs (macOS, Windows) """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/(1<<10)
+    except OSError:
+        pass
+    return None
+
+def rss_mb() -> float:
+    """ Resident memory of this process now, in MB """
+    return _proc_status_mb('VmRSS')
+
+def reset_peak_rss() -> bool:
+    """ Restart the peak resident memory of this process from its current size (Linux 4.0+), False if unsupported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb() -> float:
+    """ Peak resident memory of this process since the last reset_peak_rss, in MB """
+    return _proc_status_mb('VmHWM')
+
+'''
+    Timing of the stages of one benchmark generation.
+    Each stage prints its Start / Finish lines and records its duration, the resident memory of the process
+    at its start and end, its own peak resident memory, and the gate count the stage sets on its record.
+    The peak is restarted at every stage, so it does not carry the peak of an earlier stage or of an earlier job
+    run by the same pool process; it is None where the kernel cannot restart it.
+'''
+class StageReport:
+    def __init__(self, algorithm: str, N: int, approx_factor: int):
+        self.algorithm = algorithm
+        self.N = N
+        self.approx_factor = approx_factor
+        self.stages = []
+
+    def log(self, message: str):
+        print("%s (%s %d(af %d)) %s"%\
+              (datetime.datetime.today().strftime("[%H:%M:%S]"), self.algorithm, self.N, self.approx_factor, message))
+
+    @contextmanager
+    def stage(self, name: str, description: str):
+        """ with report.stage(name, description) as record: ...; record['gate_cnt'] = ...
+            A stage that raises is still recorded, as failed """
+        record = {'stage': name, 'duration': None, 'rss_start_mb': rss_mb(), 'rss_end_mb': None,
+                  'peak_rss_mb': None, 'gate_cnt': None, 'failed': False}
+        self.log("Start %s"%description)
+        peak_reset = reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - start
+            record['rss_end_mb'] = rss_mb()
+            record['peak_rss_mb'] = peak_rss_mb() if peak_reset else None
+            self.stages.append(record)
+            self.log("%s %s"%('Failed' if record['failed'] else 'Finish', description))
+
+    def to_dict(self) -> dict:
+        return {'algorithm': self.algorithm, 'N': self.N, 'approx_factor': self.approx_factor,
+                'total_duration': sum([record['duration'] for record in self.stages]), 'stages': self.stages}
+
+def write_reports(filepath: str, reports: [dict]):
+    """ Write the to_dict() of the reports of a benchmark matrix as one JSON file """
+    tmp_filepath = "%s.tmp"%filepath
+    with open(tmp_filepath, 'w') as f:
+        json.dump(reports, f, indent=1)
+    os.replace(tmp_filepath, filepath)
@@ -1,5 +1,6 @@
-import subprocess, os, sys
-import datetime
+import subprocess, os, sys, time, json, hashlib, threading, math, queue
+import datetime, dataclasses, functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 from ExperimentSet import num_qubit_exp, error_rate_exp, trap_size_exp, sched_exp
@@ -15,134 +16,437 @@ else:
     raise Exception(f'No executable exists')
 
 NUM_ITER = 1
+### Extra attempts of a job whose simulator exits with an error
+MAX_RETRY = 2
+### Record of every job run, so that an interrupted sweep resumes where it stopped
+MANIFEST_PATH = os.path.join('data', 'manifest.json')
+### Adaptive sweeps: each point runs ITER_BATCH iterations at a time, at least MIN_ITER and at most MAX_ITER,
+### until the CI_Z (95%) confidence intervals of its mean runtime and success probabilities are narrow enough
+ITER_BATCH = 8
+MIN_ITER = 8
+MAX_ITER = 512
+CI_Z = 1.96
+PROB_CI_WIDTH = 1e-3        # full width of each success probability interval
+RUNTIME_CI_WIDTH = 1e-2     # full width of the runtime interval, relative to the mean runtime
 
-def num_qubit_sim():
+@dataclasses.dataclass
+class Job:
+    experiment: str         # num_qubit, err_rate, trap_size, sched
+    label: str              # e.g. qft(8)_af(1) with qec
+    env: {str: str}         # simulator flags on top of os.environ
+    input_path: str
+    output_path: str
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join('data', 'log', self.experiment, Path(self.output_path).stem + '.log')
+
+def circuit_jobs(experiment: str, exp, num_qubit: int, approx_factor: int, flags: {str: str},
+                 output_dir: str, suffix: str = '', qec: bool = True, noqec: bool = True) -> [Job]:
+    """ qec / no qec jobs of one circuit of an Experiment """
+    jobs = []
+    for variant, used in (('qec', qec), ('noqec', noqec)):
+        if not used:
+            continue
+        filename = f'{exp.algorithm}({num_qubit})_af({approx_factor})_{variant}'
+        env = dict(flags)
+        env['QEC' if variant=='qec' else 'NO_QEC'] = 'True'
+        jobs.append(Job(experiment, "%s(%d)_af(%d) %s"%(exp.algorithm, num_qubit, approx_factor,
+                                                        'with qec' if variant=='qec' else 'without qec'),
+                        env, f'circuit/{filename}.txt', f'{output_dir}/{filename}{suffix}.txt'))
+    return jobs
+
+def num_qubit_jobs() -> [Job]:
+    jobs = []
     for exp in num_qubit_exp:
         for num_qubit, approx_factor in exp.num_qubits:
-            filename_qec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_qec'
-            filename_noqec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_noqec'
-
-            ### qec
-            my_env = os.environ.copy()
-            my_env['TRAP_SIZE'] = str(exp.trap_size)
-            my_env['INDIV_EXP'] = 'True'
-            my_env['NUM_ITER'] = str(NUM_ITER)
-            my_env['QEC'] = 'True'
-            with open(f'circuit/{filename_qec}.txt', 'r') as f1:
-                with open(f'data/num_qubit/{filename_qec}.txt', 'w') as f2:
-                    print("%s Start num_qubit %s(%d)_af(%d) with qec"%\
-                          (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                    subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                    print("%s Finish num_qubit %s(%d)_af(%d) with qec"%\
-                          (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-            ### no qec
-            my_env = os.environ.copy()
-            my_env['TRAP_SIZE'] = str(exp.trap_size)
-            my_env['INDIV_EXP'] = 'True'
-            my_env['NUM_ITER'] = str(NUM_ITER)
-            my_env['NO_QEC'] = 'True'
-            with open(f'circuit/{filename_noqec}.txt', 'r') as f1:
-                with open(f'data/num_qubit/{filename_noqec}.txt', 'w') as f2:
-                    print("%s Start num_qubit %s(%d)_af(%d) without qec"%\
-                          (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                    subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                    print("%s Finish num_qubit %s(%d)_af(%d) without qec"%\
-                          (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-def error_rate_sim():
+            flags = {'TRAP_SIZE': str(exp.trap_size), 'INDIV_EXP': 'True', 'NUM_ITER': str(NUM_ITER)}
+            jobs += circuit_jobs('num_qubit', exp, num_qubit, approx_factor, flags, 'data/num_qubit')
+    return jobs
+
+def error_rate_jobs() -> [Job]:
+    jobs = []
     for exp in error_rate_exp:
         num_qubit, approx_factor = exp.num_qubits[0]
-        filename_qec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_qec'
-        filename_noqec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_noqec'
+        flags = {'TRAP_SIZE': str(exp.trap_size), 'RATE_EXP': 'True', 'NUM_ITER': str(NUM_ITER)}
+        jobs += circuit_jobs('err_rate', exp, num_qubit, approx_factor, flags, 'data/error_rate', '_er')
+    return jobs
 
-        ### qec
-        my_env = os.environ.copy()
-        my_env['TRAP_SIZE'] = str(exp.trap_size)
-        my_env['RATE_EXP'] = 'True'
-        my_env['NUM_ITER'] = str(NUM_ITER)
-        my_env['QEC'] = 'True'
-        with open(f'circuit/{filename_qec}.txt', 'r') as f1:
-            with open(f'data/error_rate/{filename_qec}_er.txt', 'w') as f2:
-                print("%s Start err_rate %s(%d)_af(%d) with qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"),exp.algorithm, num_qubit, approx_factor))
-                subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                print("%s Finish err_rate %s(%d)_af(%d) with qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-        ### no qec
-        my_env = os.environ.copy()
-        my_env['TRAP_SIZE'] = str(exp.trap_size)
-        my_env['RATE_EXP'] = 'True'
-        my_env['NUM_ITER'] = str(NUM_ITER)
-        my_env['NO_QEC'] = 'True'
-        with open(f'circuit/{filename_noqec}.txt', 'r') as f1:
-            with open(f'data/error_rate/{filename_noqec}_er.txt', 'w') as f2:
-                print("%s Start err_rate %s(%d)_af(%d) without qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                print("%s Finish err_rate %s(%d)_af(%d) without qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-def trap_size_sim():
+def trap_size_jobs() -> [Job]:
+    jobs = []
     for exp in trap_size_exp:
         num_qubit, approx_factor = exp.num_qubits[0]
-        filename_qec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_qec'
-        filename_noqec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_noqec'
+        flags = {'SIZE_EXP': 'True', 'NUM_ITER': str(NUM_ITER)}
+        jobs += circuit_jobs('trap_size', exp, num_qubit, approx_factor, flags, 'data/trap_size', '_ss')
+    return jobs
 
-        ### qec
-        my_env = os.environ.copy()
-        my_env['SIZE_EXP'] = 'True'
-        my_env['NUM_ITER'] = str(NUM_ITER)
-        my_env['QEC'] = 'True'
-        with open(f'circuit/{filename_qec}.txt', 'r') as f1:
-            with open(f'data/trap_size/{filename_qec}_ss.txt', 'w') as f2:
-                print("%s Start trap_size %s(%d)_af(%d) with qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                print("%s Finish trap_size %s(%d)_af(%d) with qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-        ### no qec
-        my_env = os.environ.copy()
-        my_env['SIZE_EXP'] = 'True'
-        my_env['NUM_ITER'] = str(NUM_ITER)
-        my_env['NO_QEC'] = 'True'
-        with open(f'circuit/{filename_noqec}.txt', 'r') as f1:
-            with open(f'data/trap_size/{filename_noqec}_ss.txt', 'w') as f2:
-                print("%s Start trap_size %s(%d)_af(%d) without qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                print("%s Finish trap_size %s(%d)_af(%d) without qec"%\
-                      (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-
-def sched_sim():
+def sched_jobs() -> [Job]:
+    jobs = []
     for exp in sched_exp:
         num_qubit, approx_factor = exp.num_qubits[0]
-        trap_size = str(exp.trap_size)
-        filename_qec = f'{exp.algorithm}({num_qubit})_af({approx_factor})_qec'
+        flags = {'TRAP_SIZE': str(exp.trap_size), 'SCHED_EXP': 'True'}
+        jobs += circuit_jobs('sched', exp, num_qubit, approx_factor, flags, 'data/sched',
+                             f'_sched_ss{exp.trap_size}', noqec=False)
+    return jobs
+
+def file_hash(path: str) -> str:
+    """ sha256 of a file, None if it does not exist """
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+'''
+    JSON manifest of the jobs, keyed by output path.
+    A job is complete only if its record is done, was made from the same input, flags and simulator binary,
+    and its output is still the file that was written then; any other job is (re)run.
+'''
+class Manifest:
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.binary_hash = file_hash(_executable)
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.records = json.load(f)
+
+    def inputs(self, job: Job) -> dict:
+        return {'input_path': job.input_path, 'input_hash': file_hash(job.input_path),
+                'env': job.env, 'binary_hash': self.binary_hash}
+
+    def is_done(self, job: Job) -> bool:
+        record = self.records.get(job.output_path)
+        if record==None or record['status']!='done' or not os.path.isfile(job.output_path):
+            return False
+        for field, value in self.inputs(job).items():
+            if record[field]!=value:
+                return False
+        return record['output_hash']==file_hash(job.output_path)
 
-        ### qec
+    def update(self, job: Job, status: str, **fields):
+        record = {'experiment': job.experiment, 'label': job.label, 'output_path': job.output_path,
+                  'status': status, 'updated': datetime.datetime.today().isoformat(timespec='seconds')}
+        record.update(self.inputs(job))
+        record.update(fields)
+        with self.lock:
+            self.records[job.output_path] = record
+            tmp_path = "%s.%d.tmp"%(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.records, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+def report(message: str):
+    """ Print a line with a single write, so that lines of concurrent jobs do not interleave """
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+
+def run_job(job: Job, num_threads: int, manifest: Manifest) -> (float, int):
+    """ Run the simulator on one job, retrying up to MAX_RETRY times.
+        Returns the wall time of the successful attempt and the number of attempts """
+    my_env = os.environ.copy()
+    my_env.update(job.env)
+    ### Jobs run side by side, so each simulator only gets its share of the cores
+    my_env.setdefault('RAYON_NUM_THREADS', str(num_threads))
+
+    os.makedirs(os.path.dirname(job.log_path), exist_ok=True)
+    tmp_output_path = "%s.%d.tmp"%(job.output_path, os.getpid())
+    attempt = 0
+    try:
+        manifest.update(job, 'running')
+        for attempt in range(1, MAX_RETRY+2):
+            report("%s Start %s %s (attempt %d)"%\
+                   (datetime.datetime.today().strftime("[%H:%M:%S]"), job.experiment, job.label, attempt))
+            start = time.perf_counter()
+            with open(job.input_path, 'r') as f1, open(tmp_output_path, 'w') as f2, open(job.log_path, 'a') as log:
+                log.write("%s attempt %d\n"%(datetime.datetime.today().strftime("[%H:%M:%S]"), attempt))
+                log.flush()
+                result = subprocess.run(_executable, stdin=f1, stdout=f2, stderr=log, env=my_env)
+            elapsed = time.perf_counter() - start
+            if result.returncode==0:
+                ### Only finished outputs ever appear under their final name
+                os.replace(tmp_output_path, job.output_path)
+                manifest.update(job, 'done', output_hash=file_hash(job.output_path), attempts=attempt, wall_time=elapsed)
+                report("%s Finish %s %s in %.2fs"%\
+                       (datetime.datetime.today().strftime("[%H:%M:%S]"), job.experiment, job.label, elapsed))
+                return elapsed, attempt
+            report("%s Failed %s %s with exit code %d, see %s"%\
+                   (datetime.datetime.today().strftime("[%H:%M:%S]"), job.experiment, job.label, result.returncode, job.log_path))
+    except BaseException:
+        ### e.g. a missing input or simulator, so the job is not left 'running' in the manifest
+        manifest.update(job, 'failed', attempts=attempt)
+        raise
+    finally:
+        if os.path.exists(tmp_output_path):
+            os.remove(tmp_output_path)
+
+    manifest.update(job, 'failed', attempts=MAX_RETRY+1)
+    raise Exception(f'%s %s failed %d times'%(job.experiment, job.label, MAX_RETRY+1))
+
+def run_jobs(jobs: [Job], num_workers: int = os.cpu_count(), resume: bool = True):
+    """ Run the jobs on a bounded pool of concurrent simulator processes, then print a summary table.
+        With resume, jobs already complete in the manifest are skipped """
+    manifest = Manifest()
+    results = {}
+    pending = []
+    for job in jobs:
+        if resume and manifest.is_done(job):
+            results[id(job)] = None
+            report("%s Skip %s %s, already done"%\
+                   (datetime.datetime.today().strftime("[%H:%M:%S]"), job.experiment, job.label))
+        else:
+            pending.append(job)
+
+    num_workers = max(1, min(num_workers, len(pending)))
+    num_threads = max(1, os.cpu_count()//num_workers)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(run_job, job, num_threads, manifest): job for job in pending}
+        for future in as_completed(futures):
+            try:
+                results[id(futures[future])] = future.result()
+            except Exception as error:
+                results[id(futures[future])] = error
+
+    print("%-10s %-32s %-8s %8s %10s"%('experiment', 'job', 'status', 'attempts', 'wall time'))
+    failed = 0
+    for job in jobs:
+        result = results[id(job)]
+        if result==None:
+            print("%-10s %-32s %-8s %8s %10s"%(job.experiment, job.label, 'skipped', '-', '-'))
+        elif isinstance(result, Exception):
+            failed += 1
+            print("%-10s %-32s %-8s %8d %10s"%(job.experiment, job.label, 'failed', MAX_RETRY+1, '-'))
+        else:
+            elapsed, attempts = result
+            print("%-10s %-32s %-8s %8d %9.2fs"%(job.experiment, job.label, 'done', attempts, elapsed))
+    if failed:
+        raise Exception(f'%d of %d jobs failed'%(failed, len(jobs)))
+
+'''
+    Client of a long-lived simulator started with WORKER (src/worker.rs).
+    The worker keeps each circuit parsed in memory, keyed by the hash of its file content,
+    so a sweep over schedulers, codes, sector sizes and error rates parses every circuit once:
+        with SimWorker() as worker:
+            key = worker.load('circuit/qft(8)_af(1)_qec.txt')
+            result = worker.simulate(key, 'ntcf', sector_size=4, error_rates=[1e-4, 2e-4], iterations=10, code=(17, 1, 5))
+    Runtimes and success probabilities are already scaled by the approx_factor of the circuit, like the experiments.
+'''
+class SimWorker:
+    def __init__(self, env: {str: str} = None):
         my_env = os.environ.copy()
-        my_env['TRAP_SIZE'] = str(exp.trap_size)
-        my_env['SCHED_EXP'] = 'True'
-        with open(f'circuit/{filename_qec}.txt', 'r') as f1:
-            with open(f'data/sched/{filename_qec}_sched_ss{trap_size}.txt', 'w') as f2:
-                print("%s Start num_qubit %s(%d)_af(%d) with qec"%\
-                        (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
-                subprocess.run(_executable, stdin=f1, stdout=f2, env=my_env)
-                print("%s Finish num_qubit %s(%d)_af(%d) with qec"%\
-                        (datetime.datetime.today().strftime("[%H:%M:%S]"), exp.algorithm, num_qubit, approx_factor))
+        if env!=None:
+            my_env.update(env)
+        my_env['WORKER'] = 'True'
+        self.process = subprocess.Popen(_executable, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env=my_env, text=True, bufsize=1)
+
+    def request(self, **request) -> dict:
+        """ Send one request line and wait for its response line """
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception(f'Worker exited with code %s'%self.process.wait())
+        response = json.loads(line)
+        if not response['ok']:
+            raise Exception(f'Worker failed: %s'%response['error'])
+        return response
+
+    def load(self, path: str) -> str:
+        """ Key of the circuit file in the worker, parsed only if no file with the same content was loaded """
+        return self.request(op='load', path=os.path.abspath(path))['key']
+
+    def unload(self, key: str):
+        self.request(op='unload', key=key)
+
+    def constants(self) -> dict:
+        """ {'codes', 'code_times', 'empty_sector', 'error_rates'} of src/lib.rs, as the simulator was built """
+        response = self.request(op='constants')
+        del response['ok']
+        return response
+
+    def simulate(self, key: str, scheduler: str, sector_size: int, error_rates: [float], iterations: int = NUM_ITER,
+                 code: (int, int, int) = None, qec_time: int = None, empty_sector: int = None) -> dict:
+        """ Schedule the circuit iterations times with ntcf, mark or pmark and evaluate each schedule at the error rates.
+            code is needed by ntcf and mark, qec_time defaults to the QEC time of the code,
+            and empty_sector to the EMPTY_SECTOR of the simulator.
+            Returns {'runtimes': [per iteration], 'success_probs': [per iteration][per error rate]} """
+        request = {'op': 'simulate', 'key': key, 'scheduler': scheduler, 'sector_size': sector_size,
+                   'error_rates': list(error_rates), 'iterations': iterations}
+        if code!=None:
+            request['code'] = list(code)
+        if qec_time!=None:
+            request['qec_time'] = qec_time
+        if empty_sector!=None:
+            request['empty_sector'] = empty_sector
+        response = self.request(**request)
+        return {'runtimes': response['runtimes'], 'success_probs': response['success_probs']}
+
+    def close(self):
+        if self.process.poll()==None:
+            self.process.stdin.write(json.dumps({'op': 'quit'}) + "\n")
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RunningStats:
+    """ Running mean and sample variance (Welford) of per-iteration samples, elementwise over a list """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, sample: [float]):
+        self.count += 1
+        if self.mean==None:
+            self.mean, self.m2 = list(sample), [0.0]*len(sample)
+            return
+        for i, value in enumerate(sample):
+            delta = value - self.mean[i]
+            self.mean[i] += delta/self.count
+            self.m2[i] += delta*(value - self.mean[i])
+
+    @property
+    def variance(self) -> [float]:
+        return [m2/(self.count-1) if self.count>1 else math.inf for m2 in self.m2]
+
+    def ci_width(self) -> [float]:
+        """ Full width of the CI_Z confidence interval of each mean """
+        return [2.0*CI_Z*math.sqrt(variance/self.count) for variance in self.variance]
+
+@dataclasses.dataclass
+class SweepPoint:
+    label: str
+    input_path: str
+    scheduler: str              # ntcf, mark or pmark
+    sector_size: int
+    code: (int, int, int) = None
+    error_rates: [float] = dataclasses.field(default_factory=lambda: list(simulator_constants()['error_rates']))
+
+@functools.lru_cache(maxsize=None)
+def simulator_constants() -> dict:
+    """ SimWorker.constants, asked once of a short-lived worker so that sweeps use the simulator's own values """
+    with SimWorker() as worker:
+        return worker.constants()
+
+def error_rate_points() -> [SweepPoint]:
+    """ Sweep points of the error rate experiment: ntcf and mark with each code on the qec circuit,
+        pmark on the trap size and on a single long chain (100) on the noqec circuit """
+    codes = [tuple(code) for code in simulator_constants()['codes']]
+    points = []
+    for exp in error_rate_exp:
+        num_qubit, approx_factor = exp.num_qubits[0]
+        name = f'{exp.algorithm}({num_qubit})_af({approx_factor})'
+        for scheduler in ('ntcf', 'mark'):
+            for code in codes:
+                points.append(SweepPoint(f'{name} {scheduler} {code}', f'circuit/{name}_qec.txt', scheduler, exp.trap_size, code))
+        for sector_size in (exp.trap_size, 100):
+            points.append(SweepPoint(f'{name} pmark ss{sector_size}', f'circuit/{name}_noqec.txt', 'pmark', sector_size))
+    return points
+
+def run_point(point: SweepPoint, worker: SimWorker, prob_width: float, runtime_width: float) -> dict:
+    """ Iterate the sweep point by batches until its confidence intervals are narrow enough or MAX_ITER """
+    key = worker.load(point.input_path)
+    runtime, success_prob = RunningStats(), RunningStats()
+    converged = False
+    while not converged and runtime.count<MAX_ITER:
+        result = worker.simulate(key, point.scheduler, point.sector_size, point.error_rates,
+                                 min(ITER_BATCH, MAX_ITER-runtime.count), point.code)
+        for iter_runtime, iter_success_probs in zip(result['runtimes'], result['success_probs']):
+            runtime.add([iter_runtime])
+            success_prob.add(iter_success_probs)
+        converged = runtime.count>=MIN_ITER and max(success_prob.ci_width())<=prob_width \
+                    and runtime.ci_width()[0]<=runtime_width*runtime.mean[0]
+    return {'label': point.label, 'input_path': point.input_path, 'scheduler': point.scheduler,
+            'sector_size': point.sector_size, 'code': point.code, 'error_rates': point.error_rates,
+            'iterations': runtime.count, 'converged': converged,
+            'runtime_mean': runtime.mean[0], 'runtime_ci_width': runtime.ci_width()[0],
+            'success_prob_mean': success_prob.mean, 'success_prob_ci_width': success_prob.ci_width()}
+
+def adaptive_sweep(points: [SweepPoint], num_workers: int = os.cpu_count(), prob_width: float = PROB_CI_WIDTH,
+                   runtime_width: float = RUNTIME_CI_WIDTH, output_path: str = None) -> [dict]:
+    """ Run every sweep point on a pool of SimWorker processes, each point stopping on its own once converged,
+        then print a summary table and write the results to output_path as JSON """
+    ### Convergence is judged on the success probability of every error rate, so each point needs one
+    for point in points:
+        if len(point.error_rates)==0:
+            raise Exception(f'Sweep point %s has no error rate'%point.label)
+    ### Created before the sweep, so that the results cannot be lost after every point is simulated
+    if output_path!=None and os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    num_workers = max(1, min(num_workers, len(points)))
+    workers = queue.Queue()
+    for _ in range(num_workers):
+        workers.put(SimWorker())
+
+    def run(point: SweepPoint) -> dict:
+        worker = workers.get()
+        try:
+            report("%s Start %s"%(datetime.datetime.today().strftime("[%H:%M:%S]"), point.label))
+            start = time.perf_counter()
+            result = run_point(point, worker, prob_width, runtime_width)
+            result['wall_time'] = time.perf_counter() - start
+            report("%s Finish %s after %d iterations in %.2fs"%\
+                   (datetime.datetime.today().strftime("[%H:%M:%S]"), point.label, result['iterations'], result['wall_time']))
+            return result
+        finally:
+            workers.put(worker)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(run, points))
+    finally:
+        while not workers.empty():
+            workers.get().close()
+
+    print("%-40s %10s %9s %14s %12s"%('point', 'iterations', 'converged', 'runtime', 'prob CI'))
+    for result in results:
+        print("%-40s %10d %9s %14s %12.2e"%(result['label'], result['iterations'], result['converged'],
+                                           "%.0f±%.0f"%(result['runtime_mean'], result['runtime_ci_width']/2),
+                                           max(result['success_prob_ci_width'])))
+    if output_path!=None:
+        tmp_path = "%s.%d.tmp"%(output_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        os.replace(tmp_path, output_path)
+    return results
+
+def num_qubit_sim(num_workers: int = os.cpu_count(), resume: bool = True):
+    run_jobs(num_qubit_jobs(), num_workers, resume)
+
+def error_rate_sim(num_workers: int = os.cpu_count(), resume: bool = True):
+    run_jobs(error_rate_jobs(), num_workers, resume)
+
+def trap_size_sim(num_workers: int = os.cpu_count(), resume: bool = True):
+    run_jobs(trap_size_jobs(), num_workers, resume)
+
+def sched_sim(num_workers: int = os.cpu_count(), resume: bool = True):
+    run_jobs(sched_jobs(), num_workers, resume)
 
 if __name__ == '__main__':
+    ### python runner.py <er|ts|qn|sched|er_adaptive> [num_workers], every core by default
+    ### Jobs complete in data/manifest.json are skipped, set NO_RESUME to rerun them all
+    ### er_adaptive iterates each point of the error rate experiment until converged, see adaptive_sweep
     exp_name = sys.argv[1]
+    num_workers = int(sys.argv[2]) if len(sys.argv)>2 else os.cpu_count()
+    resume = not os.environ.get('NO_RESUME')
     if exp_name=='er':
-        error_rate_sim()
+        error_rate_sim(num_workers, resume)
     elif exp_name=='ts':
-        trap_size_sim()
+        trap_size_sim(num_workers, resume)
     elif exp_name=='qn':
-        num_qubit_sim()
+        num_qubit_sim(num_workers, resume)
     elif exp_name=="sched":
-        sched_sim()
+        sched_sim(num_workers, resume)
+    elif exp_name=='er_adaptive':
+        adaptive_sweep(error_rate_points(), num_workers, output_path=os.path.join('data', 'error_rate', 'adaptive.json'))
     else:
-        raise Exception(f'Invalid command %s - choose among er, ss, qn'%exp_name)
\ No newline at end of file
+        raise Exception(f'Invalid command %s - choose among er, ss, qn, sched, er_adaptive'%exp_name)
@@ -2,6 +2,13 @@ use std::collections::HashMap;
 use std::fmt::Write;
 use crate::circuit::NodeType::H;
 
+pub const NATIVE_MAGIC: &[u8] = b"QCB\x01";
+pub const NATIVE_GPI: u8 = 0;
+pub const NATIVE_GPI2: u8 = 1;
+pub const NATIVE_RZ: u8 = 2;
+pub const NATIVE_RZ_DEPTH: u8 = 3;
+pub const NATIVE_MS: u8 = 4;
+
 #[derive(Clone)]
 pub struct Circuit {
     pub qubits: Vec<Vec<u8>>,
@@ -77,13 +84,14 @@ impl Circuit {
         let mut cx = HashMap::new();
         let mut depths = HashMap::new();
         for line in lines {
-            let parts: Vec<&str> = line.split_whitespace().collect();
-            let target: usize = parts[1].parse().unwrap();
-            match parts[0] {
+            let mut parts = line.split_ascii_whitespace();
+            let name = parts.next().unwrap();
+            let target: usize = parts.next().unwrap().parse().unwrap();
+            match name {
                 "gpi" => qubits[target].push(b'g'),
                 "gpi2" => qubits[target].push(b'p'),
                 "rz" => {
-                    match parts.get(2) {
+                    match parts.next() {
                         Some(depth) => {
                             let depth = depth.parse().unwrap();
                             depths.insert((target, qubits[target].len()), depth);
@@ -95,7 +103,7 @@ impl Circuit {
                     }
                 }
                 "ms" => {
-                    let target2: usize = parts[2].parse().unwrap();
+                    let target2: usize = parts.next().unwrap().parse().unwrap();
                     cx.insert((target, qubits[target].len()), (target2, qubits[target2].len()));
                     cx.insert((target2, qubits[target2].len()), (target, qubits[target].len()));
                     qubits[target].push(b'm');
@@ -107,6 +115,92 @@ impl Circuit {
         Self { qubits, cx, parameters: vec![], depths, approx_factor }
     }
 
+    /// Binary native circuit written by Circuit.circuit_to_txt for a BINARY_EXT path (Circuit.py).
+    /// Little-endian: NATIVE_MAGIC, u32 num_qubits, u32 approx_factor, then per gate
+    /// a u8 code followed by a u32 qubit, and a u32 second qubit for ms or a u16 depth for rz with depth.
+    /// A truncated or corrupt input is an error naming the byte where it goes wrong
+    pub fn from_bytes_native(input: &[u8]) -> Result<Self, String> {
+        if !input.starts_with(NATIVE_MAGIC) {
+            return Err("Not a binary native circuit".to_string());
+        }
+        if input.len() < 12 {
+            return Err(format!("Truncated header: {} bytes, 12 needed", input.len()));
+        }
+        let read_u32 = |pos: usize| u32::from_le_bytes(input[pos..pos + 4].try_into().unwrap()) as usize;
+        let num_qubits = read_u32(4);
+        let mut circuit = Self::new(num_qubits);
+        circuit.approx_factor = read_u32(8);
+        let mut pos = 12;
+        while pos < input.len() {
+            let code = input[pos];
+            let record_len = match code {
+                NATIVE_GPI | NATIVE_GPI2 | NATIVE_RZ => 5,
+                NATIVE_RZ_DEPTH => 7,
+                NATIVE_MS => 9,
+                code => return Err(format!("Unknown gate code {} at byte {}", code, pos))
+            };
+            if pos + record_len > input.len() {
+                return Err(format!("Truncated gate at byte {}: {} bytes left, {} needed",
+                                   pos, input.len() - pos, record_len));
+            }
+            let target = read_u32(pos + 1);
+            let arg = match code {
+                NATIVE_RZ_DEPTH => u16::from_le_bytes([input[pos + 5], input[pos + 6]]) as usize,
+                NATIVE_MS => read_u32(pos + 5),
+                _ => 0
+            };
+            if target >= num_qubits || (code == NATIVE_MS && arg >= num_qubits) {
+                return Err(format!("Gate at byte {} on a qubit out of the {} qubits", pos, num_qubits));
+            }
+            circuit.push_native(code, target, arg);
+            pos += record_len;
+        }
+        Ok(circuit)
+    }
+
+    /// Native circuit given as one NATIVE_* code, qubit and argument per gate,
+    /// the argument being the second qubit of ms or the depth of rz with depth (ignored otherwise)
+    pub fn from_gates(num_qubits: usize, approx_factor: usize, codes: &[u8], targets: &[u32], args: &[i64]) -> Self {
+        assert!(codes.len() == targets.len() && codes.len() == args.len(), "Gate arrays of different lengths");
+        let mut circuit = Self::new(num_qubits);
+        circuit.approx_factor = approx_factor;
+        for ((&code, &target), &arg) in codes.iter().zip(targets).zip(args) {
+            circuit.push_native(code, target as usize, arg.max(0) as usize);
+        }
+        circuit
+    }
+
+    fn push_native(&mut self, code: u8, target: usize, arg: usize) {
+        match code {
+            NATIVE_GPI => self.qubits[target].push(b'g'),
+            NATIVE_GPI2 => self.qubits[target].push(b'p'),
+            NATIVE_RZ => self.qubits[target].push(b'r'), // NO-QEC
+            NATIVE_RZ_DEPTH => {
+                self.depths.insert((target, self.qubits[target].len()), arg);
+                self.qubits[target].push(b'r');
+            }
+            NATIVE_MS => {
+                let target2 = arg;
+                self.cx.insert((target, self.qubits[target].len()), (target2, self.qubits[target2].len()));
+                self.cx.insert((target2, self.qubits[target2].len()), (target, self.qubits[target].len()));
+                self.qubits[target].push(b'm');
+                self.qubits[target2].push(b'm');
+            }
+            code => panic!("Unknown gate code: {}", code)
+        }
+    }
+
+    /// Parse a native circuit in either format, binary ones start with NATIVE_MAGIC.
+    /// Invalid binary input is an error; invalid text still panics in from_str_native
+    pub fn from_native(input: &[u8]) -> Result<Self, String> {
+        if input.starts_with(NATIVE_MAGIC) {
+            Self::from_bytes_native(input)
+        } else {
+            let input = std::str::from_utf8(input).map_err(|error| format!("Not a native circuit: {}", error))?;
+            Ok(Self::from_str_native(input))
+        }
+    }
+
     pub fn into_str(&self) -> String {
         let mut ret = format!("{}\n", self.qubits.len());
         let mut pos = vec![0; self.qubits.len()];
@@ -214,4 +308,44 @@ mod tests {
         assert_eq!(circuit.qubits[0][0], b'r');
         assert_eq!(circuit.parameters[0], 2.0);
     }
+
+    #[test]
+    fn test_binary_native() {
+        let text = Circuit::from_str_native("3 2\ngpi 0\nms 0 2\nrz 2 4\ngpi2 1\nrz 1");
+        let mut bytes = NATIVE_MAGIC.to_vec();
+        for value in [3u32, 2] {
+            bytes.extend(value.to_le_bytes());
+        }
+        bytes.push(NATIVE_GPI);
+        bytes.extend(0u32.to_le_bytes());
+        bytes.push(NATIVE_MS);
+        bytes.extend(0u32.to_le_bytes());
+        bytes.extend(2u32.to_le_bytes());
+        bytes.push(NATIVE_RZ_DEPTH);
+        bytes.extend(2u32.to_le_bytes());
+        bytes.extend(4u16.to_le_bytes());
+        bytes.push(NATIVE_GPI2);
+        bytes.extend(1u32.to_le_bytes());
+        bytes.push(NATIVE_RZ);
+        bytes.extend(1u32.to_le_bytes());
+        let binary = Circuit::from_native(&bytes).unwrap();
+        assert_eq!(binary.approx_factor, 2);
+        assert_eq!(binary.qubits, text.qubits);
+        assert_eq!(binary.cx, text.cx);
+        assert_eq!(binary.depths, text.depths);
+        assert_eq!(binary.qubits[2], vec![b'm', b'r']);
+        assert_eq!(binary.depths[&(2, 1)], 4);
+
+        // Every truncation fails instead of reading past the end, except at a gate boundary
+        for len in 0..bytes.len() {
+            let boundary = [12, 17, 26, 33, 38].contains(&len);
+            assert_eq!(Circuit::from_bytes_native(&bytes[..len]).is_ok(), boundary, "{} bytes", len);
+        }
+        let mut corrupt = bytes.clone();
+        corrupt[17] = 9;
+        assert_eq!(Circuit::from_native(&corrupt).err().unwrap(), "Unknown gate code 9 at byte 17");
+        let mut corrupt = bytes.clone();
+        corrupt[22] = 3;
+        assert!(Circuit::from_native(&corrupt).err().unwrap().contains("out of the 3 qubits"));
+    }
 }
\ No newline at end of file
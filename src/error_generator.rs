@@ -12,6 +12,7 @@ pub fn generate_error_depol(sched: &Schedule, code: (usize, usize, usize), two_q
     let mut binom = Binom::new();
 
     let one_qubit_error = two_qubit_error * SQ_ERR;
+    let ms_error = two_qubit_error * TQ_ERR;
     let swap_error = two_qubit_error * SWAP_ERR;
     let shuttle_error = two_qubit_error * SHUTTLE_ERR;
     let measure_error = two_qubit_error * MEASURE_ERR;
@@ -30,7 +31,7 @@ pub fn generate_error_depol(sched: &Schedule, code: (usize, usize, usize), two_q
                     error_prob = error_prob + one_qubit_error - 4.0*one_qubit_error*error_prob/3.0;
                 }
                 "m" => { // MS
-                    error_prob = error_prob + two_qubit_error*4.0/5.0 - 16.0*two_qubit_error*error_prob/15.0;
+                    error_prob = error_prob + ms_error*4.0/5.0 - 16.0*ms_error*error_prob/15.0;
                 }
                 "s" => { // Swap
                     error_prob = error_prob + swap_error*4.0/5.0 - 16.0*swap_error*error_prob/15.0;
@@ -71,6 +72,7 @@ pub fn overhead_cnt(sched: &Schedule, code: (usize, usize, usize), two_qubit_err
     let mut binom = Binom::new();
 
     let one_qubit_error = two_qubit_error * SQ_ERR;
+    let ms_error = two_qubit_error * TQ_ERR;
     let swap_error = two_qubit_error * SWAP_ERR;
     let shuttle_error = two_qubit_error * SHUTTLE_ERR;
     let measure_error = two_qubit_error * MEASURE_ERR;
@@ -113,7 +115,7 @@ pub fn overhead_cnt(sched: &Schedule, code: (usize, usize, usize), two_qubit_err
                     interqec_count += 1;
                 }
                 "m" => { // MS
-                    error_prob = error_prob + two_qubit_error*4.0/5.0 - 16.0*two_qubit_error*error_prob/15.0;
+                    error_prob = error_prob + ms_error*4.0/5.0 - 16.0*ms_error*error_prob/15.0;
                     interqec_count += 1;
                 }
                 "s" => { // Swap
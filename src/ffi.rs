@@ -0,0 +1,277 @@
+//! C interface of the scheduler and error generator, loaded in-process by QeccLib.py.
+//! Circuits and schedules are handed out as opaque pointers, freed by their *_free function.
+//! A panic (invalid circuit, ...) is caught and reported as a null pointer / NaN instead of unwinding into C.
+use std::panic::{catch_unwind, AssertUnwindSafe};
+use std::ptr::null_mut;
+use std::slice;
+use crate::circuit::Circuit;
+use crate::schedule::{self, Schedule};
+use crate::error_generator::generate_error_depol;
+use crate::{error_rate_ticks, CODES, CODE_TIMES, EMPTY_SECTOR, TQ_TIME};
+use crate::{SQ_ERR, TQ_ERR, SWAP_ERR, SHUTTLE_ERR, MEASURE_ERR, QEC_ERR};
+
+pub const SCHED_NTCF: u32 = 0;
+pub const SCHED_MARK: u32 = 1;
+pub const SCHED_PMARK: u32 = 2;
+
+unsafe fn slice_of<'a, T>(ptr: *const T, len: usize) -> &'a [T] {
+    if len == 0 { &[] } else { slice::from_raw_parts(ptr, len) }
+}
+
+unsafe fn slice_of_mut<'a, T>(ptr: *mut T, len: usize) -> &'a mut [T] {
+    if len == 0 { &mut [] } else { slice::from_raw_parts_mut(ptr, len) }
+}
+
+/// Constants of src/lib.rs, read by QeccLib.py when it loads the library so that they cannot drift from the simulator
+#[no_mangle]
+pub extern "C" fn qecc_tq_time() -> usize {
+    TQ_TIME
+}
+
+#[no_mangle]
+pub extern "C" fn qecc_empty_sector() -> usize {
+    EMPTY_SECTOR
+}
+
+#[no_mangle]
+pub extern "C" fn qecc_num_codes() -> usize {
+    CODES.len()
+}
+
+/// Gate error weights relative to the two-qubit error rate, written to weights as
+/// SQ_ERR, TQ_ERR, SWAP_ERR, SHUTTLE_ERR, MEASURE_ERR, QEC_ERR
+#[no_mangle]
+pub unsafe extern "C" fn qecc_error_weights(weights: *mut f64) {
+    slice_of_mut(weights, 6).copy_from_slice(&[SQ_ERR, TQ_ERR, SWAP_ERR, SHUTTLE_ERR, MEASURE_ERR, QEC_ERR]);
+}
+
+#[no_mangle]
+pub extern "C" fn qecc_num_error_rate_ticks() -> usize {
+    error_rate_ticks().len()
+}
+
+/// Two-qubit error rates of the error rate experiment, written to error_rates (qecc_num_error_rate_ticks entries)
+#[no_mangle]
+pub unsafe extern "C" fn qecc_error_rate_ticks(error_rates: *mut f64) {
+    let ticks = error_rate_ticks();
+    slice_of_mut(error_rates, ticks.len()).copy_from_slice(&ticks);
+}
+
+/// (n, k, d) of the index-th code of CODES written to code (3 entries) and its QEC time to qec_time,
+/// false if there is no such code
+#[no_mangle]
+pub unsafe extern "C" fn qecc_code(index: usize, code: *mut usize, qec_time: *mut usize) -> bool {
+    if index >= CODES.len() {
+        return false;
+    }
+    let (n, k, d) = CODES[index];
+    slice_of_mut(code, 3).copy_from_slice(&[n, k, d]);
+    *qec_time = CODE_TIMES[index];
+    true
+}
+
+/// Circuit of num_gates gates given as arrays, see Circuit::from_gates
+#[no_mangle]
+pub unsafe extern "C" fn qecc_circuit_from_gates(num_qubits: usize, approx_factor: usize, codes: *const u8,
+                                                 targets: *const u32, args: *const i64, num_gates: usize) -> *mut Circuit {
+    let (codes, targets, args) = (slice_of(codes, num_gates), slice_of(targets, num_gates), slice_of(args, num_gates));
+    match catch_unwind(|| Circuit::from_gates(num_qubits, approx_factor, codes, targets, args)) {
+        Ok(circuit) => Box::into_raw(Box::new(circuit)),
+        Err(_) => null_mut()
+    }
+}
+
+/// Circuit of a native circuit file content in either format, see Circuit::from_native.
+/// On failure null, with the reason written to error (error_len bytes, NUL terminated) unless it is null
+#[no_mangle]
+pub unsafe extern "C" fn qecc_circuit_from_native(input: *const u8, len: usize, error: *mut u8, error_len: usize) -> *mut Circuit {
+    let input = slice_of(input, len);
+    let message = match catch_unwind(|| Circuit::from_native(input)) {
+        Ok(Ok(circuit)) => return Box::into_raw(Box::new(circuit)),
+        Ok(Err(message)) => message,
+        Err(_) => "Invalid native circuit".to_string()
+    };
+    if !error.is_null() && error_len > 0 {
+        let error = slice_of_mut(error, error_len);
+        let len = message.len().min(error_len - 1);
+        error[..len].copy_from_slice(&message.as_bytes()[..len]);
+        error[len] = 0;
+    }
+    null_mut()
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_circuit_free(circuit: *mut Circuit) {
+    if !circuit.is_null() {
+        drop(Box::from_raw(circuit));
+    }
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_circuit_num_qubits(circuit: *const Circuit) -> usize {
+    (*circuit).qubits.len()
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_circuit_approx_factor(circuit: *const Circuit) -> usize {
+    (*circuit).approx_factor
+}
+
+/// Schedule the circuit with one of SCHED_*, writing its runtime to runtime.
+/// qec_time is ignored by pmark, which schedules circuits without QEC
+#[no_mangle]
+pub unsafe extern "C" fn qecc_schedule(circuit: *const Circuit, scheduler: u32, sector_size: usize, empty_sector: usize,
+                                       qec_time: usize, runtime: *mut usize) -> *mut Schedule {
+    let circuit = &*circuit;
+    let result = catch_unwind(AssertUnwindSafe(|| match scheduler {
+        SCHED_NTCF => schedule::ntcf_scheduler(circuit, sector_size, empty_sector, qec_time),
+        SCHED_MARK => schedule::mark_scheduler(circuit, sector_size, empty_sector, qec_time),
+        SCHED_PMARK => schedule::pmark_scheduler(circuit, sector_size, empty_sector),
+        scheduler => panic!("Unknown scheduler: {}", scheduler)
+    }));
+    match result {
+        Ok((sched, sched_runtime)) => {
+            *runtime = sched_runtime;
+            Box::into_raw(Box::new(sched))
+        }
+        Err(_) => null_mut()
+    }
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_schedule_free(sched: *mut Schedule) {
+    if !sched.is_null() {
+        drop(Box::from_raw(sched));
+    }
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_schedule_num_qubits(sched: *const Schedule) -> usize {
+    (*sched).qubits.len()
+}
+
+#[no_mangle]
+pub unsafe extern "C" fn qecc_schedule_num_gates(sched: *const Schedule) -> usize {
+    (*sched).qubits.iter().map(|qubit| qubit.len()).sum()
+}
+
+/// Flatten the schedule qubit by qubit: offsets (num_qubits+1 entries) delimit the gates of each qubit in
+/// gates (the ASCII letter of each scheduled gate) and timestamps (num_gates entries each)
+#[no_mangle]
+pub unsafe extern "C" fn qecc_schedule_export(sched: *const Schedule, offsets: *mut usize, gates: *mut u8, timestamps: *mut u64) {
+    let sched = &*sched;
+    let num_gates = qecc_schedule_num_gates(sched);
+    let offsets = slice_of_mut(offsets, sched.qubits.len() + 1);
+    let gates = slice_of_mut(gates, num_gates);
+    let timestamps = slice_of_mut(timestamps, num_gates);
+    let mut pos = 0;
+    for (qubit_index, (qubit, timestamp)) in sched.qubits.iter().zip(&sched.timestamp).enumerate() {
+        offsets[qubit_index] = pos;
+        for (gate, &time) in qubit.iter().zip(timestamp) {
+            gates[pos] = gate.as_bytes()[0];
+            timestamps[pos] = time as u64;
+            pos += 1;
+        }
+    }
+    offsets[sched.qubits.len()] = pos;
+}
+
+/// generate_error_depol of the schedule for each of the num_rates two-qubit error rates, written to success_probs.
+/// Returns false (NaN written) if the error model rejects the schedule
+#[no_mangle]
+pub unsafe extern "C" fn qecc_error_depol(sched: *const Schedule, code_n: usize, code_k: usize, code_d: usize,
+                                          two_qubit_errors: *const f64, num_rates: usize, success_probs: *mut f64) -> bool {
+    let sched = &*sched;
+    let two_qubit_errors = slice_of(two_qubit_errors, num_rates);
+    let success_probs = slice_of_mut(success_probs, num_rates);
+    let mut ok = true;
+    for (&two_qubit_error, success_prob) in two_qubit_errors.iter().zip(success_probs.iter_mut()) {
+        *success_prob = match catch_unwind(|| generate_error_depol(sched, (code_n, code_k, code_d), two_qubit_error)) {
+            Ok(prob) => prob,
+            Err(_) => {
+                ok = false;
+                f64::NAN
+            }
+        };
+    }
+    ok
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::circuit::{NATIVE_GPI, NATIVE_GPI2, NATIVE_MAGIC, NATIVE_MS, NATIVE_RZ_DEPTH};
+    use crate::{C7_CODE, C7_QECTIME};
+
+    #[test]
+    fn test_schedule_roundtrip() {
+        unsafe {
+            let codes = [NATIVE_GPI2, NATIVE_MS, NATIVE_RZ_DEPTH, NATIVE_GPI2];
+            let targets = [0u32, 0, 1, 1];
+            let args = [-1i64, 1, 2, -1];
+            let circuit = qecc_circuit_from_gates(2, 1, codes.as_ptr(), targets.as_ptr(), args.as_ptr(), codes.len());
+            assert!(!circuit.is_null());
+            assert_eq!(qecc_circuit_num_qubits(circuit), 2);
+
+            let mut runtime = 0;
+            let sched = qecc_schedule(circuit, SCHED_NTCF, 4, 3, C7_QECTIME, &mut runtime);
+            assert!(!sched.is_null());
+            let num_gates = qecc_schedule_num_gates(sched);
+            let mut offsets = vec![0; qecc_schedule_num_qubits(sched) + 1];
+            let mut gates = vec![0u8; num_gates];
+            let mut timestamps = vec![0u64; num_gates];
+            qecc_schedule_export(sched, offsets.as_mut_ptr(), gates.as_mut_ptr(), timestamps.as_mut_ptr());
+            assert_eq!(offsets[offsets.len() - 1], num_gates);
+            for qubit_index in 0..offsets.len() - 1 {
+                let qubit_timestamps = &timestamps[offsets[qubit_index]..offsets[qubit_index + 1]];
+                assert!(qubit_timestamps.windows(2).all(|pair| pair[0] <= pair[1]));
+            }
+
+            let rates = [0.0, 1e-4];
+            let mut probs = [0.0; 2];
+            assert!(qecc_error_depol(sched, C7_CODE.0, C7_CODE.1, C7_CODE.2, rates.as_ptr(), rates.len(), probs.as_mut_ptr()));
+            assert_eq!(probs[0], 1.0);
+            assert!(probs[1] < 1.0);
+
+            qecc_schedule_free(sched);
+            qecc_circuit_free(circuit);
+        }
+    }
+
+    #[test]
+    fn test_constants() {
+        unsafe {
+            assert_eq!(qecc_num_codes(), CODES.len());
+            let mut code = [0usize; 3];
+            let mut qec_time = 0;
+            assert!(qecc_code(0, code.as_mut_ptr(), &mut qec_time));
+            assert_eq!((code[0], code[1], code[2]), C7_CODE);
+            assert_eq!(qec_time, C7_QECTIME);
+            assert!(!qecc_code(CODES.len(), code.as_mut_ptr(), &mut qec_time));
+
+            let mut error_rates = vec![0.0; qecc_num_error_rate_ticks()];
+            qecc_error_rate_ticks(error_rates.as_mut_ptr());
+            assert_eq!(error_rates, error_rate_ticks());
+
+            let mut weights = [0.0; 6];
+            qecc_error_weights(weights.as_mut_ptr());
+            assert_eq!(weights, [SQ_ERR, TQ_ERR, SWAP_ERR, SHUTTLE_ERR, MEASURE_ERR, QEC_ERR]);
+        }
+    }
+
+    #[test]
+    fn test_circuit_from_native_error() {
+        unsafe {
+            let mut input = NATIVE_MAGIC.to_vec();
+            input.extend([1, 0, 0, 0, 1, 0, 0, 0, NATIVE_GPI, 0, 0]);
+            let mut error = [0xffu8; 16];
+            assert!(qecc_circuit_from_native(input.as_ptr(), input.len(), error.as_mut_ptr(), error.len()).is_null());
+            assert_eq!(&error[..], b"Truncated gate \0");
+            assert!(qecc_circuit_from_native(input.as_ptr(), input.len(), null_mut(), 0).is_null());
+
+            let circuit = qecc_circuit_from_native(input.as_ptr(), 12, error.as_mut_ptr(), error.len());
+            assert_eq!(qecc_circuit_num_qubits(circuit), 1);
+            qecc_circuit_free(circuit);
+        }
+    }
+}
@@ -1,12 +1,24 @@
 pub mod circuit;
 pub mod schedule;
 pub mod error_generator;
+pub mod ffi;
+pub mod worker;
 
 pub const SQ_TIME: usize = 1;
 pub const TQ_TIME: usize = 5;
 pub const SWAP_TIME: usize = 3*TQ_TIME;
 pub const SHUTTLE_TIME: usize = 15;
 pub const MEASURE_TIME: usize = 1;
+// Empty sectors kept free for shuttling by the schedulers
+pub const EMPTY_SECTOR: usize = 3;
+
+// Two-qubit error rates swept by the error rate experiment: 0, ERROR_RATE_STEP, ..., NUM_ERROR_RATE_TICKS*ERROR_RATE_STEP
+pub const ERROR_RATE_STEP: f64 = 5e-6;
+pub const NUM_ERROR_RATE_TICKS: usize = 26;
+
+pub fn error_rate_ticks() -> Vec<f64> {
+    (0..=NUM_ERROR_RATE_TICKS).map(|i| i as f64 * ERROR_RATE_STEP).collect()
+}
 
 pub const C7_QECTIME: usize = 5*TQ_TIME;
 pub const C7_CODE: (usize, usize, usize) = (7, 1, 3);
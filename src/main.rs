@@ -12,13 +12,19 @@ use rayon::prelude::*;
 use std::sync::{Arc, Mutex};
 
 fn main() {
+    // Serve line-delimited JSON queries on stdin/stdout instead of one experiment, see src/worker.rs
+    if env::var("WORKER").is_ok() {
+        qecc::worker::serve(io::stdin().lock(), io::stdout().lock());
+        return;
+    }
+
     let mut buf = vec![];
     io::stdin().lock().read_to_end(&mut buf).unwrap();
 
-    let mut circuit = Circuit::from_str_native(std::str::from_utf8(&buf).unwrap());
+    let mut circuit = Circuit::from_native(&buf).unwrap_or_else(|error| panic!("Invalid native circuit: {}", error));
 
 
-    let empty_sector = 3;
+    let empty_sector = EMPTY_SECTOR;
     let mut default_sector_size = 1;
     let default_error_rate = 1e-4;
 
@@ -115,8 +121,8 @@ fn main() {
 }
 
 fn error_rate_exp_qec(circuit: &Circuit, error_rate: f64, empty_sector: usize, default_sector_size: usize, num_iter: usize) {
-    let num_tick = 26;
-    let error_rates: Vec<_> = (0..=num_tick).map(|i| i as f64 * 5e-6).collect(); // (2e-5, 4e-5, ..., 5e-4)
+    let error_rates = error_rate_ticks();
+    let num_tick = error_rates.len() - 1;
     let mut mark_rate = vec![vec![Vec::new(); num_iter]; 3];
     let mut mark_runtime = vec![vec![Vec::new(); num_iter]; 3];
     let mut ntcf_rate = vec![vec![Vec::new(); num_iter]; 3];
@@ -169,8 +175,8 @@ fn error_rate_exp_qec(circuit: &Circuit, error_rate: f64, empty_sector: usize, d
 }
 
 fn error_rate_exp_noqec(no_qec_circuit: &Circuit, error_rate: f64, empty_sector: usize, default_sector_size: usize, num_iter: usize) {
-    let num_tick = 26;
-    let error_rates: Vec<_> = (0..=num_tick).map(|i| i as f64 * 5e-6).collect(); // (2e-5, 4e-5, ..., 5e-4)
+    let error_rates = error_rate_ticks();
+    let num_tick = error_rates.len() - 1;
     let mut no_qec_rate = vec![vec![]; num_iter];
     let mut no_qec_runtime = vec![vec![]; num_iter];
     let mut long_rate = vec![vec![]; num_iter];
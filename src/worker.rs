@@ -0,0 +1,182 @@
+//! Long-lived simulation worker (WORKER flag of main.rs), driven by SimWorker of runner.py.
+//! Reads one JSON request per line and writes one JSON response per line:
+//!   {"op": "load", "path": ...}  -> {"ok": true, "key": ..., "num_qubits": ..., "approx_factor": ..., "cached": ...}
+//!   {"op": "simulate", "key": ..., "scheduler": "ntcf" | "mark" | "pmark", "code": [n, k, d], "sector_size": ...,
+//!    "error_rates": [...], "iterations": ...}  -> {"ok": true, "runtimes": [...], "success_probs": [[...], ...]}
+//!   {"op": "constants"}  -> {"ok": true, "codes": [[n, k, d], ...], "code_times": [...], "empty_sector": ...,
+//!                            "error_rates": [...]}, the constants of src/lib.rs the simulator was built with
+//!   {"op": "unload", "key": ...}, {"op": "quit"}
+//! Circuits stay parsed in memory, keyed by the hash of their file content, so a file is parsed once
+//! however many queries use it. Failures answer {"ok": false, "error": ...} and the worker goes on.
+use std::collections::hash_map::DefaultHasher;
+use std::collections::HashMap;
+use std::hash::Hasher;
+use std::io::{BufRead, Write};
+use std::panic::{catch_unwind, AssertUnwindSafe};
+use serde::Deserialize;
+use serde_json::{json, Value};
+use crate::circuit::Circuit;
+use crate::error_generator::generate_error_depol;
+use crate::schedule;
+use crate::{error_rate_ticks, CODES, CODE_TIMES, EMPTY_SECTOR};
+
+const NO_QEC_CODE: (usize, usize, usize) = (1, 1, 1);
+
+#[derive(Deserialize)]
+#[serde(tag = "op", rename_all = "snake_case")]
+enum Request {
+    Load { path: String },
+    Simulate {
+        key: String,
+        scheduler: String,
+        #[serde(default)]
+        code: Option<(usize, usize, usize)>,
+        #[serde(default)]
+        qec_time: Option<usize>,
+        sector_size: usize,
+        #[serde(default)]
+        empty_sector: Option<usize>,
+        error_rates: Vec<f64>,
+        iterations: usize,
+    },
+    Constants,
+    Unload { key: String },
+    Quit,
+}
+
+fn content_key(content: &[u8]) -> String {
+    let mut hasher = DefaultHasher::new();
+    hasher.write(content);
+    format!("{:016x}-{}", hasher.finish(), content.len())
+}
+
+/// Runtimes and success probabilities (one row of error_rates per iteration) of a schedule,
+/// both scaled by approx_factor like the experiments of main.rs
+fn simulate(circuit: &Circuit, scheduler: &str, code: Option<(usize, usize, usize)>, qec_time: Option<usize>,
+            sector_size: usize, empty_sector: usize, error_rates: &[f64], iterations: usize) -> Result<Value, String> {
+    let code = match (scheduler, code) {
+        ("pmark", code) => code.unwrap_or(NO_QEC_CODE),
+        (_, Some(code)) => code,
+        (_, None) => return Err(format!("{} needs a code", scheduler))
+    };
+    let qec_time = match qec_time.or_else(|| CODES.iter().position(|&c| c == code).map(|i| CODE_TIMES[i])) {
+        Some(qec_time) => qec_time,
+        None if scheduler == "pmark" => 0,
+        None => return Err(format!("No QEC time for code {:?}", code))
+    };
+    let mut runtimes = Vec::with_capacity(iterations);
+    let mut success_probs = Vec::with_capacity(iterations);
+    for _ in 0..iterations {
+        let (sched, runtime) = match scheduler {
+            "ntcf" => schedule::ntcf_scheduler(circuit, sector_size, empty_sector, qec_time),
+            "mark" => schedule::mark_scheduler(circuit, sector_size, empty_sector, qec_time),
+            "pmark" => schedule::pmark_scheduler(circuit, sector_size, empty_sector),
+            scheduler => return Err(format!("Unknown scheduler {}", scheduler))
+        };
+        runtimes.push(runtime * circuit.approx_factor);
+        success_probs.push(error_rates.iter()
+            .map(|&error_rate| generate_error_depol(&sched, code, error_rate).powi(circuit.approx_factor as i32))
+            .collect::<Vec<_>>());
+    }
+    Ok(json!({"ok": true, "runtimes": runtimes, "success_probs": success_probs}))
+}
+
+fn handle(circuits: &mut HashMap<String, Circuit>, request: Request) -> Result<Value, String> {
+    match request {
+        Request::Load { path } => {
+            let content = std::fs::read(&path).map_err(|error| format!("Cannot read {}: {}", path, error))?;
+            let key = content_key(&content);
+            let cached = circuits.contains_key(&key);
+            if !cached {
+                let circuit = catch_unwind(|| Circuit::from_native(&content))
+                    .map_err(|_| format!("Invalid native circuit {}", path))?
+                    .map_err(|error| format!("Invalid native circuit {}: {}", path, error))?;
+                circuits.insert(key.clone(), circuit);
+            }
+            let circuit = &circuits[&key];
+            Ok(json!({"ok": true, "key": key, "num_qubits": circuit.qubits.len(),
+                      "approx_factor": circuit.approx_factor, "cached": cached}))
+        }
+        Request::Simulate { key, scheduler, code, qec_time, sector_size, empty_sector, error_rates, iterations } => {
+            let circuit = circuits.get(&key).ok_or_else(|| format!("No circuit loaded as {}", key))?;
+            let empty_sector = empty_sector.unwrap_or(EMPTY_SECTOR);
+            catch_unwind(AssertUnwindSafe(|| simulate(circuit, &scheduler, code, qec_time, sector_size, empty_sector,
+                                                      &error_rates, iterations)))
+                .unwrap_or_else(|_| Err(format!("{} scheduling failed", scheduler)))
+        }
+        Request::Constants => {
+            Ok(json!({"ok": true, "codes": CODES, "code_times": CODE_TIMES, "empty_sector": EMPTY_SECTOR,
+                      "error_rates": error_rate_ticks()}))
+        }
+        Request::Unload { key } => {
+            circuits.remove(&key);
+            Ok(json!({"ok": true}))
+        }
+        Request::Quit => unreachable!()
+    }
+}
+
+pub fn serve(input: impl BufRead, mut output: impl Write) {
+    let mut circuits = HashMap::new();
+    for line in input.lines() {
+        let line = line.expect("Fail to read a request");
+        if line.trim().is_empty() {
+            continue;
+        }
+        let response = match serde_json::from_str::<Request>(&line) {
+            Ok(Request::Quit) => break,
+            Ok(request) => handle(&mut circuits, request),
+            Err(error) => Err(format!("Invalid request: {}", error))
+        };
+        let response = response.unwrap_or_else(|error| json!({"ok": false, "error": error}));
+        writeln!(output, "{}", response).expect("Fail to write a response");
+        output.flush().expect("Fail to write a response");
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::NUM_ERROR_RATE_TICKS;
+
+    fn run(requests: &str) -> Vec<Value> {
+        let mut output = vec![];
+        serve(requests.as_bytes(), &mut output);
+        String::from_utf8(output).unwrap().lines().map(|line| serde_json::from_str(line).unwrap()).collect()
+    }
+
+    #[test]
+    fn test_worker() {
+        let path = std::env::temp_dir().join(format!("qecc_worker_{}.txt", std::process::id()));
+        std::fs::write(&path, "2 3\ngpi2 0\nms 0 1\nrz 1\ngpi 1\n").unwrap();
+        let load = format!("{{\"op\": \"load\", \"path\": {:?}}}", path.to_str().unwrap());
+        let responses = run(&format!("{}\n{}\n{}\n{}\n{}\n",
+            load, load,
+            "{\"op\": \"simulate\", \"key\": \"missing\", \"scheduler\": \"pmark\", \"sector_size\": 4, \"error_rates\": [0.0], \"iterations\": 1}",
+            "not json",
+            "{\"op\": \"quit\"}"));
+        std::fs::remove_file(&path).unwrap();
+        assert_eq!(responses.len(), 4);
+        assert_eq!(responses[0]["ok"], true);
+        assert_eq!(responses[0]["cached"], false);
+        assert_eq!(responses[0]["approx_factor"], 3);
+        assert_eq!(responses[1]["cached"], true);
+        assert_eq!(responses[1]["key"], responses[0]["key"]);
+        assert_eq!(responses[2]["ok"], false);
+        assert_eq!(responses[3]["ok"], false);
+
+        let key = responses[0]["key"].as_str().unwrap().to_string();
+        let mut circuits = HashMap::new();
+        circuits.insert(key.clone(), Circuit::from_str_native("2 3\ngpi2 0\nms 0 1\nrz 1\ngpi 1"));
+        let request = serde_json::from_value(json!({"op": "simulate", "key": key, "scheduler": "pmark", "sector_size": 4,
+                                                    "error_rates": [0.0, 1e-4], "iterations": 2})).unwrap();
+        let response = handle(&mut circuits, request).unwrap();
+        assert_eq!(response["runtimes"].as_array().unwrap().len(), 2);
+        assert_eq!(response["success_probs"][1][0], 1.0);
+        assert!(response["success_probs"][1][1].as_f64().unwrap() < 1.0);
+
+        let response = handle(&mut circuits, serde_json::from_value(json!({"op": "constants"})).unwrap()).unwrap();
+        assert_eq!(response["codes"][1], json!([17, 1, 5]));
+        assert_eq!(response["error_rates"].as_array().unwrap().len(), NUM_ERROR_RATE_TICKS + 1);
+    }
+}